@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Management command to benchmark the enterprise data API against synthetic data at production scale.
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import itertools
+import math
+import random
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+from logging import getLogger
+from timeit import default_timer
+
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count, Max
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from enterprise_data.models import EnterpriseEnrollment, EnterpriseUser
+
+LOGGER = getLogger(__name__)
+
+# Query parameter values of every filter of each v0 endpoint; every combination of them is benchmarked.
+# None leaves the parameter out and a tuple repeats it. Enrollment endpoints are also benchmarked with
+# audit enrollments both enabled and disabled for the enterprise, as AuditEnrollmentsFilterBackend reads it.
+ENROLLMENT_FILTERS = OrderedDict([
+    ('passed_date', [None, 'last_week']),
+    ('learner_activity', [None, 'active_past_week', 'inactive_past_week', 'inactive_past_month']),
+])
+ENDPOINTS = [
+    ('v0:enterprise-enrollments-list', ENROLLMENT_FILTERS, True),
+    ('v0:enterprise-enrollments-overview', ENROLLMENT_FILTERS, True),
+    ('v0:enterprise-users-list', OrderedDict([
+        ('has_enrollments', [None, 'true', 'false']),
+        ('active_courses', [None, 'true', 'false']),
+        ('all_enrollments_passed', [None, 'true', 'false']),
+        ('extra_fields', [
+            None, 'enrollment_count', 'course_completion_count', ('enrollment_count', 'course_completion_count'),
+        ]),
+    ]), False),
+    ('v0:enterprise-learner-completed-courses-list', OrderedDict(), False),
+]
+
+ENROLLMENT_MODES = (('verified', 0.6), ('audit', 0.25), ('professional', 0.1), ('no-id-professional', 0.05))
+CONSENT_GRANTED = ((True, 0.85), (False, 0.1), (None, 0.05))
+COUNTRY_CODES = ('US', 'IN', 'GB', 'CA', 'DE', 'BR', 'CN', 'FR', 'PK', 'NG')
+
+
+def weighted_choice(rng, choices):
+    """
+    Return one of the values of a sequence of (value, probability) pairs.
+    """
+    threshold = rng.random()
+    for value, probability in choices:
+        threshold -= probability
+        if threshold < 0:
+            return value
+    return choices[-1][0]
+
+
+def skewed_index(rng, count, exponent):
+    """
+    Return an index below `count`, where low indices are drawn more often the larger `exponent` is.
+    """
+    return min(int(count * rng.random() ** exponent), count - 1)
+
+
+def get_enrollment_counts(enrollment_count, enterprise_count, skew):
+    """
+    Split `enrollment_count` across enterprises following a Zipf distribution with exponent `skew`.
+
+    Every enterprise gets at least one enrollment, and the largest get the remainder of the rounding.
+    """
+    weights = [1 / rank ** skew for rank in range(1, enterprise_count + 1)]
+    total_weight = sum(weights)
+    counts = [max(int(enrollment_count * weight / total_weight), 1) for weight in weights]
+    for index in range(max(enrollment_count - sum(counts), 0)):
+        counts[index % enterprise_count] += 1
+    return counts
+
+
+def percentile(values, percent):
+    """
+    Return the nearest-rank `percent` percentile of a list of values.
+    """
+    ordered = sorted(values)
+    return ordered[max(int(math.ceil(percent / 100 * len(ordered))) - 1, 0)]
+
+
+class SyntheticDataGenerator(object):
+    """
+    Generates enterprises of synthetic enterprise users and their enrollments, shaped like the production data.
+
+    Each enterprise has about a third as many users as enrollments, plus a tenth more that never enrolled.
+    Some users and courses are much more popular than others, and both modes and outcomes follow the mix seen
+    in production: mostly verified enrollments with data sharing consent, a third of them passed.
+    """
+
+    def __init__(self, seed=0, course_count=2000):
+        self.rng = random.Random(seed)
+        self.now = timezone.now()
+        self.today = self.now.date()
+        max_user_id = EnterpriseUser.objects.aggregate(Max('enterprise_user_id'))['enterprise_user_id__max']
+        self.next_user_id = (max_user_id or 0) + 1
+        self.courses = [self.generate_course(index) for index in range(course_count)]
+
+    def generate_course(self, index):
+        """
+        Return the course fields of an enrollment in a synthetic course, a third of which have ended.
+        """
+        course_start = self.now - timedelta(days=self.rng.randint(0, 720))
+        course_end = course_start + timedelta(weeks=self.rng.randint(4, 16))
+        if index % 3:
+            course_end = self.now + timedelta(days=self.rng.randint(1, 180))
+        return {
+            'course_id': 'course-v1:BenchmarkX+Course{}+2018'.format(index),
+            'course_key': 'BenchmarkX+Course{}'.format(index),
+            'course_title': 'Benchmark Course {}'.format(index),
+            'course_start': course_start,
+            'course_end': course_end,
+            'course_pacing_type': 'self_paced' if index % 2 else 'instructor_paced',
+            'course_duration_weeks': str(self.rng.randint(4, 16)),
+            'course_min_effort': 2,
+            'course_max_effort': 6,
+            'course_price': 100 + index % 5 * 50,
+        }
+
+    def generate_user(self, enterprise_id):
+        """
+        Return an unsaved synthetic EnterpriseUser of the enterprise.
+        """
+        user_id = self.next_user_id
+        self.next_user_id += 1
+        last_activity_date = None
+        if self.rng.random() < 0.9:
+            last_activity_date = self.today - timedelta(days=self.rng.randint(0, 60))
+        return EnterpriseUser(
+            enterprise_id=enterprise_id,
+            lms_user_id=user_id,
+            enterprise_user_id=user_id,
+            enterprise_sso_uid='sso-{}'.format(user_id),
+            user_account_creation_timestamp=self.now - timedelta(days=self.rng.randint(0, 1500)),
+            user_email='learner{}@example.com'.format(user_id),
+            user_username='learner{}'.format(user_id),
+            user_country_code=self.rng.choice(COUNTRY_CODES),
+            last_activity_date=last_activity_date,
+            created=self.now,
+        )
+
+    def generate_enrollment(self, enterprise_id, enterprise_name, user):
+        """
+        Return an unsaved synthetic EnterpriseEnrollment of the user in one of the courses.
+        """
+        course = self.courses[skewed_index(self.rng, len(self.courses), 3)]
+        enrollment_created_timestamp = course['course_start'] + timedelta(days=self.rng.randint(-30, 60))
+        has_passed = self.rng.random() < 0.3
+        unenrollment_timestamp = None
+        if self.rng.random() < 0.05:
+            unenrollment_timestamp = enrollment_created_timestamp + timedelta(days=self.rng.randint(1, 30))
+        return EnterpriseEnrollment(
+            enterprise_id=enterprise_id,
+            enterprise_name=enterprise_name,
+            lms_user_id=user.lms_user_id,
+            enterprise_user_id=user.enterprise_user_id,
+            enrollment_created_timestamp=enrollment_created_timestamp,
+            user_current_enrollment_mode=weighted_choice(self.rng, ENROLLMENT_MODES),
+            consent_granted=weighted_choice(self.rng, CONSENT_GRANTED),
+            letter_grade='Pass' if has_passed else None,
+            has_passed=has_passed,
+            passed_timestamp=self.now - timedelta(days=self.rng.randint(0, 90)) if has_passed else None,
+            enterprise_sso_uid=user.enterprise_sso_uid,
+            user_account_creation_timestamp=user.user_account_creation_timestamp,
+            user_email=user.user_email,
+            user_username=user.user_username,
+            user_country_code=user.user_country_code,
+            last_activity_date=user.last_activity_date,
+            current_grade=self.rng.uniform(0.7, 1) if has_passed else self.rng.uniform(0, 0.7),
+            discount_price=0,
+            created=self.now,
+            unenrollment_timestamp=unenrollment_timestamp,
+            **course
+        )
+
+    def generate_enterprise(self, rank, enrollment_count):
+        """
+        Yield unsaved synthetic users of a new enterprise, then their enrollments.
+        """
+        enterprise_id = uuid.UUID(int=self.rng.getrandbits(128))
+        enterprise_name = 'Benchmark Enterprise {}'.format(rank)
+        enrolled_user_count = max(enrollment_count // 3, 1)
+        users = [
+            self.generate_user(enterprise_id)
+            for __ in range(enrolled_user_count + enrolled_user_count // 10)
+        ]
+        for user in users:
+            yield user
+        for __ in range(enrollment_count):
+            user = users[skewed_index(self.rng, enrolled_user_count, 2)]
+            yield self.generate_enrollment(enterprise_id, enterprise_name, user)
+
+    def generate(self, enrollment_count, enterprise_count, skew, batch_size):
+        """
+        Save synthetic enterprises with `enrollment_count` enrollments in total, in batches of `batch_size`.
+        """
+        counts = get_enrollment_counts(enrollment_count, enterprise_count, skew)
+        objects = itertools.chain.from_iterable(
+            self.generate_enterprise(rank, count) for rank, count in enumerate(counts, 1)
+        )
+        saved = 0
+        while True:
+            batch = list(itertools.islice(objects, batch_size))
+            if not batch:
+                break
+            # Users are always generated before their enrollments, so they are saved first.
+            for model, instances in itertools.groupby(batch, type):
+                model.objects.bulk_create(list(instances))
+            saved += len(batch)
+            LOGGER.info('Saved %d synthetic users and enrollments.', saved)
+
+
+class Command(BaseCommand):
+    """
+    Benchmark every v0 endpoint and filter combination of the enterprise data API through the DRF test client.
+
+    Synthetic data is generated first, unless --skip-data-generation is given to benchmark the data already in
+    the database, and is rolled back at the end unless --keep-data is given. The largest, median and smallest
+    enterprises are benchmarked by default, and for each endpoint, filter combination and enterprise, the p50
+    and p95 latency, the number of database queries and the rows returned per second are reported.
+
+    Example:
+        ./manage.py benchmark_enterprise_data_api --enrollments 1000000 --enterprises 1000 --repeat 5
+    """
+
+    help = 'Benchmark the enterprise data API against synthetic data at production scale.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--enrollments', type=int, default=1000000, help='Number of synthetic enrollments.')
+        parser.add_argument('--enterprises', type=int, default=1000, help='Number of synthetic enterprises.')
+        parser.add_argument(
+            '--skew', type=float, default=1.0,
+            help='Exponent of the Zipf distribution of enrollments across enterprises.',
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data.')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows saved per bulk insert.')
+        parser.add_argument('--skip-data-generation', action='store_true', help='Benchmark the existing data.')
+        parser.add_argument('--keep-data', action='store_true', help='Keep the synthetic data afterwards.')
+        parser.add_argument(
+            '--sample-enterprises', type=int, default=3,
+            help='Number of enterprises benchmarked, spread from the largest to the smallest.',
+        )
+        parser.add_argument('--repeat', type=int, default=5, help='Timed requests per case, after one warm-up.')
+        parser.add_argument('--page-size', type=int, default=100, help='Page size of list endpoints.')
+        parser.add_argument('--no-page', action='store_true', help='Request list endpoints without pagination.')
+        parser.add_argument(
+            '--endpoint', action='append', dest='endpoints',
+            help='Only benchmark the endpoints whose URL name contains this; may be repeated.',
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if not options['skip_data_generation']:
+                SyntheticDataGenerator(options['seed']).generate(
+                    options['enrollments'], options['enterprises'], options['skew'], options['batch_size']
+                )
+            self.benchmark(options)
+            if not options['keep_data']:
+                transaction.set_rollback(True)
+
+    def get_sample_enterprises(self, sample_count):
+        """
+        Return (enterprise_id, enrollment count) pairs of enterprises spread from the largest to the smallest.
+        """
+        enterprises = list(
+            EnterpriseEnrollment.objects.values_list('enterprise_id').annotate(
+                enrollment_count=Count('id')
+            ).order_by('-enrollment_count', 'enterprise_id')
+        )
+        if not enterprises or sample_count < 1:
+            return []
+        if sample_count == 1:
+            return enterprises[:1]
+        step = (len(enterprises) - 1) / (sample_count - 1)
+        indexes = sorted(set(int(round(index * step)) for index in range(sample_count)))
+        return [enterprises[index] for index in indexes]
+
+    def get_cases(self, options):
+        """
+        Yield (URL name, query parameters, audit enrollment setting) of every case to benchmark.
+        """
+        for url_name, filters, uses_audit_setting in ENDPOINTS:
+            if options['endpoints'] and not any(name in url_name for name in options['endpoints']):
+                continue
+            for values in itertools.product(*filters.values()):
+                params = OrderedDict((key, value) for key, value in zip(filters, values) if value is not None)
+                if url_name.endswith('-list'):
+                    params['page_size'] = options['page_size']
+                    if options['no_page']:
+                        params['no_page'] = 'true'
+                for enable_audit_enrollment in ([False, True] if uses_audit_setting else [None]):
+                    yield url_name, params, enable_audit_enrollment
+
+    def benchmark(self, options):
+        """
+        Request each case for each sample enterprise and report the results.
+        """
+        user, __ = User.objects.get_or_create(username='enterprise_data_benchmark', defaults={'is_staff': True})
+        client = APIClient()
+        client.force_authenticate(user=user)
+        enterprises = self.get_sample_enterprises(options['sample_enterprises'])
+
+        self.stdout.write('{:<45} {:>9} {:<80} {:>6} {:>9} {:>9} {:>7} {:>8} {:>10}'.format(
+            'endpoint', 'size', 'parameters', 'status', 'p50 ms', 'p95 ms', 'queries', 'rows', 'rows/s'
+        ))
+        with override_settings(ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']):
+            for url_name, params, enable_audit_enrollment in self.get_cases(options):
+                for enterprise_id, enrollment_count in enterprises:
+                    self.set_enterprise_access(client, enterprise_id, enable_audit_enrollment)
+                    url = reverse(url_name, kwargs={'enterprise_id': enterprise_id})
+                    self.stdout.write(self.format_result(
+                        url_name, params, enable_audit_enrollment, enrollment_count,
+                        self.time_requests(client, url, params, options['repeat']),
+                    ))
+
+    def set_enterprise_access(self, client, enterprise_id, enable_audit_enrollment):
+        """
+        Grant access to the enterprise in the client's session, so no request is made to the LMS.
+        """
+        session = client.session
+        session['enterprises_with_access'] = {str(enterprise_id): True}
+        session['enable_audit_enrollment'] = {str(enterprise_id): bool(enable_audit_enrollment)}
+        session.save()
+
+    def time_requests(self, client, url, params, repeat):
+        """
+        Request the URL once to warm up and `repeat` more times, and return the measurements of the requests.
+        """
+        latencies = []
+        for __ in range(repeat + 1):
+            with CaptureQueriesContext(connection) as queries:
+                start = default_timer()
+                response = client.get(url, params)
+                latencies.append(default_timer() - start)
+        data = getattr(response, 'data', None)
+        if isinstance(data, dict) and 'results' in data:
+            rows = len(data['results'])
+        elif isinstance(data, list):
+            rows = len(data)
+        else:
+            rows = 1 if response.status_code == 200 else 0
+        return {
+            'status': response.status_code,
+            'latencies': latencies[1:] or latencies,
+            'queries': len(queries),
+            'rows': rows,
+        }
+
+    def format_result(self, url_name, params, enable_audit_enrollment, enrollment_count, result):
+        """
+        Return a line of the report.
+        """
+        described_params = ['{}={}'.format(key, '+'.join(value) if isinstance(value, tuple) else value)
+                            for key, value in params.items()]
+        if enable_audit_enrollment is not None:
+            described_params.append('audit={}'.format('on' if enable_audit_enrollment else 'off'))
+        p50 = percentile(result['latencies'], 50)
+        return '{:<45} {:>9,} {:<80} {:>6} {:>9.1f} {:>9.1f} {:>7} {:>8,} {:>10,.0f}'.format(
+            url_name,
+            enrollment_count,
+            '&'.join(described_params) or '-',
+            result['status'],
+            p50 * 1000,
+            percentile(result['latencies'], 95) * 1000,
+            result['queries'],
+            result['rows'],
+            result['rows'] / p50 if p50 else 0,
+        )
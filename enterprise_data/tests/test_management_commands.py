@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the `enterprise-data` management commands.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import unittest
+
+from pytest import mark
+from six import StringIO
+
+from django.core.management import call_command
+
+from enterprise_data.management.commands.benchmark_enterprise_data_api import (
+    ENDPOINTS,
+    get_enrollment_counts,
+    percentile,
+)
+from enterprise_data.models import EnterpriseEnrollment, EnterpriseUser
+
+
+@mark.django_db
+class TestBenchmarkEnterpriseDataApi(unittest.TestCase):
+    """
+    Tests for the benchmark_enterprise_data_api management command.
+    """
+
+    def test_get_enrollment_counts(self):
+        counts = get_enrollment_counts(1000, 10, 1.0)
+        assert sum(counts) == 1000
+        assert counts == sorted(counts, reverse=True)
+        assert counts[0] > 5 * counts[-1]
+        assert get_enrollment_counts(5, 10, 1.0) == [1] * 10
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3]
+        assert percentile(values, 50) == 3
+        assert percentile(values, 95) == 5
+        assert percentile([7], 95) == 7
+
+    def test_benchmark(self):
+        """
+        Every endpoint is benchmarked for each sample enterprise, and the synthetic data is rolled back.
+        """
+        output = StringIO()
+        call_command(
+            'benchmark_enterprise_data_api', enrollments=300, enterprises=5, sample_enterprises=2, repeat=1,
+            stdout=output,
+        )
+
+        lines = output.getvalue().splitlines()
+        case_count = 2 * 8 * 2 + 3 * 3 * 3 * 4 + 1
+        assert len(lines) == 1 + case_count * 2
+        for url_name, __, __ in ENDPOINTS:
+            assert any(line.startswith(url_name + ' ') for line in lines)
+        assert all(line.split()[1] in ('132', '26') for line in lines[1:])
+        assert '&extra_fields=enrollment_count+course_completion_count&' in output.getvalue()
+        assert lines[1].split()[3] == '200'
+        assert not EnterpriseEnrollment.objects.exists()
+        assert not EnterpriseUser.objects.exists()
+
+    def test_benchmark_keep_data(self):
+        call_command(
+            'benchmark_enterprise_data_api', enrollments=100, enterprises=3, endpoint=['overview'], repeat=1,
+            keep_data=True, stdout=StringIO(),
+        )
+        assert EnterpriseEnrollment.objects.count() == 100
+        assert EnterpriseEnrollment.objects.values('enterprise_id').distinct().count() == 3
+        assert EnterpriseUser.objects.filter(enrollments__isnull=True).exists()
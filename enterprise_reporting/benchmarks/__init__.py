@@ -0,0 +1,8 @@
+"""
+Benchmarks for the enterprise reporting scripts.
+
+Each benchmark is a runnable module, e.g. `python -m enterprise_reporting.benchmarks.vertica_stream --help`,
+that exercises the reporting code against local stand-ins for the external systems it normally talks to.
+"""
+
+from __future__ import absolute_import, unicode_literals
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark compressing and PGP encrypting a large report, reporting wall time and peak RSS.
+
+Peak RSS is a process-wide high-water mark, so only one encryption mode is measured per run:
+    python -m enterprise_reporting.benchmarks.compress_encrypt --size-mb 2048 --mode streaming
+    python -m enterprise_reporting.benchmarks.compress_encrypt --size-mb 2048 --mode in-memory
+"""
+from __future__ import absolute_import, unicode_literals
+
+import argparse
+import csv
+import os
+import tempfile
+from collections import OrderedDict
+from io import open  # pylint: disable=redefined-builtin
+
+import pgpy
+from pgpy.constants import CompressionAlgorithm, HashAlgorithm, KeyFlags, PubKeyAlgorithm, SymmetricKeyAlgorithm
+
+from enterprise_reporting import utils
+from enterprise_reporting.benchmarks.fakes import generate_progress_rows
+from enterprise_reporting.benchmarks.utils import peak_rss_megabytes, print_results, timed
+
+
+def get_encrypted_file_in_memory(zipfile, pgp_key):
+    """
+    The in-memory implementation of `utils._get_encrypted_file` for an existing zip file, kept as the baseline.
+    """
+    rsa_pub, _ = pgpy.PGPKey.from_blob(pgp_key)
+    message = pgpy.PGPMessage.new(zipfile, file=True)
+    pgpfile = '{}.pgp'.format(zipfile)
+    encrypted_message = rsa_pub.encrypt(message)
+    with open(pgpfile, 'wb') as encrypted_file:
+        encrypted_file.write(encrypted_message.__bytes__())
+    return pgpfile
+
+
+def create_pgp_key():
+    """Create a throwaway key pair to encrypt the report for."""
+    key = pgpy.PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, 2048)
+    uid = pgpy.PGPUID.new('Benchmark', email='benchmark@example.com')
+    key.add_uid(uid, usage={KeyFlags.EncryptCommunications, KeyFlags.EncryptStorage},
+                hashes=[HashAlgorithm.SHA256], ciphers=[SymmetricKeyAlgorithm.AES256],
+                compression=[CompressionAlgorithm.Uncompressed])
+    return key
+
+
+def write_report(file_path, size_bytes):
+    """Write a synthetic progress report CSV of roughly `size_bytes` bytes."""
+    with open(file_path, 'w') as report_file:
+        writer = csv.writer(report_file)
+        while report_file.tell() < size_bytes:
+            writer.writerows(row for row, _ in generate_progress_rows(10000))
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=2048, help='Approximate size of the report CSV.')
+    parser.add_argument('--mode', choices=['streaming', 'in-memory'], default='streaming',
+                        help='Zip straight into the encrypted data (current), or zip to a file then load it into '
+                             'a PGPMessage (previous).')
+    args = parser.parse_args()
+
+    report_path = tempfile.NamedTemporaryFile(suffix='_progress_csv.csv', delete=False).name
+    pgp_key = str(create_pgp_key().pubkey)
+    results = OrderedDict()
+    files = [report_path]
+    try:
+        with timed(results, 'write report'):
+            write_report(report_path, args.size_mb * 1024 * 1024)
+        rss_before_encryption = peak_rss_megabytes()
+        with open(report_path, 'rb') as report_file:
+            if args.mode == 'streaming':
+                with timed(results, 'compress and encrypt (streaming)'):
+                    files.append(utils._get_encrypted_file([report_file], pgp_key))  # pylint: disable=protected-access
+            else:
+                with timed(results, 'compress'):
+                    zipfile = utils._get_compressed_file([report_file])  # pylint: disable=protected-access
+                files.append(zipfile)
+                with timed(results, 'encrypt (in-memory)'):
+                    files.append(get_encrypted_file_in_memory(zipfile, pgp_key))
+        encrypted_size = os.path.getsize(files[-1])
+    finally:
+        for file_path in files:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    print_results('Compress and encrypt a {} MB report ({:.1f} MB encrypted)'.format(
+        args.size_mb, encrypted_size / 1024.0 / 1024.0
+    ), results)
+    print('  peak RSS before encryption: {:.1f} MB'.format(rss_before_encryption))
+    print('  peak RSS after encryption:  {:.1f} MB'.format(peak_rss_megabytes()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins for the external systems used by the enterprise reporting scripts.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+import itertools
+import json
+import re
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+
+def generate_progress_rows(row_count, enterprise_ids=('0' * 32,)):
+    """
+    Lazily generate synthetic rows shaped like `EnterpriseReportSender.VERTICA_QUERY_FIELDS`.
+
+    When several `enterprise_ids` are given, rows are spread evenly across them in enterprise_id order.
+    """
+    start = datetime.datetime(2018, 1, 1)
+    rows_per_enterprise = max(row_count // len(enterprise_ids), 1)
+    for index in range(row_count):
+        enterprise_id = enterprise_ids[min(index // rows_per_enterprise, len(enterprise_ids) - 1)]
+        created = start + datetime.timedelta(minutes=index)
+        passed = index % 3 == 0
+        yield (
+            index,
+            index + 1000,
+            'sso-uid-{}'.format(index) if index % 2 else None,
+            created,
+            True,
+            'course-v1:edX+DemoX{}+2018'.format(index % 500),
+            'Demo Course {}'.format(index % 500),
+            '6 weeks',
+            2,
+            4,
+            created - datetime.timedelta(days=30),
+            'learner{}@example.com'.format(index),
+            'learner{}'.format(index),
+            20 + index % 50,
+            'b',
+            'f' if index % 2 else 'm',
+            'US',
+            'United States',
+            passed,
+            created + datetime.timedelta(days=14) if passed else None,
+            (index % 100) / 10.0,
+            (created + datetime.timedelta(days=7)).date(),
+            'verified' if passed else 'audit',
+        ), enterprise_id
+
+
+def generate_catalog_items(item_count, start=0):
+    """
+    Lazily generate synthetic content metadata items shaped like the enterprise catalog API's.
+
+    Items are numbered from `start` to `item_count` and cycle through the course, course run and program
+    content types. Every tenth course also has a
+    `prerequisites_raw` field the others lack, as optional fields are omitted by the API.
+    """
+    for index in range(start, item_count):
+        content_type = ('course', 'courserun', 'program')[index % 3]
+        key = 'edX+DemoX{}'.format(index)
+        item = {
+            'content_type': content_type,
+            'key': key if content_type != 'courserun' else 'course-v1:{}+2018'.format(key),
+            'title': 'Demo Content {}'.format(index),
+            'short_description': '<p>A short description of demo content {}.</p>'.format(index),
+            'uuid': '{:032x}'.format(index),
+            'modified': '2018-10-{:02d}T12:00:00Z'.format(index % 28 + 1),
+            'image': {'src': 'https://example.com/images/{}.png'.format(index), 'height': None, 'width': None},
+            'owners': [{'key': 'edX', 'name': 'edX', 'logo_image_url': 'https://example.com/edx.png'}],
+            'subjects': ['Computer Science', 'Data Analysis'][:index % 3],
+            'enrollment_url': 'https://example.com/enroll/{}'.format(index),
+        }
+        if content_type == 'course':
+            item['course_runs'] = [
+                {'key': 'course-v1:{}+{}'.format(key, year), 'start': '{}-01-01T00:00:00Z'.format(year)}
+                for year in (2017, 2018)
+            ]
+            if index % 10 == 0:
+                item['prerequisites_raw'] = 'Demo Content {}'.format(index - 1)
+        elif content_type == 'courserun':
+            item.update({'start': '2018-01-01T00:00:00Z', 'end': '2018-06-01T00:00:00Z', 'pacing_type': 'self_paced'})
+        else:
+            item.update({'type': 'XSeries', 'courses': [{'key': key, 'title': 'Demo Content {}'.format(index)}]})
+        yield item
+
+
+def generate_data_api_enrollments(enterprise_id, start, stop):
+    """
+    Lazily generate synthetic enrollments numbered from `start` to `stop`, shaped like the Enterprise Data API's.
+    """
+    for index in range(start, stop):
+        passed = index % 3 == 0
+        created = datetime.datetime(2018, 1, 1) + datetime.timedelta(minutes=index)
+        course_id = 'course-v1:edX+DemoX{}+2018'.format(index % 500)
+        yield {
+            'id': index + 1,
+            'enterprise_id': enterprise_id,
+            'enterprise_name': 'Enterprise {}'.format(enterprise_id),
+            'lms_user_id': index + 1000,
+            'enterprise_user': index // 3 + 1,
+            'course_id': course_id,
+            'course_key': 'edX+DemoX{}'.format(index % 500),
+            'course_title': 'Demo Course {}'.format(index % 500),
+            'course_start': '2018-01-01T00:00:00Z',
+            'course_end': '2018-06-01T00:00:00Z',
+            'course_pacing_type': 'self_paced',
+            'course_duration_weeks': '6',
+            'course_min_effort': 2,
+            'course_max_effort': 4,
+            'course_price': '200.00',
+            'discount_price': '120.00',
+            'course_api_url': '/enterprise/v1/enterprise-catalogs/{}/courses/{}'.format(enterprise_id, course_id),
+            'enrollment_created_timestamp': created.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'unenrollment_timestamp': None,
+            'unenrollment_end_within_date': None,
+            'user_current_enrollment_mode': 'verified' if passed else 'audit',
+            'consent_granted': True,
+            'letter_grade': 'Pass' if passed else None,
+            'has_passed': passed,
+            'passed_timestamp': (created + datetime.timedelta(days=14)).strftime('%Y-%m-%dT%H:%M:%SZ')
+                                if passed else None,
+            'current_grade': 0.8 if passed else 0.2,
+            'enterprise_sso_uid': 'sso-uid-{}'.format(index),
+            'enterprise_site_id': None,
+            'user_account_creation_timestamp': '2017-01-01T00:00:00Z',
+            'user_email': 'learner{}@example.com'.format(index),
+            'user_username': 'learner{}'.format(index),
+            'user_country_code': 'US',
+            'last_activity_date': (created + datetime.timedelta(days=7)).strftime('%Y-%m-%d'),
+            'coupon_name': None,
+            'coupon_code': None,
+            'offer': None,
+        }
+
+
+def generate_html_blocks(block_count, course_count=1000):
+    """
+    Lazily generate synthetic coursegraph records of html blocks, as returned by the link report's query.
+
+    Blocks are spread evenly across `course_count` courses, one in ten of which has an old style course key.
+    Their html mixes external links with links to edx.org and to images, in varying case and across lines.
+    """
+    blocks_per_course = max(block_count // course_count, 1)
+    for index in range(block_count):
+        course_index = index // blocks_per_course
+        if course_index % 10 == 9:
+            course_key = 'edX/Old{}/2014'.format(course_index)
+        else:
+            course_key = 'course-v1:edX+DemoX{}+2018'.format(course_index)
+        yield {
+            'course_title': 'Demo Course {}'.format(course_index),
+            'organization': 'edX',
+            'h.course_key': course_key,
+            'h.location': 'block-v1:edX+DemoX{}+2018+type@html+block@{}'.format(course_index, index),
+            'h.edited_on': '2018-01-01 00:00:00+00:00',
+            'h.data': (
+                '<p>Read <a href="https://example.com/articles/{index}">this article</a> and watch '
+                '<a href="http://videos.example.org/watch?v={index}&amp;t=1">this video</a>.</p>\n'
+                '<img src="https://cdn.example.com/figures/{index}.PNG" alt="figure"/>'
+                '<img src="https://cdn.example.com/photos/{index}.jpeg"/>\n'
+                '<p>See also <a href="https://courses.edx.org/courses/{course_key}/about">the course</a>, '
+                'https://example.com/plain/{course} <br/>and https://example.com/broken\nline".</p>'
+            ).format(index=index, course=course_index, course_key=course_key) * (1 + index % 3),
+        }
+
+
+class FakeCoursegraph(object):
+    """
+    Stands in for coursegraph running the link report's queries over records of html blocks.
+
+    Blocks of old style course keys, and of courses not in the `course_keys` parameter when it is given, are
+    dropped and the rest are grouped by course, in order of first appearance. When the query asks for the
+    versions of the blocks, their locations and edit times are returned instead of their html. When it uses
+    APOC, links are extracted from each block's html the way the query does, by turning the groups of each
+    match of the `pattern` parameter into a link.
+    """
+
+    def __init__(self, html_blocks):
+        self.html_blocks = html_blocks
+        self.queries = []
+
+    def run(self, query, **parameters):
+        """
+        Return the records of the link report's query.
+        """
+        assert "h.course_key STARTS WITH 'course-'" in query
+        self.queries.append((query, parameters))
+        course_keys = parameters.get('course_keys')
+        courses = OrderedDict()
+        for block in self.html_blocks:
+            if not block['h.course_key'].startswith('course-'):
+                continue
+            if course_keys is not None and block['h.course_key'] not in course_keys:
+                continue
+            course = (block['course_title'], block['organization'], block['h.course_key'])
+            courses.setdefault(course, []).append(block)
+
+        records = []
+        for (course_title, organization, course_key), blocks in courses.items():
+            record = {'course_title': course_title, 'organization': organization, 'course_key': course_key}
+            html_blocks = [block['h.data'] for block in blocks]
+            if 'block_versions' in query:
+                record['block_versions'] = [[block['h.location'], block['h.edited_on']] for block in blocks]
+            elif 'apoc.text.regexGroups' in query:
+                pattern = re.compile(parameters['pattern'])
+                record['external_links'] = list(set(
+                    match.group(1) + '://' + match.group(2)[:-1]
+                    for html_string in html_blocks
+                    for match in pattern.finditer(html_string)
+                    if match.group(2) is not None
+                ))
+            else:
+                record['html_blocks'] = html_blocks
+            records.append(record)
+        return records
+
+
+class LocalEdxApiRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the LMS and Enterprise Data API endpoints used by the reporter from a `LocalEdxApiServer`'s data.
+    """
+
+    PAGINATED_PATHS = [
+        (re.compile(r'^/enterprise/api/v0/enterprise/([^/]+)/enrollments/$'), 'get_enrollments'),
+        (re.compile(r'^/enterprise/api/v1/enterprise_catalogs/([^/]+)/$'), 'get_catalog_items'),
+    ]
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if urlparse(self.path).path != '/oauth2/access_token':
+            return self.send_error(404)
+        self._send_json({'access_token': 'benchmark-token', 'expires_in': 3600, 'token_type': 'JWT'})
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        querystring = parse_qs(url.query)
+        self.server.request_count += 1
+        if url.path == '/enterprise/api/v1/enterprise_catalogs/':
+            enterprise_id = querystring['enterprise_customer'][0]
+            catalogs = [{'uuid': enterprise_id}] if enterprise_id in self.server.catalog_item_counts else []
+            return self._send_json({'count': len(catalogs), 'next': None, 'previous': None, 'results': catalogs})
+        for pattern, get_results in self.PAGINATED_PATHS:
+            match = pattern.match(url.path)
+            if match:
+                page = int(querystring.get('page', ['1'])[0])
+                page_size = int(querystring.get('page_size', ['100'])[0])
+                count, results = getattr(self.server, get_results)(
+                    match.group(1), (page - 1) * page_size, page * page_size
+                )
+                next_page = None
+                if page * page_size < count:
+                    next_page = 'http://{}:{}{}?page={}&page_size={}'.format(
+                        self.server.server_address[0], self.server.server_address[1], url.path, page + 1, page_size
+                    )
+                return self._send_json({'count': count, 'next': next_page, 'previous': None, 'results': results})
+        return self.send_error(404)
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class LocalEdxApiServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTP server on localhost standing in for the LMS and the Enterprise Data API.
+
+    It hands out access tokens, and pages of the synthetic enrollments and catalog items of the enterprises
+    added with `add_enterprise`; each enterprise has a single catalog whose uuid is the enterprise's.
+    Use it as a context manager; `url` is the root URL of both APIs and `request_count` counts GET requests.
+    """
+
+    daemon_threads = True
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), LocalEdxApiRequestHandler)
+        self.enrollment_counts = {}
+        self.catalog_item_counts = {}
+        self.request_count = 0
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def add_enterprise(self, enterprise_id, enrollment_count=0, catalog_item_count=0):
+        self.enrollment_counts[enterprise_id] = enrollment_count
+        self.catalog_item_counts[enterprise_id] = catalog_item_count
+
+    def get_enrollments(self, enterprise_id, start, stop):
+        count = self.enrollment_counts.get(enterprise_id, 0)
+        return count, list(generate_data_api_enrollments(enterprise_id, start, min(stop, count)))
+
+    def get_catalog_items(self, catalog_uuid, start, stop):
+        count = self.catalog_item_counts.get(catalog_uuid, 0)
+        return count, list(generate_catalog_items(min(stop, count), start))
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeSESClient(object):
+    """
+    Stands in for a boto3 SES client, recording the size of each raw email instead of sending it.
+    """
+
+    def __init__(self):
+        self.sent_message_sizes = []
+
+    def send_raw_email(self, RawMessage, Source, Destinations):  # pylint: disable=invalid-name
+        self.sent_message_sizes.append(len(RawMessage['Data']))
+        return {'MessageId': str(len(self.sent_message_sizes))}
+
+
+class FakeVerticaCursor(object):
+    """
+    A cursor that serves synthetic rows instead of querying Vertica.
+
+    `row_factory` is called on every `execute` and returns (row, enterprise_id) pairs.
+    The enterprise_id of each row is only exposed when `include_enterprise_id` is set, in which case it is
+    prepended to the row, as for a query that selects it first.
+    """
+
+    def __init__(self, row_factory, include_enterprise_id=False):
+        self.row_factory = row_factory
+        self.include_enterprise_id = include_enterprise_id
+        self.executed = []
+        self._iterator = iter(())
+
+    def execute(self, query, parameters=None):
+        self.executed.append((query, parameters))
+        if self.include_enterprise_id:
+            self._iterator = ((enterprise_id,) + row for row, enterprise_id in self.row_factory())
+        else:
+            self._iterator = (row for row, _ in self.row_factory())
+
+    def iterate(self):
+        return self._iterator
+
+    def fetchone(self):
+        return next(self._iterator, None)
+
+    def fetchmany(self, size=None):
+        return list(itertools.islice(self._iterator, size or 1))
+
+    def fetchall(self):
+        return list(self._iterator)
+
+    def close(self):
+        self._iterator = iter(())
+
+
+class FakeVerticaConnection(object):
+    """
+    A connection that hands out `FakeVerticaCursor`s over the same synthetic rows.
+    """
+
+    def __init__(self, row_count, enterprise_ids=('0' * 32,), include_enterprise_id=False):
+        self.row_count = row_count
+        self.enterprise_ids = enterprise_ids
+        self.include_enterprise_id = include_enterprise_id
+        self.cursors = []
+
+    def cursor(self):
+        cursor = FakeVerticaCursor(
+            lambda: generate_progress_rows(self.row_count, self.enterprise_ids),
+            include_enterprise_id=self.include_enterprise_id,
+        )
+        self.cursors.append(cursor)
+        return cursor
+
+    def close(self):
+        pass
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark turning catalog content metadata into CSV rows and flattening nested items.
+
+Usage:
+    python -m enterprise_reporting.benchmarks.flatten --items 50000
+"""
+from __future__ import absolute_import, unicode_literals
+
+import argparse
+from collections import OrderedDict
+
+from enterprise_reporting.benchmarks.fakes import generate_catalog_items
+from enterprise_reporting.benchmarks.utils import print_results, timed
+from enterprise_reporting.utils import CompiledFlattener, flatten_dict
+
+
+def generate_data_with_ordered_dicts(item, target='key' or 'value'):
+    """
+    The previous implementation of `generate_data`, kept here as the baseline.
+    """
+    data = []
+    target_is_key = target == 'key'
+    for key, value in OrderedDict(sorted(item.items())).items():
+        if target_is_key:
+            data.append(key)
+            continue
+        if isinstance(value, list) and not len(value):
+            value = ''
+        data.append(value)
+    return data
+
+
+def flatten_dict_with_ordered_dicts(d, target='key' or 'value'):
+    """
+    The previous implementation of `flatten_dict`, kept here as the baseline.
+    """
+    def format_nested(nested, _key=None):
+        if _key is None:
+            _key = key
+        return '{}_{}'.format(_key, nested)
+
+    flattened = []
+    target_is_key = target == 'key'
+    for key, value in OrderedDict(sorted(d.items())).items():
+        if isinstance(value, dict):
+            flattened += map(
+                format_nested if target_is_key else lambda x: x,
+                flatten_dict_with_ordered_dicts(value, target=target)
+            )
+        elif isinstance(value, list):
+            items_are_dict = [isinstance(item, dict) for item in value]
+            items_are_list = [isinstance(item, list) for item in value]
+            if any(items_are_dict) and not all(items_are_dict):
+                raise NotImplementedError()
+            if any(items_are_list):
+                raise NotImplementedError()
+            elif all(items_are_dict):
+                for index, item in enumerate(value):
+                    _flattened_dict = flatten_dict_with_ordered_dicts(item, target=target)
+                    if target_is_key:
+                        _flattened_dict = [format_nested(flattened_item, _key=index)
+                                           for flattened_item in _flattened_dict]
+                    flattened += map(format_nested if target_is_key else lambda x: x, _flattened_dict)
+            else:
+                flattened += map(format_nested, range(len(value))) if target_is_key else value
+        else:
+            flattened.append(key if target_is_key else value)
+    return flattened
+
+
+def rows_per_item(items):
+    """Build rows the way the catalog CSV report used to: sorting every item's keys."""
+    return [generate_data_with_ordered_dicts(item, target='value') for item in items]
+
+
+def rows_compiled(items):
+    """Build rows with one CompiledFlattener per content type."""
+    flatteners = {}
+    rows = []
+    for item in items:
+        flattener = flatteners.get(item['content_type'])
+        if flattener is None:
+            flattener = flatteners[item['content_type']] = CompiledFlattener(item)
+        rows.append(flattener.values(item))
+    return rows
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=50000, help='Number of synthetic catalog items.')
+    args = parser.parse_args()
+
+    items = list(generate_catalog_items(args.items))
+
+    results = OrderedDict()
+    with timed(results, 'generate_data (previous)'):
+        expected_rows = rows_per_item(items)
+    with timed(results, 'CompiledFlattener'):
+        rows = rows_compiled(items)
+    assert rows == expected_rows
+    print_results('Catalog items to CSV rows, {:,} items'.format(args.items), results, args.items, unit='items')
+
+    results = OrderedDict()
+    with timed(results, 'flatten_dict (previous)'):
+        expected_rows = [flatten_dict_with_ordered_dicts(item, target='value') for item in items]
+    with timed(results, 'flatten_dict'):
+        rows = [flatten_dict(item, target='value') for item in items]
+    assert rows == expected_rows
+    print_results('Flattening nested catalog items, {:,} items'.format(args.items), results, args.items, unit='items')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark extracting external links from coursegraph html blocks for the external resource link report.
+
+The previous query returned one record per html block, archived courses included; the current one returns one
+record per course, and with APOC only the links. The bytes each returns are compared too, as are incremental
+reports that only re-extract the courses changed since the last one.
+
+Usage:
+    python -m enterprise_reporting.benchmarks.link_extraction --blocks 1000000 --workers 8
+"""
+from __future__ import absolute_import, unicode_literals
+
+import argparse
+import os
+import re
+import tempfile
+from collections import OrderedDict
+
+from enterprise_reporting.benchmarks.fakes import FakeCoursegraph, generate_html_blocks
+from enterprise_reporting.benchmarks.utils import peak_rss_megabytes, print_results, timed
+from enterprise_reporting.external_resource_link_report import (
+    COURSEGRAPH_APOC_QUERY,
+    COURSEGRAPH_QUERY,
+    EXTERNAL_LINK_PATTERN,
+    LinkReportState,
+    process_results,
+    update_link_report,
+)
+
+
+def gather_links_with_lazy_regex(html_string):
+    """
+    The previous implementation of `gather_links_from_html`, kept here as the baseline.
+    """
+    pattern = 'https?://.*?[" <]'
+    links = set([
+        link[0:-1]
+        for link in re.findall(pattern, html_string,)
+        if (not link.lower().endswith('.png"') and
+            not link.lower().endswith('.jpg"') and
+            not link.lower().endswith('.jpeg"') and
+            not link.lower().endswith('.gif"') and
+            not '.edx.org' in link)
+    ])
+    return links
+
+
+def process_results_serially(raw_results):
+    """
+    The previous implementation of `process_results`, kept here as the baseline.
+    """
+    processed_results = {}
+    for entry in raw_results:
+        course_key = entry['h.course_key']
+        if not course_key.startswith('course-'):
+            continue
+        external_links = gather_links_with_lazy_regex(entry['h.data'])
+        if not external_links:
+            continue
+        if course_key not in processed_results:
+            processed_results[course_key] = {
+                'course_title': entry['course_title'],
+                'organization': entry['organization'],
+                'external_links': external_links,
+            }
+        else:
+            processed_results[course_key]['external_links'].update(external_links)
+    return processed_results
+
+
+def get_records_size(records):
+    """
+    Return the number of characters of the string values of the records, and of the lists of strings in them.
+    """
+    return sum(
+        sum(len(item) for item in value) if isinstance(value, list) else len(value)
+        for record in records
+        for value in record.values()
+    )
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--blocks', type=int, default=1000000, help='Number of synthetic html blocks.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Extraction processes.')
+    args = parser.parse_args()
+
+    raw_results = list(generate_html_blocks(args.blocks))
+    coursegraph = FakeCoursegraph(raw_results)
+    course_records = coursegraph.run(COURSEGRAPH_QUERY)
+    link_records = coursegraph.run(COURSEGRAPH_APOC_QUERY, pattern=EXTERNAL_LINK_PATTERN.pattern)
+
+    results = OrderedDict()
+    with timed(results, 'lazy regex + filters (previous)'):
+        expected = process_results_serially(raw_results)
+    with timed(results, 'single-pass regex, 1 process'):
+        processed = process_results(course_records, workers=1)
+    assert processed == expected
+    if args.workers > 1:
+        with timed(results, 'single-pass regex, {} processes'.format(args.workers)):
+            processed = process_results(course_records, workers=args.workers)
+        assert processed == expected
+    with timed(results, 'links extracted by APOC'):
+        processed = process_results(link_records, links_extracted=True)
+    assert processed == expected
+
+    with tempfile.TemporaryDirectory() as state_directory:
+        state = LinkReportState(os.path.join(state_directory, 'state.json'))
+        update_link_report(coursegraph, state, workers=args.workers)
+        with timed(results, 'incremental, no course changed'):
+            processed = update_link_report(coursegraph, state, workers=args.workers)
+        assert processed == expected
+        for block in raw_results[::len(raw_results) // 100 or 1]:  # a block of every 10th of 1000 courses
+            block['h.edited_on'] = '2019-01-01 00:00:00+00:00'
+        with timed(results, 'incremental, 1 in 10 courses edited'):
+            processed = update_link_report(coursegraph, state, workers=args.workers)
+        assert processed == expected
+
+    print_results('External links from {:,} html blocks'.format(args.blocks), results, args.blocks, unit='blocks')
+    print('  peak RSS: {:.1f} MB'.format(peak_rss_megabytes()))
+    print('  returned by the query, per html block (previous): {:,} records, {:.1f} MB'.format(
+        len(raw_results), get_records_size(raw_results) / 1e6))
+    print('  returned by the query, per course: {:,} records, {:.1f} MB'.format(
+        len(course_records), get_records_size(course_records) / 1e6))
+    print('  returned by the query, with APOC: {:,} records, {:.1f} MB'.format(
+        len(link_records), get_records_size(link_records) / 1e6))
+
+
+if __name__ == '__main__':
+    main()
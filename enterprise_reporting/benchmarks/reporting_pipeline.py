@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark sending reports end to end with `EnterpriseReportSender`, against local stand-ins for every external
+system: a fake Vertica connection, a local HTTP server for the Enterprise Data API and the LMS, a local SFTP
+server and a stubbed SES client.
+
+The time of each stage (fetch, write, compress, encrypt and deliver) and the peak RSS are reported for a
+small, a medium and a huge synthetic customer. Reports are PGP encrypted, so they are zipped as they are
+encrypted and their compression is counted in the encrypt stage. Each report is sent from a process of its
+own, so that the peak RSS is that of the report alone.
+
+Usage:
+    python -m enterprise_reporting.benchmarks.reporting_pipeline --customers small medium huge
+    python -m enterprise_reporting.benchmarks.reporting_pipeline --scale 0.1 --reports progress:csv:sftp
+"""
+from __future__ import absolute_import, unicode_literals
+
+import argparse
+import inspect
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+
+from enterprise_reporting import utils
+from enterprise_reporting.benchmarks.compress_encrypt import create_pgp_key
+from enterprise_reporting.benchmarks.fakes import FakeSESClient, FakeVerticaConnection, LocalEdxApiServer
+from enterprise_reporting.benchmarks.utils import peak_rss_megabytes
+from enterprise_reporting.clients import EdxOAuth2APIClient
+from enterprise_reporting.clients.enterprise import EnterpriseAPIClient, EnterpriseDataApiClient
+from enterprise_reporting.clients.vertica import VerticaClient
+from enterprise_reporting.delivery_method import SFTPDeliveryMethod, SMTPDeliveryMethod
+from enterprise_reporting.reporter import EnterpriseReportSender
+from enterprise_reporting.tests.sftp_server import LocalSFTPServer
+
+# The number of enrollments and catalog items of each synthetic customer.
+CUSTOMER_SIZES = OrderedDict([
+    ('small', (1000, 100)),
+    ('medium', (100000, 5000)),
+    ('huge', (2000000, 50000)),
+])
+DEFAULT_REPORTS = ['progress:csv:sftp', 'progress_v2:json:email', 'catalog:csv:sftp']
+STAGES = ['fetch', 'write', 'compress', 'encrypt', 'deliver']
+
+# The functions timed for each measured stage; `write` and `deliver` are what is left of `generate` and `send`
+# once the stages nested in them are taken out.
+TIMED_FUNCTIONS = [
+    (VerticaClient, 'stream_result_batches', 'fetch'),
+    (VerticaClient, 'stream_raw_results', 'fetch'),
+    (EnterpriseDataApiClient, 'get_enterprise_enrollments', 'fetch'),
+    (EnterpriseDataApiClient, 'iterate_enterprise_enrollments', 'fetch'),
+    (EnterpriseAPIClient, 'get_content_metadata', 'fetch'),
+    (EnterpriseReportSender, '_generate_enterprise_report', 'generate'),
+    (utils, '_get_compressed_file', 'compress'),
+    (utils, '_get_encrypted_file', 'encrypt'),
+    (SFTPDeliveryMethod, 'send', 'send'),
+    (SMTPDeliveryMethod, 'send', 'send'),
+]
+
+
+class StageTimer(object):
+    """
+    Accumulates the wall time spent in the `TIMED_FUNCTIONS` of each stage.
+
+    When a timed function returns a generator, the time spent producing each of its items is counted as well.
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+
+    def install(self):
+        """Replace each of the `TIMED_FUNCTIONS` with a timed wrapper."""
+        for owner, name, stage in TIMED_FUNCTIONS:
+            setattr(owner, name, self._wrap(owner.__dict__[name], stage))
+
+    def get_stage_seconds(self):
+        """Return the seconds spent in each of the `STAGES`."""
+        seconds = dict(self.seconds)
+        seconds['write'] = seconds.get('generate', 0) - seconds.get('fetch', 0)
+        seconds['deliver'] = seconds.get('send', 0) - seconds.get('compress', 0) - seconds.get('encrypt', 0)
+        return OrderedDict((stage, seconds.get(stage, 0)) for stage in STAGES)
+
+    def _wrap(self, function, stage):
+        def timed_function(*args, **kwargs):
+            start = time.time()
+            result = function(*args, **kwargs)
+            self.seconds[stage] += time.time() - start
+            if inspect.isgenerator(result):
+                return self._iterate(result, stage)
+            return result
+        return timed_function
+
+    def _iterate(self, iterator, stage):
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.seconds[stage] += time.time() - start
+                return
+            self.seconds[stage] += time.time() - start
+            yield item
+
+
+def get_reporting_config(enterprise_id, customer, report, sftp_server, pgp_key):
+    """
+    Return a reporting config for the `customer` sending the `report`, given as data_type:report_type:delivery.
+    """
+    data_type, report_type, delivery_method = report.split(':')
+    return {
+        'enterprise_customer': {'uuid': enterprise_id, 'name': 'Benchmark {} customer'.format(customer)},
+        'data_type': data_type,
+        'report_type': report_type,
+        'delivery_method': delivery_method,
+        'email': ['admin@example.com'],
+        'sftp_hostname': '127.0.0.1',
+        'sftp_port': sftp_server.port,
+        'sftp_username': sftp_server.username,
+        'sftp_file_path': '/{}_{}'.format(customer, report.replace(':', '_')),
+        'pgp_encryption_key': pgp_key,
+    }
+
+
+def send_report(reporting_config, password, row_count, api_url, directory):
+    """
+    Send one report with the stand-ins patched in, and return its stage timings, peak RSS and sizes.
+
+    This runs in a child process of its own, so nothing patched here needs to be restored.
+    """
+    EdxOAuth2APIClient.LMS_OAUTH_HOST = api_url
+    EnterpriseAPIClient.API_BASE_URL = api_url + '/enterprise/api/v1/'
+    EnterpriseDataApiClient.API_BASE_URL = api_url + '/enterprise/api/v0'
+    EnterpriseReportSender.FILE_WRITE_DIRECTORY = directory
+    SMTPDeliveryMethod.REPORT_EMAIL_FROM_EMAIL = 'reports@example.com'
+    utils.boto3.client = lambda *args, **kwargs: FakeSESClient()
+
+    timer = StageTimer()
+    timer.install()
+    vertica_client = VerticaClient()
+    vertica_client.connection = FakeVerticaConnection(
+        row_count,
+        enterprise_ids=(uuid.UUID(reporting_config['enterprise_customer']['uuid']).hex,),
+    )
+    if reporting_config['delivery_method'] == 'email':
+        delivery_method = SMTPDeliveryMethod(reporting_config, password)
+    else:
+        delivery_method = SFTPDeliveryMethod(reporting_config, password)
+    sender = EnterpriseReportSender(reporting_config, delivery_method, vertica_client)
+
+    start = time.time()
+    files = sender._generate_enterprise_report()  # pylint: disable=protected-access
+    sender.send_enterprise_report(files)
+    total = time.time() - start
+
+    result = timer.get_stage_seconds()
+    result['total'] = total
+    result['peak RSS MB'] = peak_rss_megabytes()
+    result['report MB'] = sum(os.path.getsize(report_file.name) for report_file in files) / 1024.0 / 1024.0
+    # The compressed and encrypted archive is written next to the report files.
+    result['archive MB'] = sum(
+        os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if name.endswith('.pgp')
+    ) / 1024.0 / 1024.0
+    return result
+
+
+def run_in_child_process(function, *args):
+    """
+    Run `function` in a fresh process and return its result.
+
+    The process is spawned rather than forked: a forked child inherits the peak RSS of the benchmark process,
+    which would then be reported as that of the report.
+    """
+    pool = multiprocessing.get_context('spawn').Pool(1)
+    try:
+        return pool.apply(function, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def print_customer_results(customer, row_count, item_count, results):
+    """Print a table of the results of each report sent for a customer."""
+    print('{} customer: {:,} enrollments, {:,} catalog items'.format(customer, row_count, item_count))
+    columns = list(next(iter(results.values())))
+    print('  {:<28}'.format('report') + ''.join('{:>12}'.format(column) for column in columns))
+    for report, result in results.items():
+        print('  {:<28}'.format(report) + ''.join('{:>12.3f}'.format(result[column]) for column in columns))
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', nargs='+', choices=list(CUSTOMER_SIZES), default=list(CUSTOMER_SIZES),
+                        help='Synthetic customers to send reports for.')
+    parser.add_argument('--reports', nargs='+', default=DEFAULT_REPORTS,
+                        help='Reports to send, as data_type:report_type:delivery_method.')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplier applied to the enrollments and catalog items of every customer.')
+    args = parser.parse_args()
+
+    pgp_key = str(create_pgp_key().pubkey)
+    sftp_root = tempfile.mkdtemp()
+    try:
+        with LocalEdxApiServer() as api_server, LocalSFTPServer(sftp_root) as sftp_server:
+            for customer in args.customers:
+                row_count, item_count = [max(int(count * args.scale), 1) for count in CUSTOMER_SIZES[customer]]
+                enterprise_id = str(uuid.uuid4())
+                api_server.add_enterprise(enterprise_id, row_count, item_count)
+                results = OrderedDict()
+                for report in args.reports:
+                    reporting_config = get_reporting_config(enterprise_id, customer, report, sftp_server, pgp_key)
+                    os.mkdir(os.path.join(sftp_root, reporting_config['sftp_file_path'].lstrip('/')))
+                    directory = tempfile.mkdtemp()
+                    try:
+                        results[report] = run_in_child_process(
+                            send_report, reporting_config, sftp_server.password, row_count, api_server.url, directory,
+                        )
+                    finally:
+                        shutil.rmtree(directory)
+                print_customer_results(customer, row_count, item_count, results)
+    finally:
+        shutil.rmtree(sftp_root)
+
+
+if __name__ == '__main__':
+    main()
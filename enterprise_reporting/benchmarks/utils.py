@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the enterprise reporting benchmarks.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import resource
+import time
+from contextlib import contextmanager
+
+
+def peak_rss_megabytes():
+    """
+    Return the peak resident set size of the current process in megabytes.
+    """
+    # ru_maxrss is reported in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+@contextmanager
+def timed(results, name):
+    """
+    Record the wall time spent in the block under `name` in the `results` dict.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        results[name] = time.time() - start
+
+
+def print_results(title, results, count=None, unit='rows'):
+    """
+    Print the timings in `results`, along with throughput when a `count` is given.
+    """
+    print(title)
+    for name, seconds in results.items():
+        line = '  {:<32} {:>10.3f}s'.format(name, seconds)
+        if count is not None and seconds:
+            line += '  {:>14,.0f} {}/s'.format(count / seconds, unit)
+        print(line)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark writing a Vertica result set to a progress report CSV, row by row versus in fetchmany batches.
+
+Usage:
+    python -m enterprise_reporting.benchmarks.vertica_stream --rows 10000000 --batch-size 10000
+"""
+from __future__ import absolute_import, unicode_literals
+
+import argparse
+import csv
+import datetime
+import os
+import tempfile
+from collections import OrderedDict
+from io import open  # pylint: disable=redefined-builtin
+
+from enterprise_reporting.benchmarks.fakes import FakeVerticaConnection
+from enterprise_reporting.benchmarks.utils import peak_rss_megabytes, print_results, timed
+from enterprise_reporting.clients.vertica import VerticaClient
+
+
+def stream_results_row_by_row(vertica_client, query):
+    """
+    The previous implementation of `VerticaClient.stream_results`, kept here as the baseline.
+    """
+    cursor = vertica_client.connection.cursor()
+    cursor.execute(query)
+    for row in cursor.iterate():
+        formatted_row = []
+        for value in row:
+            if isinstance(value, datetime.datetime):
+                formatted_row.append(value.strftime('%Y-%m-%d %H:%M:%S'))
+            else:
+                formatted_row.append(value)
+        yield formatted_row
+
+
+def write_row_by_row(vertica_client, file_path):
+    """Write the report the way it used to be written: one generated row at a time."""
+    with open(file_path, 'w') as report_file:
+        csv.writer(report_file).writerows(stream_results_row_by_row(vertica_client, 'SELECT'))
+
+
+def write_batched(vertica_client, file_path, batch_size):
+    """Write the report in blocks of `batch_size` rows."""
+    with open(file_path, 'w') as report_file:
+        writer = csv.writer(report_file)
+        for batch in vertica_client.stream_result_batches('SELECT', batch_size):
+            writer.writerows(batch)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000000, help='Number of synthetic rows in the result set.')
+    parser.add_argument('--batch-size', type=int, default=VerticaClient.FETCH_SIZE, help='Rows per fetchmany.')
+    args = parser.parse_args()
+
+    vertica_client = VerticaClient()
+    vertica_client.connection = FakeVerticaConnection(args.rows)
+    file_path = tempfile.NamedTemporaryFile(suffix='.csv', delete=False).name
+
+    results = OrderedDict()
+    try:
+        with timed(results, 'row by row (iterate)'):
+            write_row_by_row(vertica_client, file_path)
+        with timed(results, 'batched (fetchmany {})'.format(args.batch_size)):
+            write_batched(vertica_client, file_path, args.batch_size)
+    finally:
+        os.remove(file_path)
+
+    print_results('Vertica result set to CSV, {:,} rows'.format(args.rows), results, args.rows)
+    print('  peak RSS: {:.1f} MB'.format(peak_rss_megabytes()))
+
+
+if __name__ == '__main__':
+    main()
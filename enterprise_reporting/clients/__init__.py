@@ -6,12 +6,67 @@ Clients used to access third party systems.
 from __future__ import absolute_import, unicode_literals
 
 import os
+import threading
 from datetime import datetime
 from functools import wraps
+
+import requests
+from requests.adapters import HTTPAdapter
 from six.moves import urllib
 
 from edx_rest_api_client.client import EdxRestApiClient
 
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', default=10))
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', default=20))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', default=3))
+
+_SHARED_HTTP_ADAPTER = None
+_ACCESS_TOKEN_CACHE = {}
+_ACCESS_TOKEN_CACHE_LOCK = threading.Lock()
+
+
+def get_shared_http_adapter():
+    """
+    Return the process-wide HTTP adapter that holds the pool of keep-alive connections.
+
+    Every API client mounts this adapter on its session, so all clients created during a reporting run
+    reuse the same TLS connections to the LMS and the Data API instead of opening new ones per report.
+    """
+    global _SHARED_HTTP_ADAPTER  # pylint: disable=global-statement
+    if _SHARED_HTTP_ADAPTER is None:
+        _SHARED_HTTP_ADAPTER = HTTPAdapter(
+            pool_connections=HTTP_POOL_CONNECTIONS,
+            pool_maxsize=HTTP_POOL_MAXSIZE,
+            max_retries=HTTP_MAX_RETRIES,
+        )
+    return _SHARED_HTTP_ADAPTER
+
+
+def create_pooled_session():
+    """
+    Create a requests session backed by the shared connection pool.
+
+    Sessions are cheap and carry per-client state such as the auth header, so each client gets its own;
+    the expensive part, the connection pool, lives in the shared adapter.
+    """
+    session = requests.Session()
+    adapter = get_shared_http_adapter()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def reset_shared_http_state():
+    """
+    Close pooled connections and forget cached access tokens.
+    """
+    global _SHARED_HTTP_ADAPTER  # pylint: disable=global-statement
+    if _SHARED_HTTP_ADAPTER is not None:
+        _SHARED_HTTP_ADAPTER.close()
+        _SHARED_HTTP_ADAPTER = None
+    with _ACCESS_TOKEN_CACHE_LOCK:
+        _ACCESS_TOKEN_CACHE.clear()
+
 
 class EdxOAuth2APIClient(object):
     """
@@ -37,18 +92,34 @@ class EdxOAuth2APIClient(object):
     def connect(self):
         """
         Connect to the REST API, authenticating with an access token retrieved with our client credentials.
+
+        The access token is shared by every client using the same credentials until it expires, and the
+        underlying connections come from the process-wide pool.
         """
-        access_token, expires_at = EdxRestApiClient.get_oauth_access_token(
-            self.LMS_OAUTH_HOST + '/oauth2/access_token',
-            self.client_id,
-            self.client_secret,
-            'jwt'
-        )
+        access_token, expires_at = self.get_access_token()
         self.client = EdxRestApiClient(
-            self.API_BASE_URL, append_slash=self.APPEND_SLASH, jwt=access_token,
+            self.API_BASE_URL, append_slash=self.APPEND_SLASH, jwt=access_token, session=create_pooled_session(),
         )
         self.expires_at = expires_at
 
+    def get_access_token(self):
+        """
+        Return a cached (access_token, expires_at) pair, fetching a new JWT only when the cached one has expired.
+        """
+        oauth_url = self.LMS_OAUTH_HOST + '/oauth2/access_token'
+        cache_key = (oauth_url, self.client_id)
+        with _ACCESS_TOKEN_CACHE_LOCK:
+            cached_token = _ACCESS_TOKEN_CACHE.get(cache_key)
+            if cached_token is None or datetime.utcnow() > cached_token[1]:
+                cached_token = EdxRestApiClient.get_oauth_access_token(
+                    oauth_url,
+                    self.client_id,
+                    self.client_secret,
+                    'jwt'
+                )
+                _ACCESS_TOKEN_CACHE[cache_key] = cached_token
+        return cached_token
+
     def token_expired(self):
         """
         Return True if the JWT token has expired, False if not.
@@ -96,9 +167,7 @@ class EdxOAuth2APIClient(object):
         default_val = default if default is not self.DEFAULT_VALUE_SAFEGUARD else {}
         querystring = querystring or {}
 
-        endpoint = getattr(self.client, resource)
-        endpoint = getattr(self.client, resource)(resource_id) if resource_id else endpoint
-        endpoint = getattr(endpoint, detail_resource) if detail_resource else endpoint
+        endpoint = self._get_endpoint(resource, detail_resource, resource_id)
         response = endpoint.get(**querystring)
         if should_traverse_pagination:
             results = traverse_pagination(response, endpoint)
@@ -111,6 +180,34 @@ class EdxOAuth2APIClient(object):
 
         return response or default_val
 
+    def _stream_data(self, resource, detail_resource=None, resource_id=None, querystring=None):
+        """
+        Lazily iterates over the results of a paginated response from one of the API endpoints.
+
+        Unlike `_load_data` with `should_traverse_pagination`, only one page of results is held at a time.
+
+        Arguments:
+            resource: The endpoint resource name.
+            detail_resource: The sub-resource to append to the path.
+            resource_id: The resource ID for the specific detail to get from the endpoint.
+            querystring: Optional query string parameters.
+
+        Returns
+            (generator): Each result dict, in the order returned by the API.
+        """
+        endpoint = self._get_endpoint(resource, detail_resource, resource_id)
+        response = endpoint.get(**(querystring or {}))
+        return iterate_pagination(response or {}, endpoint)
+
+    def _get_endpoint(self, resource, detail_resource=None, resource_id=None):
+        """
+        Build the slumber resource for an API endpoint.
+        """
+        endpoint = getattr(self.client, resource)
+        endpoint = getattr(self.client, resource)(resource_id) if resource_id else endpoint
+        endpoint = getattr(endpoint, detail_resource) if detail_resource else endpoint
+        return endpoint
+
 
 def traverse_pagination(response, endpoint):
     """
@@ -127,13 +224,31 @@ def traverse_pagination(response, endpoint):
         list of dict.
 
     """
-    results = response.get('results', [])
+    return list(iterate_pagination(response, endpoint))
+
+
+def iterate_pagination(response, endpoint):
+    """
+    Lazily traverse a paginated API response.
+
+    Yields the "results" (dict) returned by DRF-powered APIs one at a time, requesting the next page
+    only once the current one has been consumed.
+
+    Arguments:
+        response (Dict): Current response dict from service API
+        endpoint (slumber Resource object): slumber Resource object from edx-rest-api-client
+
+    Yields:
+        dict
+
+    """
+    for result in response.get('results', []):
+        yield result
 
     next_page = response.get('next')
     while next_page:
         querystring = urllib.parse.parse_qs(urllib.parse.urlparse(next_page).query, True)
         response = endpoint.get(**querystring)
-        results += response.get('results', [])
+        for result in response.get('results', []):
+            yield result
         next_page = response.get('next')
-
-    return results
@@ -5,10 +5,133 @@ Client for connecting to the LMS Enterprise endpoints.
 
 from __future__ import absolute_import, unicode_literals
 
+import hashlib
+import json
 import os
-from collections import OrderedDict
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from enterprise_reporting.clients import EdxOAuth2APIClient
+from enterprise_reporting.utils import DedupSpillStore
+
+CATALOG_FETCH_WORKERS = int(os.getenv('CATALOG_FETCH_WORKERS', default=4))
+CATALOG_CACHE_DIRECTORY = os.getenv('CATALOG_CACHE_DIRECTORY', default='')
+# Items can change without their catalog's `modified` timestamp changing, so catalogs cached on disk are fetched
+# again once they are this old, and removed at the end of a run.
+CATALOG_CACHE_MAX_AGE = int(os.getenv('CATALOG_CACHE_MAX_AGE', default=24 * 60 * 60))
+
+
+class CatalogContentCache(object):
+    """
+    Content metadata of enterprise catalogs, shared by every catalog report of a run.
+
+    Entries are keyed by catalog uuid and, when the LMS provides it, the catalog's `modified` timestamp.
+    Catalogs are only kept on disk, as files of one JSON item per line, so they are written as their pages are
+    fetched and read back an item at a time, and never held in memory as a whole. If a `directory` is given,
+    catalogs with a known `modified` timestamp are stored there, so later runs reuse them until the catalog
+    changes or the entry is older than `max_age` seconds; other catalogs are stored in a temporary directory that
+    `clear` removes. Only the latest entry of each catalog is kept, and `clear` also removes expired entries.
+    """
+
+    def __init__(self, directory=None, max_age=None):
+        self.directory = CATALOG_CACHE_DIRECTORY if directory is None else directory
+        self.max_age = CATALOG_CACHE_MAX_AGE if max_age is None else max_age
+        self._run_directory = None
+        self._lock = threading.Lock()
+        self._catalog_locks = {}
+
+    def get_items(self, catalog_uuid, modified, fetch_items):
+        """
+        Return an iterator over the items of a catalog, calling `fetch_items()` for them if it is not cached.
+
+        A thread that needs a catalog another thread is already fetching waits for it instead of fetching the
+        catalog again.
+        """
+        with self._lock:
+            catalog_lock = self._catalog_locks.setdefault(catalog_uuid, threading.Lock())
+        with catalog_lock:
+            path = self._get_path(catalog_uuid, modified)
+            if not os.path.exists(path) or self._is_expired(path):
+                temporary_path = '{}.{}.tmp'.format(path, threading.get_ident())
+                try:
+                    with open(temporary_path, 'w') as catalog_file:
+                        for item in fetch_items():
+                            catalog_file.write(json.dumps(item))
+                            catalog_file.write('\n')
+                except Exception:
+                    os.remove(temporary_path)
+                    raise
+                os.replace(temporary_path, path)
+                self._remove_other_entries(path)
+            # The file is opened while the catalog is locked, so that a newer entry can't remove it before it is read.
+            return self._read_items(open(path))
+
+    def clear(self):
+        """
+        Remove the catalogs cached for this run only, and the expired catalogs cached for later runs.
+        """
+        with self._lock:
+            if self._run_directory is not None:
+                shutil.rmtree(self._run_directory, ignore_errors=True)
+            self._run_directory = None
+            self._catalog_locks.clear()
+        if self.directory and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.startswith('catalog_') and self._is_expired(path):
+                    self._remove(path)
+
+    @staticmethod
+    def _read_items(catalog_file):
+        """Lazily read back the items of a cached catalog from its open file."""
+        with catalog_file:
+            for line in catalog_file:
+                yield json.loads(line)
+
+    def _get_path(self, catalog_uuid, modified):
+        """Return the path of the file a catalog is stored in on disk."""
+        directory = self.directory if self.directory and modified else self._get_run_directory()
+        return os.path.join(directory, 'catalog_{}_{}.jsonl'.format(
+            hashlib.sha1(catalog_uuid.encode('utf-8')).hexdigest(),
+            hashlib.sha1('{}'.format(modified).encode('utf-8')).hexdigest(),
+        ))
+
+    def _remove_other_entries(self, path):
+        """Remove the entries of the catalog at other `modified` timestamps than the one at `path`."""
+        directory, name = os.path.split(path)
+        prefix = name[:name.rindex('_') + 1]
+        for other_name in os.listdir(directory):
+            if other_name.startswith(prefix) and other_name.endswith('.jsonl') and other_name != name:
+                self._remove(os.path.join(directory, other_name))
+
+    def _is_expired(self, path):
+        """Return whether the cached file is older than `max_age`."""
+        try:
+            return time.time() - os.path.getmtime(path) >= self.max_age
+        except OSError:
+            return False
+
+    @staticmethod
+    def _remove(path):
+        """Remove a cached file, unless another process already did."""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _get_run_directory(self):
+        """Return the temporary directory of the catalogs cached for this run, creating it if needed."""
+        with self._lock:
+            if self._run_directory is None:
+                self._run_directory = tempfile.mkdtemp(prefix='enterprise_reporting_catalogs_')
+            return self._run_directory
+
+
+CATALOG_CONTENT_CACHE = CatalogContentCache()
 
 
 class EnterpriseAPIClient(EdxOAuth2APIClient):
@@ -49,8 +172,11 @@ class EnterpriseAPIClient(EdxOAuth2APIClient):
 
     @EdxOAuth2APIClient.refresh_token
     def get_content_metadata(self, enterprise_customer_uuid, reporting_config):
-        """Return all content metadata contained in the catalogs associated with an Enterprise Customer."""
-        content_metadata = OrderedDict()
+        """
+        Return all content metadata contained in the catalogs associated with an Enterprise Customer.
+
+        The metadata is returned as a `DedupSpillStore`, to be iterated over and closed by the caller.
+        """
 
         enterprise_customer_catalogs = extract_catalog_uuids_from_reporting_config(reporting_config)
         if not enterprise_customer_catalogs.get('results'):
@@ -62,21 +188,49 @@ class EnterpriseAPIClient(EdxOAuth2APIClient):
                     'page_size': self.PAGE_SIZE,
                 },
             )
-        for catalog in enterprise_customer_catalogs.get('results', []):
-            catalog_content = self._load_data(
+        catalogs = enterprise_customer_catalogs.get('results', [])
+        # It's possible that there are duplicate items.
+        # Filter them out by adding common items under their common identifier, in a store kept on disk
+        # so that the metadata of large catalogs does not all have to fit in memory.
+        content_metadata = DedupSpillStore()
+        # Catalogs are fetched concurrently, a page at a time, into the on-disk catalog cache, then merged in their
+        # original order, so the result is the same as if they had been fetched one after the other.
+        # No more catalogs are fetched ahead than there are workers, to bound the disk used for catalogs
+        # waiting to be merged.
+        workers = max(min(CATALOG_FETCH_WORKERS, len(catalogs)), 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending_catalogs = deque()
+            for catalog in catalogs:
+                if len(pending_catalogs) == workers:
+                    content_metadata.add_items(pending_catalogs.popleft().result(), get_content_metadata_item_key)
+                pending_catalogs.append(executor.submit(self._get_catalog_content, catalog))
+            for pending_catalog in pending_catalogs:
+                content_metadata.add_items(pending_catalog.result(), get_content_metadata_item_key)
+        return content_metadata
+
+    def _get_catalog_content(self, catalog):
+        """
+        Return an iterator over the content metadata of a single enterprise customer catalog.
+
+        The catalog is fetched into `CATALOG_CONTENT_CACHE` a page at a time, unless it is already cached there,
+        so catalogs shared by several enterprises are only fetched once per run.
+        """
+        return CATALOG_CONTENT_CACHE.get_items(
+            catalog['uuid'],
+            catalog.get('modified'),
+            lambda: self._stream_data(
                 self.ENTERPRISE_CUSTOMER_CATALOGS_ENDPOINT,
                 resource_id=catalog['uuid'],
-                should_traverse_pagination=True,
                 querystring={'page_size': self.PAGE_SIZE},
-            )
-            # It's possible that there are duplicate items.
-            # Filter them out by assigning common items to their common identifier in a dictionary.
-            for item in catalog_content['results']:
-                key = 'uuid' if item['content_type'] == 'program' else 'key'
-                content_metadata[item[key]] = item
+            ),
+        )
+
 
-        # We only made this a dictionary to help filter out duplicates by a common key. We just want values now.
-        return content_metadata.values()
+def get_content_metadata_item_key(item):
+    """
+    Return the identifier that duplicates of a content metadata item have in common.
+    """
+    return item['uuid'] if item['content_type'] == 'program' else item['key']
 
 
 def extract_catalog_uuids_from_reporting_config(reporting_config):
@@ -87,7 +241,7 @@ def extract_catalog_uuids_from_reporting_config(reporting_config):
     dicts containing a key-value pair of 'uuid' and some uuid
     """
     enterprise_customer_catalogs = {'results': [
-        {'uuid': catalog['uuid']}
+        {key: catalog[key] for key in ('uuid', 'modified') if key in catalog}
         for catalog in reporting_config.get('enterprise_customer_catalogs', [])
         ]
     }
@@ -106,6 +260,9 @@ class EnterpriseDataApiClient(EdxOAuth2APIClient):
 
     @EdxOAuth2APIClient.refresh_token
     def get_enterprise_enrollments(self, enterprise_customer_uuid):
+        """
+        Return all enrollments of an Enterprise Customer.
+        """
         return self._load_data(
             'enterprise',
             resource_id=enterprise_customer_uuid,
@@ -113,3 +270,29 @@ class EnterpriseDataApiClient(EdxOAuth2APIClient):
             should_traverse_pagination=True,
             querystring={'page_size': self.PAGE_SIZE},
         )
+
+    @EdxOAuth2APIClient.refresh_token
+    def get_enterprise_enrollments_summary(self, enterprise_customer_uuid):
+        """
+        Return the number of enrollments of an Enterprise Customer and the latest `created` time among them.
+        """
+        response = self._load_data(
+            'enterprise',
+            resource_id=enterprise_customer_uuid,
+            detail_resource='enrollments',
+            querystring={'page_size': 1, 'ordering': '-created'},
+        )
+        results = response.get('results') or [{}]
+        return response.get('count', 0), results[0].get('created')
+
+    @EdxOAuth2APIClient.refresh_token
+    def iterate_enterprise_enrollments(self, enterprise_customer_uuid):
+        """
+        Lazily iterate over all enrollments of an Enterprise Customer, one page of results at a time.
+        """
+        return self._stream_data(
+            'enterprise',
+            resource_id=enterprise_customer_uuid,
+            detail_resource='enrollments',
+            querystring={'page_size': self.PAGE_SIZE},
+        )
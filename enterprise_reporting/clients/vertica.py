@@ -18,6 +18,8 @@ class VerticaClient(object):
     Client for connecting to Vertica.
     """
 
+    FETCH_SIZE = int(os.environ.get('VERTICA_FETCH_SIZE', 10000))
+
     def __init__(self, host=None, username=None, password=None):
         """
         Instantiate a new client using the Django settings to determine the vertica credentials.
@@ -45,25 +47,77 @@ class VerticaClient(object):
         self.connection.close()
         self.connection = None
 
-    def stream_results(self, query):
+    @property
+    def is_connected(self):
         """
-        Streams the results for a query using the current connection.
+        Return True if a connection to Vertica is currently open.
         """
-        cursor = self.connection.cursor()
-        cursor.execute(query)
+        return self.connection is not None
+
+    def stream_raw_results(self, query, parameters=None):
+        """
+        Streams the results for a query using the current connection, leaving values as returned by the driver.
+        """
+        cursor = self._execute(query, parameters)
         for row in cursor.iterate():
-            formatted_row = []
-            for value in row:
-                if isinstance(value, datetime.datetime):
-                    formatted_row.append(value.strftime('%Y-%m-%d %H:%M:%S'))
-                else:
-                    formatted_row.append(value)
-            yield formatted_row
+            yield row
+
+    def stream_results(self, query, parameters=None):
+        """
+        Streams the results for a query using the current connection.
+        """
+        for batch in self.stream_result_batches(query, parameters=parameters):
+            for row in batch:
+                yield row
+
+    def stream_result_batches(self, query, batch_size=None, parameters=None):
+        """
+        Streams the results for a query using the current connection, in lists of up to `batch_size` rows.
 
-    def fetch_results(self, query):
+        Rows are fetched with `fetchmany` and datetimes are formatted a column at a time, only for the columns
+        of the batch that actually contain datetimes, so a whole batch can be handed to `csv.writer.writerows`.
+        """
+        batch_size = batch_size or self.FETCH_SIZE
+        cursor = self._execute(query, parameters)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield format_datetime_columns(rows)
+
+    def fetch_results(self, query, parameters=None):
         """
         Fetches all of the results for a query using the current connection.
         """
+        return self._execute(query, parameters).fetchall()
+
+    def _execute(self, query, parameters=None):
+        """
+        Execute a query on a new cursor of the current connection and return the cursor.
+
+        `parameters` are bound to the query's placeholders (`:name` for a dict, `%s` for a sequence) by the
+        driver, which quotes and escapes them. vertica-python binds them on the client side, so Vertica still
+        receives and plans a separate statement for each set of values.
+        """
         cursor = self.connection.cursor()
-        cursor.execute(query)
-        return cursor.fetchall()
+        if parameters is None:
+            cursor.execute(query)
+        else:
+            cursor.execute(query, parameters)
+        return cursor
+
+
+def format_datetime_columns(rows):
+    """
+    Format every datetime in a batch of rows as 'YYYY-MM-DD HH:MM:SS', returning the batch as a list of tuples.
+
+    The batch is transposed so the type check happens once per column instead of once per cell.
+    """
+    columns = list(zip(*rows))
+    for index, column in enumerate(columns):
+        if any(issubclass(value_type, datetime.datetime) for value_type in set(map(type, column))):
+            columns[index] = [
+                value.isoformat(' ')[:19] if isinstance(value, datetime.datetime) else value
+                for value in column
+            ]
+    return list(zip(*columns))
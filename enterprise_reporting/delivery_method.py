@@ -5,16 +5,36 @@ Classes that handle sending reports for enterprise customers with specific deliv
 
 from __future__ import absolute_import, unicode_literals
 
+import hashlib
+import json
 import logging
 import os
+import shutil
+import socket
+import time
 from smtplib import SMTPException
 
 import paramiko
 
-from enterprise_reporting.utils import compress_and_encrypt, send_email_with_attachment
+from enterprise_reporting.utils import (
+    COMPRESSION_LEVEL,
+    COMPRESSION_WORKERS,
+    compress_and_encrypt,
+    send_email_with_attachment,
+)
 
 LOGGER = logging.getLogger(__name__)
 
+SFTP_WINDOW_SIZE = int(os.environ.get('SFTP_WINDOW_SIZE', 16 * 1024 * 1024))
+SFTP_MAX_PACKET_SIZE = int(os.environ.get('SFTP_MAX_PACKET_SIZE', 32 * 1024))
+SFTP_UPLOAD_RETRIES = int(os.environ.get('SFTP_UPLOAD_RETRIES', 3))
+SFTP_UPLOAD_CHUNK_SIZE = 1024 * 1024
+SFTP_PROGRESS_LOG_INTERVAL = int(os.environ.get('SFTP_PROGRESS_LOG_INTERVAL', 30))
+SFTP_PENDING_UPLOAD_DIRECTORY = os.environ.get(
+    'SFTP_PENDING_UPLOAD_DIRECTORY',
+    '/tmp/enterprise_reporting_pending_uploads'
+)
+
 
 class DeliveryMethod(object):
     """
@@ -28,11 +48,20 @@ class DeliveryMethod(object):
         self.report_type = reporting_config['report_type']
         self.password = password
         self.pgp_encryption_key = reporting_config.get('pgp_encryption_key')
+        # Reporting configurations have no compression settings, so every report uses the environment's.
+        self.compression_level = COMPRESSION_LEVEL
+        self.compression_workers = COMPRESSION_WORKERS
 
     def send(self, files):
         """Base method for sending files, to perform common sending logic."""
         LOGGER.info('Encrypting data report for {}'.format(self.enterprise_customer_name))
-        return compress_and_encrypt(files, self.password, self.pgp_encryption_key)
+        return compress_and_encrypt(
+            files,
+            self.password,
+            self.pgp_encryption_key,
+            compression_level=self.compression_level,
+            workers=self.compression_workers,
+        )
 
 
 class SMTPDeliveryMethod(DeliveryMethod):
@@ -41,6 +70,8 @@ class SMTPDeliveryMethod(DeliveryMethod):
     """
 
     REPORT_EMAIL_FROM_EMAIL = os.environ.get('SEND_EMAIL_FROM')
+    # Whether recipients of the same report may share a single email instead of each getting their own.
+    REPORT_EMAIL_BATCH_RECIPIENTS = os.environ.get('REPORT_EMAIL_BATCH_RECIPIENTS', '').lower() == 'true'
     REPORT_EMAIL_SUBJECT = '{enterprise_name} edX Learner Data'
     REPORT_EMAIL_BODY = """
     Please find the attached {type} data for courses on edX.
@@ -73,7 +104,8 @@ class SMTPDeliveryMethod(DeliveryMethod):
                 self.REPORT_EMAIL_BODY.format(type=self.data_type),
                 self.REPORT_EMAIL_FROM_EMAIL,
                 self.email,
-                data_report_zipped
+                data_report_zipped,
+                batch_recipients=self.REPORT_EMAIL_BATCH_RECIPIENTS,
             )
         except SMTPException:
             LOGGER.exception('Failed to send email report to {} for {}'.format(
@@ -101,25 +133,281 @@ class SFTPDeliveryMethod(DeliveryMethod):
         self.file_path = reporting_config['sftp_file_path']
 
     def send(self, files):
-        """Send the given files in zip format through SFTP."""
-        data_report_zipped = super().send(files)
-        LOGGER.info('Connecting via SFTP to remote host {} for {}'.format(
-            self.hostname,
-            self.enterprise_customer_name
+        """
+        Send the given files in zip format through SFTP.
+
+        The archive is uploaded to "<name>.part" and renamed into place once complete. An upload that fails
+        is retried from the end of the partial file, up to SFTP_UPLOAD_RETRIES times. When the retries run
+        out, the archive is kept in SFTP_PENDING_UPLOAD_DIRECTORY, and the next delivery of the same report
+        files resumes uploading it rather than compressing and encrypting the files into a new archive,
+        whose content would differ because of its random keys.
+        """
+        data_report_zipped, stale_partial_path = self._get_pending_archive(files)
+        resume = data_report_zipped is not None
+        if not resume:
+            data_report_zipped = super().send(files)
+        remote_path = os.path.join(self.file_path, os.path.basename(data_report_zipped))
+        partial_path = '{}.part'.format(remote_path)
+        file_size = os.path.getsize(data_report_zipped)
+
+        start = time.time()
+        bytes_sent = 0
+        attempt = 0
+        while True:
+            LOGGER.info('Connecting via SFTP to remote host {} for {}'.format(
+                self.hostname,
+                self.enterprise_customer_name
+            ))
+            try:
+                sftp = SFTP_SESSION_POOL.get_sftp_client(self.hostname, self.port, self.username, self.password)
+                if stale_partial_path not in (None, partial_path):
+                    self._remove(sftp, stale_partial_path)
+                stale_partial_path = None
+                bytes_sent += self._upload(sftp, data_report_zipped, partial_path, file_size, resume)
+                self._rename(sftp, partial_path, remote_path)
+                break
+            except (IOError, EOFError, socket.error, paramiko.SSHException):
+                # Don't hand a connection in an unknown state to the next attempt or report.
+                SFTP_SESSION_POOL.discard(self.hostname, self.port, self.username, self.password)
+                resume = True
+                attempt += 1
+                if attempt > SFTP_UPLOAD_RETRIES:
+                    self._save_pending_archive(files, data_report_zipped, partial_path)
+                    raise
+                LOGGER.warning('SFTP upload failed for {}, resuming it (retry {} of {})'.format(
+                    self.enterprise_customer_name,
+                    attempt,
+                    SFTP_UPLOAD_RETRIES,
+                ), exc_info=True)
+        shutil.rmtree(self.pending_upload_directory, ignore_errors=True)
+
+        elapsed = max(time.time() - start, 1e-6)
+        LOGGER.info('Successfully sent report via sftp for {}: {} of {} bytes sent in {:.2f}s ({:.2f} MB/s)'.format(
+            self.enterprise_customer_name,
+            bytes_sent,
+            file_size,
+            elapsed,
+            bytes_sent / elapsed / 1024 / 1024,
         ))
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(
-            hostname=self.hostname,
-            port=self.port,
-            username=self.username,
-            password=self.password,
+
+    @property
+    def pending_upload_directory(self):
+        """Get the local directory an archive whose upload failed is kept in, one per report and destination."""
+        key = '{}:{}:{}:{}:{}:{}:{}'.format(
+            self.hostname,
+            self.port,
+            self.username,
+            self.file_path,
+            self.enterprise_customer_name,
+            self.data_type,
+            self.report_type,
         )
-        sftp = ssh.open_sftp()
-        sftp.put(
-            data_report_zipped,
-            os.path.join(self.file_path, os.path.basename(data_report_zipped))
+        return os.path.join(SFTP_PENDING_UPLOAD_DIRECTORY, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _get_source_fingerprint(self, files):
+        """
+        Get a hash of the report files and of the settings they are compressed and encrypted with.
+
+        The names of the files are hashed too, so an archive kept from an earlier day's run, whose name and
+        entries carry that day's date, is not delivered by a later run with the same data.
+        """
+        fingerprint = hashlib.sha1('{}:{}:{}'.format(
+            self.password,
+            self.pgp_encryption_key,
+            self.compression_level,
+        ).encode('utf-8'))
+        for report_file in files:
+            fingerprint.update('{}\n'.format(os.path.basename(report_file.name)).encode('utf-8'))
+            with open(report_file.name, 'rb') as source_file:
+                for chunk in iter(lambda: source_file.read(SFTP_UPLOAD_CHUNK_SIZE), b''):
+                    fingerprint.update(chunk)
+        return fingerprint.hexdigest()
+
+    def _get_pending_archive(self, files):
+        """
+        Return the archive kept from a failed upload of the same report files, if any, and None.
+
+        If the kept archive is for other files, it is discarded and (None, the path of its partial upload)
+        is returned, so the stale partial file can be removed from the server.
+        """
+        try:
+            with open(os.path.join(self.pending_upload_directory, 'pending.json')) as pending_file:
+                pending_upload = json.load(pending_file)
+        except (IOError, ValueError):
+            return None, None
+        archive = os.path.join(self.pending_upload_directory, pending_upload['archive_name'])
+        if os.path.exists(archive) and pending_upload['source_fingerprint'] == self._get_source_fingerprint(files):
+            LOGGER.info('Resuming the upload of {}, kept from a failed delivery for {}'.format(
+                pending_upload['archive_name'],
+                self.enterprise_customer_name,
+            ))
+            return archive, None
+        LOGGER.info('Discarding {}, kept from a failed delivery for {}, as the report files have changed'.format(
+            pending_upload['archive_name'],
+            self.enterprise_customer_name,
+        ))
+        shutil.rmtree(self.pending_upload_directory, ignore_errors=True)
+        return None, pending_upload['partial_path']
+
+    def _save_pending_archive(self, files, archive, partial_path):
+        """Keep an archive whose upload failed, for the next delivery of the same report files to resume."""
+        directory = self.pending_upload_directory
+        kept_archive = os.path.join(directory, os.path.basename(archive))
+        if archive != kept_archive:
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+            shutil.move(archive, kept_archive)
+        with open(os.path.join(directory, 'pending.json'), 'w') as pending_file:
+            json.dump({
+                'archive_name': os.path.basename(archive),
+                'partial_path': partial_path,
+                'source_fingerprint': self._get_source_fingerprint(files),
+            }, pending_file)
+        LOGGER.warning('Kept the archive for {} in {} to resume its upload on the next delivery'.format(
+            self.enterprise_customer_name,
+            directory,
+        ))
+
+    def _upload(self, sftp, local_path, partial_path, file_size, resume=False):
+        """
+        Upload a file to `partial_path`, replacing any file there unless `resume` is set, in which case the
+        upload continues from the end of the partial file.
+
+        Returns the number of bytes sent.
+        """
+        offset = 0
+        if resume:
+            try:
+                offset = sftp.stat(partial_path).st_size
+            except IOError:
+                offset = 0
+        if offset > file_size:
+            offset = 0
+        if offset:
+            LOGGER.info('Resuming upload for {} at byte {} of {}'.format(
+                self.enterprise_customer_name,
+                offset,
+                file_size,
+            ))
+
+        start = last_logged = time.time()
+        bytes_sent = 0
+        with open(local_path, 'rb') as local_file, sftp.open(partial_path, 'r+b' if offset else 'wb') as remote_file:
+            local_file.seek(offset)
+            remote_file.seek(offset)
+            # Send writes without waiting for each one to be acknowledged.
+            remote_file.set_pipelined(True)
+            for chunk in iter(lambda: local_file.read(SFTP_UPLOAD_CHUNK_SIZE), b''):
+                remote_file.write(chunk)
+                bytes_sent += len(chunk)
+                if time.time() - last_logged >= SFTP_PROGRESS_LOG_INTERVAL:
+                    last_logged = time.time()
+                    LOGGER.info('Uploaded {:.1%} of the report for {} ({:.2f} MB/s)'.format(
+                        (offset + bytes_sent) / float(file_size),
+                        self.enterprise_customer_name,
+                        bytes_sent / (last_logged - start) / 1024 / 1024,
+                    ))
+
+        uploaded_size = sftp.stat(partial_path).st_size
+        if uploaded_size != file_size:
+            raise IOError('Size mismatch in upload: {} != {}'.format(uploaded_size, file_size))
+        return bytes_sent
+
+    @staticmethod
+    def _remove(sftp, remote_path):
+        """Remove a file from the server, if it is there."""
+        try:
+            sftp.remove(remote_path)
+        except IOError:
+            pass
+
+    @classmethod
+    def _rename(cls, sftp, partial_path, remote_path):
+        """
+        Move a completed upload to its final name, atomically if the server supports it.
+        """
+        try:
+            sftp.posix_rename(partial_path, remote_path)
+        except IOError:
+            # Not every server supports the posix-rename extension, and a plain rename refuses to overwrite.
+            cls._remove(sftp, remote_path)
+            sftp.rename(partial_path, remote_path)
+
+
+class SFTPSessionPool(object):
+    """
+    Keeps one authenticated SFTP session open per (hostname, port, username, password) for the duration of a run.
+
+    Many customers deliver to the same few hosts, so reusing the SSH transport saves a TCP and SSH handshake
+    plus authentication for every report. Sessions use a larger window than paramiko's default so that
+    pipelined uploads are not throttled by flow control.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+
+    def get_sftp_client(self, hostname, port, username, password):
+        """
+        Return an open SFTP client for the given host and credentials, connecting only if there is no live session.
+        """
+        key = self._get_key(hostname, port, username, password)
+        session = self._sessions.get(key)
+        if session is not None and session[0].is_active():
+            LOGGER.debug('Reusing the SFTP session to {}:{} as {}'.format(hostname, port, username))
+            return session[1]
+        self._discard(key)
+
+        # Like the AutoAddPolicy previously used with SSHClient, the host key is not verified.
+        transport = paramiko.Transport(
+            (hostname, port),
+            default_window_size=SFTP_WINDOW_SIZE,
+            default_max_packet_size=SFTP_MAX_PACKET_SIZE,
         )
-        sftp.close()
-        ssh.close()
-        LOGGER.info('Successfully sent report via sftp for {}'.format(self.enterprise_customer_name))
+        try:
+            transport.connect(username=username, password=password)
+            sftp = paramiko.SFTPClient.from_transport(
+                transport,
+                window_size=SFTP_WINDOW_SIZE,
+                max_packet_size=SFTP_MAX_PACKET_SIZE,
+            )
+        except Exception:
+            transport.close()
+            raise
+        self._sessions[key] = (transport, sftp)
+        return sftp
+
+    def discard(self, hostname, port, username, password):
+        """
+        Close and forget the session for the given host and credentials, if any.
+        """
+        self._discard(self._get_key(hostname, port, username, password))
+
+    def close_all(self):
+        """
+        Close every open session.
+        """
+        for key in list(self._sessions):
+            self._discard(key)
+
+    @staticmethod
+    def _get_key(hostname, port, username, password):
+        """
+        Get the key of the session for the given host and credentials.
+
+        The password is part of the key, so a customer with a different or rotated password authenticates a
+        session of its own instead of reusing one opened with another password. Only its hash is kept.
+        """
+        password = password if isinstance(password, bytes) else '{}'.format(password).encode('utf-8')
+        return (hostname, port, username, hashlib.sha1(password).hexdigest())
+
+    def _discard(self, key):
+        session = self._sessions.pop(key, None)
+        if session is not None:
+            transport, sftp = session
+            try:
+                sftp.close()
+            finally:
+                transport.close()
+
+
+SFTP_SESSION_POOL = SFTPSessionPool()
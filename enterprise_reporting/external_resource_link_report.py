@@ -4,11 +4,18 @@ External Resource Link Report Generation Code.
 """
 from __future__ import absolute_import, unicode_literals
 
+import csv
+import hashlib
+import io
+import json
 import logging
+import multiprocessing
 import os
 import re
 import sys
+from collections import deque
 from datetime import date
+from itertools import islice
 
 from py2neo import Graph
 
@@ -17,6 +24,124 @@ from enterprise_reporting.utils import send_email_with_attachment
 logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger(__name__)
 
+LINK_EXTRACTION_WORKERS = int(os.environ.get('LINK_EXTRACTION_WORKERS', os.cpu_count() or 1))
+LINK_EXTRACTION_CHUNK_SIZE = int(os.environ.get('LINK_EXTRACTION_CHUNK_SIZE', 20))
+COURSEGRAPH_USE_APOC = os.environ.get('COURSEGRAPH_USE_APOC', '').lower() in ('1', 'true', 'yes')
+LINK_REPORT_STATE_PATH = os.environ.get(
+    'LINK_REPORT_STATE_PATH',
+    '/tmp/external_resource_link_report_state.json'
+)
+
+# A link runs from http(s):// up to the first '"', ' ' or '<' on the same line. Links to edx.org and to
+# images (ending in .png", .jpg", .jpeg" or .gif", in any case) are matched by the first two alternatives,
+# which leave the second group empty, so only external links end up in it, along with their terminator.
+EXTERNAL_LINK_PATTERN = re.compile(
+    r'(https?)://(?:'
+    r'[^" <\n]*\.edx\.org[^" <\n]*[" <]'
+    r'|[^" <\n]*\.(?:[pP][nN][gG]|[jJ][pP][eE]?[gG]|[gG][iI][fF])"'
+    r'|([^" <\n]*[" <]))'
+)
+
+
+# The location and last edit of each html block the report reads, which tell whether a course changed.
+COURSEGRAPH_VERSIONS_QUERY = '''MATCH
+                (c:course)-[:PARENT_OF*]->(h:html)
+              WHERE
+                h.course_key STARTS WITH 'course-' AND
+                h.data =~ '.*https?://.*'
+              RETURN
+                c.display_name as course_title,
+                c.org as organization,
+                h.course_key as course_key,
+                collect([h.location, h.edited_on]) as block_versions'''
+
+COURSEGRAPH_QUERY = '''MATCH
+                (c:course)-[:PARENT_OF*]->(h:html)
+              WHERE
+                h.course_key STARTS WITH 'course-' AND
+                ($course_keys IS NULL OR h.course_key IN $course_keys) AND
+                h.data =~ '.*https?://.*'
+              RETURN
+                c.display_name as course_title,
+                c.org as organization,
+                h.course_key as course_key,
+                collect(h.data) as html_blocks'''
+
+# The same query, with the links extracted by EXTERNAL_LINK_PATTERN, passed as $pattern, on the server.
+# Matches of the edx.org and image alternatives have a null third group and are dropped.
+COURSEGRAPH_APOC_QUERY = '''MATCH
+                (c:course)-[:PARENT_OF*]->(h:html)
+              WHERE
+                h.course_key STARTS WITH 'course-' AND
+                ($course_keys IS NULL OR h.course_key IN $course_keys) AND
+                h.data =~ '.*https?://.*'
+              WITH
+                c, h,
+                [groups IN apoc.text.regexGroups(h.data, $pattern) WHERE groups[2] IS NOT NULL |
+                  groups[1] + '://' + left(groups[2], size(groups[2]) - 1)] as links
+              RETURN
+                c.display_name as course_title,
+                c.org as organization,
+                h.course_key as course_key,
+                apoc.coll.toSet(apoc.coll.flatten(collect(links))) as external_links'''
+
+
+class LinkReportState(object):
+    """
+    The version and external links of each course as of the last report, stored as JSON on disk.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or LINK_REPORT_STATE_PATH
+        try:
+            with open(self.path) as state_file:
+                self.courses = json.load(state_file)
+        except (IOError, ValueError):
+            self.courses = {}
+
+    def get_external_links(self, course_key, version):
+        """
+        Return the external links of the course if it is unchanged since they were recorded, or None.
+        """
+        course = self.courses.get(course_key)
+        if course is None or course['version'] != version:
+            return None
+        return set(course['external_links'])
+
+    def save(self):
+        """
+        Write the state to disk, replacing the previous one atomically.
+        """
+        temporary_path = '{}.tmp'.format(self.path)
+        with open(temporary_path, 'w') as state_file:
+            json.dump(self.courses, state_file)
+        os.replace(temporary_path, self.path)
+
+
+def get_course_version(block_versions):
+    """
+    Takes the [location, edited_on] pairs of a course's html blocks and returns
+    a hash that changes whenever a block is added, removed or edited
+    """
+    block_versions = sorted([str(location), str(edited_on)] for location, edited_on in block_versions)
+    return hashlib.sha1(json.dumps(block_versions).encode('utf-8')).hexdigest()
+
+
+def write_csv(processed_results, output_file):
+    """
+    Takes a dict of processed results and writes it as csv to a text file
+
+    Courses are sorted by course key and each course's links are sorted, the
+    first on the course's row and the rest on rows of their own
+    """
+    writer = csv.writer(output_file, lineterminator='\n')
+    writer.writerow(['Course Key', 'Course Title', 'Partner', 'External Links'])
+    for course_key in sorted(processed_results):
+        data = processed_results[course_key]
+        links = sorted(data['external_links']) or ['']
+        writer.writerow([course_key, data['course_title'], data['organization'], links[0]])
+        writer.writerows(['', '', '', link] for link in links[1:])
+
 
 def generate_csv_string(processed_results):
     """
@@ -25,16 +150,9 @@ def generate_csv_string(processed_results):
 
     Returns (unicode) string
     """
-    csv_string = u'Course Key,Course Title,Partner,External Links\n'
-    for course_key, data in processed_results.items():
-        links = u'\n,,,'.join(data['external_links'])
-        csv_string += u'{},"{}",{},{}\n'.format(
-            course_key,
-            data['course_title'],
-            data['organization'],
-            links,
-        )
-    return csv_string
+    output_file = io.StringIO()
+    write_csv(processed_results, output_file)
+    return output_file.getvalue()
 
 
 def gather_links_from_html(html_string):
@@ -42,42 +160,84 @@ def gather_links_from_html(html_string):
     Takes some html blob as a string and extracts any external links, and
     returns them as a set
     """
-    pattern = 'https?://.*?[" <]'
-    links = set([
-        link[0:-1]
-        for link in re.findall(pattern, html_string,)
-        if (not link.lower().endswith('.png"') and
-            not link.lower().endswith('.jpg"') and
-            not link.lower().endswith('.jpeg"') and
-            not link.lower().endswith('.gif"') and
-            not '.edx.org' in link)
-    ])
-    return links
+    return set(
+        scheme + '://' + link[:-1]
+        for scheme, link in EXTERNAL_LINK_PATTERN.findall(html_string)
+        if link
+    )
+
+
+def gather_links_from_courses(html_block_lists):
+    """
+    Takes a list of the html blobs of each course and returns the set of external links of each course
+    """
+    return [
+        set().union(*(gather_links_from_html(html_string) for html_string in html_blocks))
+        for html_blocks in html_block_lists
+    ]
 
 
-def process_results(raw_results):
+def extract_links(records, workers=None, chunk_size=None):
     """
-    Takes the data from a coursegraph query
+    Takes coursegraph course records and yields (record, external links) pairs in the same order
+
+    Links are extracted from chunks of `chunk_size` courses by a pool of `workers` processes. Only a few
+    chunks per worker are in flight at a time, so records can be consumed as they arrive.
+    """
+    workers = LINK_EXTRACTION_WORKERS if workers is None else workers
+    chunk_size = chunk_size or LINK_EXTRACTION_CHUNK_SIZE
+    records = iter(records)
+    chunks = iter(lambda: list(islice(records, chunk_size)), [])
+
+    if workers <= 1:
+        for chunk in chunks:
+            for pair in zip(chunk, gather_links_from_courses([record['html_blocks'] for record in chunk])):
+                yield pair
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, pool.apply_async(
+                gather_links_from_courses,
+                ([record['html_blocks'] for record in chunk],),
+            )))
+            if len(pending) >= workers * 2:
+                chunk, links = pending.popleft()
+                for pair in zip(chunk, links.get()):
+                    yield pair
+        while pending:
+            chunk, links = pending.popleft()
+            for pair in zip(chunk, links.get()):
+                yield pair
+
+
+def process_results(raw_results, workers=None, chunk_size=None, links_extracted=False):
+    """
+    Takes the data from a coursegraph query, one record per course
+
+    Records hold the course's html blobs, from which external links are
+    extracted, unless `links_extracted` is set, in which case they hold the
+    external links the query already extracted
 
     Returns a dict with course keys as the key and list data about that course
     as value
     """
-    processed_results = {}
-    for entry in raw_results:
-        course_key = entry['h.course_key']
-        # Only want new style course keys to exclude archived courses
-        if not course_key.startswith('course-'):
-            continue
-
-        external_links = gather_links_from_html(entry['h.data'])
+    if links_extracted:
+        course_links = ((record, set(record['external_links'])) for record in raw_results)
+    else:
+        course_links = extract_links(raw_results, workers, chunk_size)
 
+    processed_results = {}
+    for record, external_links in course_links:
+        course_key = record['course_key']
         if not external_links:
             continue
 
         if course_key not in processed_results:
             processed_results[course_key] = {
-                'course_title': entry['course_title'],
-                'organization': entry['organization'],
+                'course_title': record['course_title'],
+                'organization': record['organization'],
                 'external_links': external_links,
             }
         else:
@@ -85,41 +245,105 @@ def process_results(raw_results):
     return processed_results
 
 
-def query_coursegraph():
+def get_coursegraph():
     """
-    Calls coursegraph with cypher query and returns query data
-
-    The data is a list of dicts where each dict contains keys that correspond
-    to what is being returned in the query
+    Returns a connection to coursegraph
     """
-    graph = Graph(
+    return Graph(
         bolt=True,
         http_port=os.environ.get('COURSEGRAPH_PORT'),
         host=os.environ.get('COURSEGRAPH_HOST'),
         secure=True,
     )
-    query = '''MATCH
-                (c:course)-[:PARENT_OF*]->(h:html) 
-              WHERE 
-                h.data =~ '.*https?://.*'
-              RETURN
-                c.display_name as course_title,
-                c.org as organization,
-                h.course_key, 
-                h.data'''
-    results = graph.run(query)
-    return results.data()
+
+
+def query_coursegraph(graph, use_apoc=False, course_keys=None):
+    """
+    Calls coursegraph with cypher query and returns a cursor over the query data
+
+    Only new style course keys are queried, to exclude archived courses, and
+    only those in `course_keys` if given. The query returns one record per
+    course with the html blobs of all its blocks, or with `use_apoc` the
+    external links extracted from them by APOC's regex functions, so that only
+    the links cross the wire. The cursor yields records as they arrive, so
+    courses can be processed one chunk at a time instead of all being held in
+    memory. Each record maps keys that correspond to what is being returned
+    in the query to their values
+    """
+    if use_apoc:
+        return graph.run(COURSEGRAPH_APOC_QUERY, course_keys=course_keys, pattern=EXTERNAL_LINK_PATTERN.pattern)
+    return graph.run(COURSEGRAPH_QUERY, course_keys=course_keys)
+
+
+def query_course_versions(graph):
+    """
+    Calls coursegraph for the version of each course's html blocks, without their html
+
+    Returns a dict with course keys as the key and the course's title,
+    organization and version as value
+    """
+    block_versions = {}
+    courses = {}
+    for record in graph.run(COURSEGRAPH_VERSIONS_QUERY):
+        course_key = record['course_key']
+        block_versions.setdefault(course_key, []).extend(record['block_versions'])
+        courses.setdefault(course_key, {
+            'course_title': record['course_title'],
+            'organization': record['organization'],
+        })
+    for course_key, course in courses.items():
+        course['version'] = get_course_version(block_versions[course_key])
+    return courses
+
+
+def update_link_report(graph, state, use_apoc=False, workers=None, chunk_size=None):
+    """
+    Extracts the external links of the courses changed since the last report
+    and merges them with the links `state` recorded for the unchanged ones
+
+    `state` is updated to the current courses, and courses no longer in
+    coursegraph are dropped from it. Returns processed results, like
+    process_results does
+    """
+    courses = query_course_versions(graph)
+    changed_course_keys = [
+        course_key for course_key, course in courses.items()
+        if state.get_external_links(course_key, course['version']) is None
+    ]
+    LOGGER.info("{} of {} courses changed since the last report".format(len(changed_course_keys), len(courses)))
+
+    changed_results = {}
+    if changed_course_keys:
+        changed_results = process_results(
+            query_coursegraph(graph, use_apoc, changed_course_keys), workers, chunk_size, links_extracted=use_apoc
+        )
+
+    processed_results = {}
+    course_states = {}
+    for course_key, course in courses.items():
+        external_links = state.get_external_links(course_key, course['version'])
+        if external_links is None:
+            external_links = changed_results.get(course_key, {}).get('external_links', set())
+        course_states[course_key] = {'version': course['version'], 'external_links': sorted(external_links)}
+        if external_links:
+            processed_results[course_key] = {
+                'course_title': course['course_title'],
+                'organization': course['organization'],
+                'external_links': external_links,
+            }
+    state.courses = course_states
+    return processed_results
 
 
 def generate_and_email_report():
     """
     Generates a report an sends it as an email with an attachment
     """
-    LOGGER.info("Querying Course Graph DB...")
-    raw_results = query_coursegraph()
-
-    LOGGER.info("Processing {} html blobs returned...".format(len(raw_results)))
-    processed_results = process_results(raw_results)
+    LOGGER.info("Querying Course Graph DB for changed courses...")
+    state = LinkReportState()
+    processed_results = update_link_report(get_coursegraph(), state, use_apoc=COURSEGRAPH_USE_APOC)
+    state.save()
+    LOGGER.info("Found external links in {} courses".format(len(processed_results)))
 
     LOGGER.info("Generating spreadsheet...")
     csv_string = generate_csv_string(processed_results)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+A local record of the source data fingerprint of each report as it was last delivered.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import logging
+import os
+
+LOGGER = logging.getLogger(__name__)
+
+REPORT_FINGERPRINTS_PATH = os.environ.get(
+    'REPORT_FINGERPRINTS_PATH',
+    '/tmp/enterprise_reporting_fingerprints.json'
+)
+
+
+class ReportFingerprintStore(object):
+    """
+    Fingerprints of delivered reports, keyed by reporting config and stored as JSON on disk.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or REPORT_FINGERPRINTS_PATH
+        try:
+            with open(self.path) as fingerprints_file:
+                self.fingerprints = json.load(fingerprints_file)
+        except (IOError, ValueError):
+            self.fingerprints = {}
+
+    def get(self, key):
+        """
+        Return the fingerprint of the report last delivered for `key`, if any.
+        """
+        return self.fingerprints.get(key)
+
+    def set(self, key, fingerprint):
+        """
+        Record the fingerprint of the report just delivered for `key` and save the store to disk.
+
+        The store is saved on every update so that the reports delivered before a crash are not sent again.
+        """
+        self.fingerprints[key] = fingerprint
+        temporary_path = '{}.tmp'.format(self.path)
+        with open(temporary_path, 'w') as fingerprints_file:
+            json.dump(self.fingerprints, fingerprints_file)
+        os.replace(temporary_path, self.path)
@@ -6,16 +6,28 @@ from __future__ import absolute_import, unicode_literals
 
 import csv
 import datetime
+import hashlib
 import json
 import logging
-from collections import OrderedDict
+import os
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from io import open  # pylint: disable=redefined-builtin
+from itertools import chain, groupby
+from operator import itemgetter
 from uuid import UUID
 
 from enterprise_reporting.clients.enterprise import EnterpriseAPIClient, EnterpriseDataApiClient
 from enterprise_reporting.clients.vertica import VerticaClient
 from enterprise_reporting.delivery_method import SFTPDeliveryMethod, SMTPDeliveryMethod
-from enterprise_reporting.utils import decrypt_string, generate_data
+from enterprise_reporting.utils import (
+    JSON_STYLE_INDENTED,
+    JSON_STYLE_NDJSON,
+    CsvUnionWriter,
+    ParquetReportWriter,
+    decrypt_string,
+    write_json_records,
+)
 
 LOGGER = logging.getLogger(__name__)
 NOW = datetime.datetime.now().strftime("%Y-%m-%d")
@@ -27,7 +39,19 @@ class EnterpriseReportSender(object):
     """
 
     VERTICA_QUERY = ("SELECT {fields} FROM business_intelligence.enterprise_enrollment"
-                     " WHERE enterprise_id = '{enterprise_id}' AND consent_granted = 1")
+                     " WHERE enterprise_id = :enterprise_id AND consent_granted = 1")
+    BATCH_VERTICA_QUERY = ("SELECT enterprise_id,{fields} FROM business_intelligence.enterprise_enrollment"
+                           " WHERE enterprise_id IN ({placeholders}) AND consent_granted = 1"
+                           " ORDER BY enterprise_id")
+    FINGERPRINT_VERTICA_QUERY = ("SELECT COUNT(*),MAX(enrollment_created_timestamp),MAX(passed_timestamp),"
+                                 "MAX(last_activity_date),SUM(time_spent_hours)"
+                                 " FROM business_intelligence.enterprise_enrollment"
+                                 " WHERE enterprise_id = :enterprise_id AND consent_granted = 1")
+    BATCH_FINGERPRINT_VERTICA_QUERY = ("SELECT enterprise_id,COUNT(*),MAX(enrollment_created_timestamp),"
+                                       "MAX(passed_timestamp),MAX(last_activity_date),SUM(time_spent_hours)"
+                                       " FROM business_intelligence.enterprise_enrollment"
+                                       " WHERE enterprise_id IN ({placeholders}) AND consent_granted = 1"
+                                       " GROUP BY enterprise_id")
     VERTICA_QUERY_FIELDS = (
         'enterprise_user_id',
         'lms_user_id',
@@ -53,20 +77,56 @@ class EnterpriseReportSender(object):
         'last_activity_date',
         'user_current_enrollment_mode',
     )
+    # Arrow types of the columns of the Parquet version of the progress report, keyed by VERTICA_QUERY_FIELDS.
+    VERTICA_QUERY_FIELD_TYPES = {
+        'enterprise_user_id': 'int64',
+        'lms_user_id': 'int64',
+        'enterprise_sso_uid': 'string',
+        'enrollment_created_timestamp': 'timestamp[us]',
+        'consent_granted': 'bool',
+        'course_id': 'string',
+        'course_title': 'string',
+        'course_duration': 'string',
+        'course_min_effort': 'int64',
+        'course_max_effort': 'int64',
+        'user_account_creation_date': 'timestamp[us]',
+        'user_email': 'string',
+        'user_username': 'string',
+        'user_age': 'int64',
+        'user_level_of_education': 'string',
+        'user_gender': 'string',
+        'user_country_code': 'string',
+        'country_name': 'string',
+        'has_passed': 'bool',
+        'passed_timestamp': 'timestamp[us]',
+        'time_spent_hours': 'float64',
+        'last_activity_date': 'date32',
+        'user_current_enrollment_mode': 'string',
+    }
 
     FILE_WRITE_DIRECTORY = '/tmp'
 
-    def __init__(self, reporting_config, delivery_method):
-        """Initialize with an EnterpriseCustomerReportingConfiguration."""
+    def __init__(self, reporting_config, delivery_method, vertica_client=None, fingerprint_store=None):
+        """
+        Initialize with an EnterpriseCustomerReportingConfiguration.
+
+        If a `vertica_client` is given, it is shared with other reports and left open after this report is
+        generated; otherwise a connection is opened and closed just for this report.
+        If a `fingerprint_store` is given, the report is skipped when its source data has not changed since it
+        was last delivered.
+        """
         self.reporting_config = reporting_config
         self.delivery_method = delivery_method
+        self.vertica_client = vertica_client
+        self.fingerprint_store = fingerprint_store
+        self.report_fingerprint = None
         self.enterprise_customer_uuid = reporting_config['enterprise_customer']['uuid']
         self.enterprise_customer_name = reporting_config['enterprise_customer']['name']
         self.data_type = reporting_config['data_type']
         self.report_type = reporting_config['report_type']
 
     @staticmethod
-    def create(reporting_config):
+    def create(reporting_config, vertica_client=None, fingerprint_store=None):
         """Create the EnterpriseReportSender and all of its dependencies."""
         enterprise_customer_name = reporting_config['enterprise_customer']['name']
         delivery_method_str = reporting_config['delivery_method']
@@ -91,17 +151,50 @@ class EnterpriseReportSender(object):
         else:
             raise ValueError('Invalid delivery method: {}'.format(delivery_method_str))
 
-        return EnterpriseReportSender(reporting_config, delivery_method)
+        return EnterpriseReportSender(reporting_config, delivery_method, vertica_client, fingerprint_store)
+
+    @property
+    def progress_query(self):
+        """Get the Vertica query for progress data; the enterprise is bound through `progress_query_parameters`."""
+        return self.VERTICA_QUERY.format(fields=','.join(self.VERTICA_QUERY_FIELDS))
+
+    @property
+    def progress_query_parameters(self):
+        """Get the parameters to bind to `progress_query`."""
+        return {'enterprise_id': UUID(self.enterprise_customer_uuid).hex}
+
+    @property
+    def fingerprint_key(self):
+        """Get the key the fingerprint of this report is stored under."""
+        return '{}:{}:{}:{}'.format(
+            self.enterprise_customer_uuid,
+            self.data_type,
+            self.report_type,
+            self.reporting_config['delivery_method'],
+        )
+
+    @property
+    def json_report_style(self):
+        """Get the style JSON reports are written in, from the JSON_REPORT_STYLE environment variable."""
+        return os.environ.get('JSON_REPORT_STYLE', JSON_STYLE_INDENTED)
+
+    @property
+    def data_report_file_extension(self):
+        """Get the extension of the report file, which is jsonl for JSON reports written as NDJSON."""
+        if self.report_type == 'json' and self.json_report_style == JSON_STYLE_NDJSON:
+            return 'jsonl'
+        return self.report_type
 
     @property
     def data_report_file_name(self):
         """Get the full path to the report file."""
-        return "{dir}/{enterprise_id}_{data}_{ext}_{date}.{ext}".format(
+        return "{dir}/{enterprise_id}_{data}_{type}_{date}.{ext}".format(
             dir=self.FILE_WRITE_DIRECTORY,
             enterprise_id=self.enterprise_customer_uuid,
             data=self.data_type,
+            type=self.report_type,
             date=NOW,
-            ext=self.report_type,
+            ext=self.data_report_file_extension,
         )
 
     @property
@@ -109,12 +202,21 @@ class EnterpriseReportSender(object):
         """Get a full path to the report file that can be modified with arbitrary formatting."""
         return '_{}.'.join(self.data_report_file_name.rsplit('.'))
 
-    def send_enterprise_report(self):
-        """Generate the report file of the appropriate type and send it through the configured delivery method."""
+    def send_enterprise_report(self, files=None):
+        """
+        Generate the report file of the appropriate type and send it through the configured delivery method.
+
+        If the report `files` were already generated, e.g. by `generate_batched_progress_reports`, they are sent as is.
+        """
         LOGGER.info('Starting process to send report to {}'.format(self.enterprise_customer_name))
-        files = self._generate_enterprise_report()
+        if self.is_report_unchanged():
+            return
+        if files is None:
+            files = self._generate_enterprise_report()
         if files:
             self.delivery_method.send(files)
+            if self.report_fingerprint is not None:
+                self.fingerprint_store.set(self.fingerprint_key, self.report_fingerprint)
         else:
             LOGGER.warning('No {} {} reports were generated for {}! Moving on...'.format(
                 self.data_type,
@@ -122,6 +224,158 @@ class EnterpriseReportSender(object):
                 self.enterprise_customer_name
             ))
 
+    def is_report_unchanged(self):
+        """
+        Return True if the report's source data and configuration are the same as when it was last delivered.
+
+        Always False without a fingerprint store, or for data types that can't be fingerprinted.
+        """
+        if self.fingerprint_store is None:
+            return False
+        if self.report_fingerprint is None:
+            self.report_fingerprint = self.get_report_fingerprint()
+        if self.report_fingerprint is None:
+            return False
+        if self.fingerprint_store.get(self.fingerprint_key) != self.report_fingerprint:
+            return False
+        LOGGER.info('The {} data of {} has not changed since its last {} report -- skipping it.'.format(
+            self.data_type,
+            self.enterprise_customer_name,
+            self.report_type,
+        ))
+        return True
+
+    def get_report_fingerprint(self, source_fingerprint=None):
+        """
+        Get a fingerprint of the report's source data and configuration, without generating the report.
+
+        The fingerprint of the source data is fetched unless it is given, e.g. by `fetch_batched_report_fingerprints`.
+        Returns None if the data type has no cheap way to tell whether its data changed, e.g. catalog data.
+        """
+        if source_fingerprint is None:
+            get_source_fingerprint = getattr(self, '_get_source_fingerprint_{}'.format(self.data_type), None)
+            if get_source_fingerprint is None:
+                return None
+            source_fingerprint = get_source_fingerprint()
+        # The configuration is part of the fingerprint so that e.g. new recipients or keys get a fresh report.
+        fingerprint_data = json.dumps([source_fingerprint, self.reporting_config], sort_keys=True, default=str)
+        return hashlib.sha1(fingerprint_data.encode('utf-8')).hexdigest()
+
+    def _get_source_fingerprint_progress(self):
+        """Get the enrollment count and latest enrollment timestamps of the enterprise from Vertica."""
+        with self._vertica_connection() as vertica_client:
+            return list(vertica_client.fetch_results(self.FINGERPRINT_VERTICA_QUERY, self.progress_query_parameters)[0])
+
+    def _get_source_fingerprint_progress_v2(self):
+        """Get the enrollment count and latest `created` time of the enterprise from the Enterprise Data API."""
+        return list(EnterpriseDataApiClient().get_enterprise_enrollments_summary(self.enterprise_customer_uuid))
+
+    @classmethod
+    def fetch_batched_report_fingerprints(cls, senders, vertica_client):
+        """
+        Fetch the fingerprints of the progress reports of several senders with a single grouped Vertica query.
+
+        Each sender keeps its fingerprint, so that `is_report_unchanged` does not query Vertica for it again.
+        Enterprises without enrollments get the fingerprint `FINGERPRINT_VERTICA_QUERY` gives them.
+        """
+        senders = [sender for sender in senders if sender.fingerprint_store is not None]
+        enterprise_ids = sorted({UUID(sender.enterprise_customer_uuid).hex for sender in senders})
+        if not enterprise_ids:
+            return
+        query = cls.BATCH_FINGERPRINT_VERTICA_QUERY.format(placeholders=','.join(['%s'] * len(enterprise_ids)))
+        LOGGER.info('Executing a single Vertica query for the fingerprints of {} enterprises'.format(
+            len(enterprise_ids)
+        ))
+        if not vertica_client.is_connected:
+            vertica_client.connect()
+        source_fingerprints = {
+            row[0]: list(row[1:]) for row in vertica_client.fetch_results(query, tuple(enterprise_ids))
+        }
+        for sender in senders:
+            sender.report_fingerprint = sender.get_report_fingerprint(source_fingerprints.get(
+                UUID(sender.enterprise_customer_uuid).hex,
+                [0, None, None, None, None],
+            ))
+
+    @classmethod
+    def generate_batched_progress_reports(cls, senders, vertica_client):
+        """
+        Generate the progress CSV reports of several senders with a single scan of the enrollment table.
+
+        One query selects the enrollments of every sender's enterprise, ordered by enterprise_id, and the result
+        is streamed into each enterprise's report file in turn, so only one enterprise's files are open at a time.
+        Enterprises without enrollments get a report with only the header row, as they would from
+        `_generate_enterprise_report_progress_csv`.
+
+        Returns a dict mapping each sender to the list of files to send.
+        """
+        senders_by_enterprise_id = defaultdict(list)
+        for sender in senders:
+            senders_by_enterprise_id[UUID(sender.enterprise_customer_uuid).hex].append(sender)
+        if not senders_by_enterprise_id:
+            return {}
+
+        enterprise_ids = sorted(senders_by_enterprise_id)
+        query = cls.BATCH_VERTICA_QUERY.format(
+            fields=','.join(cls.VERTICA_QUERY_FIELDS),
+            placeholders=','.join(['%s'] * len(enterprise_ids)),
+        )
+        LOGGER.info('Executing a single Vertica query for the progress reports of {} enterprises'.format(
+            len(enterprise_ids)
+        ))
+        if not vertica_client.is_connected:
+            vertica_client.connect()
+
+        files_by_sender = {}
+        current_enterprise_id, current_writers = None, []
+        for batch in vertica_client.stream_result_batches(query, parameters=tuple(enterprise_ids)):
+            for enterprise_id, rows in groupby(batch, itemgetter(0)):
+                if enterprise_id != current_enterprise_id:
+                    cls._close_batched_progress_files(current_writers)
+                    current_enterprise_id = enterprise_id
+                    current_writers = cls._open_batched_progress_files(
+                        senders_by_enterprise_id.get(enterprise_id, []),
+                        files_by_sender,
+                    )
+                rows = [row[1:] for row in rows]
+                for _, writer in current_writers:
+                    writer.writerows(rows)
+        cls._close_batched_progress_files(current_writers)
+
+        for enterprise_id in enterprise_ids:
+            senders_without_rows = [
+                sender for sender in senders_by_enterprise_id[enterprise_id] if sender not in files_by_sender
+            ]
+            cls._close_batched_progress_files(
+                cls._open_batched_progress_files(senders_without_rows, files_by_sender)
+            )
+        return files_by_sender
+
+    @classmethod
+    def _open_batched_progress_files(cls, senders, files_by_sender):
+        """
+        Open the report files of an enterprise's senders and write their header row.
+
+        Senders of the same enterprise with the same report file name share a single file.
+        Returns a list of (file, csv writer) pairs.
+        """
+        writers = OrderedDict()
+        for sender in senders:
+            file_name = sender.data_report_file_name
+            if file_name not in writers:
+                data_report_file = open(file_name, 'w')
+                writer = csv.writer(data_report_file)
+                writer.writerow(cls.VERTICA_QUERY_FIELDS)
+                writers[file_name] = (data_report_file, writer)
+            files_by_sender[sender] = [writers[file_name][0]]
+        return list(writers.values())
+
+    @staticmethod
+    def _close_batched_progress_files(writers):
+        """Close the files opened by `_open_batched_progress_files`."""
+        for data_report_file, _ in writers:
+            data_report_file.close()
+
     def _generate_enterprise_report(self):
         """Calls the appropriate method for generating the report, e.g. the method for a CSV report of Catalog data."""
         LOGGER.info('Generating {} report in {} format...'.format(self.data_type, self.report_type))
@@ -130,20 +384,62 @@ class EnterpriseReportSender(object):
             ext=self.report_type
         ))()
 
+    @contextmanager
+    def _vertica_connection(self):
+        """
+        Provide a connected VerticaClient for generating this report.
+
+        The shared client is connected on first use and left open for the next report, unless generating
+        this report failed, in which case it is closed so that the next report starts on a fresh connection.
+        """
+        if self.vertica_client is None:
+            vertica_client = VerticaClient()
+            vertica_client.connect()
+            try:
+                yield vertica_client
+            finally:
+                vertica_client.close_connection()
+            return
+
+        if not self.vertica_client.is_connected:
+            self.vertica_client.connect()
+        try:
+            yield self.vertica_client
+        except Exception:
+            self.vertica_client.close_connection()
+            raise
+
     def _generate_enterprise_report_progress_csv(self):
         """Query vertica and write output to csv file."""
-        vertica_client = VerticaClient()
-        vertica_client.connect()
-        with open(self.data_report_file_name, 'w') as data_report_file:
+        with self._vertica_connection() as vertica_client, \
+                open(self.data_report_file_name, 'w') as data_report_file:
             data_report_file_writer = csv.writer(data_report_file)
             data_report_file_writer.writerow(self.VERTICA_QUERY_FIELDS)
-            query = self.VERTICA_QUERY.format(
-                fields=','.join(self.VERTICA_QUERY_FIELDS),
-                enterprise_id=UUID(self.enterprise_customer_uuid).hex
+            LOGGER.debug('Executing this Vertica query: {} with {}'.format(
+                self.progress_query,
+                self.progress_query_parameters,
+            ))
+            for batch in vertica_client.stream_result_batches(
+                    self.progress_query,
+                    parameters=self.progress_query_parameters,
+            ):
+                data_report_file_writer.writerows(batch)
+        return [data_report_file]
+
+    def _generate_enterprise_report_progress_parquet(self):
+        """Query vertica and write output to a Parquet file with typed columns, one row group at a time."""
+        with self._vertica_connection() as vertica_client, ParquetReportWriter(
+                self.data_report_file_name,
+                self.VERTICA_QUERY_FIELDS,
+                [self.VERTICA_QUERY_FIELD_TYPES[field] for field in self.VERTICA_QUERY_FIELDS],
+        ) as data_report_file:
+            LOGGER.debug('Executing this Vertica query: {} with {}'.format(
+                self.progress_query,
+                self.progress_query_parameters,
+            ))
+            data_report_file.write_rows(
+                vertica_client.stream_raw_results(self.progress_query, self.progress_query_parameters)
             )
-            LOGGER.debug('Executing this Vertica query: {}'.format(query))
-            data_report_file_writer.writerows(vertica_client.stream_results(query))
-        vertica_client.close_connection()
         return [data_report_file]
 
     def _generate_enterprise_report_progress_v2_csv(self):
@@ -162,60 +458,85 @@ class EnterpriseReportSender(object):
         """
         Query the Enterprise Data API to get progress data to be turned into json.
         """
-        enrollments = EnterpriseDataApiClient().get_enterprise_enrollments(self.enterprise_customer_uuid)['results']
-        report_data = enrollments if enrollments else []
-
+        enrollments = EnterpriseDataApiClient().iterate_enterprise_enrollments(self.enterprise_customer_uuid)
         with open(self.data_report_file_name, 'w') as data_report_file:
-            json.dump(report_data, data_report_file, indent=4)
+            write_json_records(enrollments, data_report_file, self.json_report_style)
 
         return [data_report_file]
 
+    def _generate_enterprise_report_progress_v2_parquet(self):
+        """
+        Query the Enterprise Data API to get progress data to be turned into a Parquet file.
+
+        Columns are the keys of the enrollments, and their types are inferred from all of their values.
+        """
+        enrollments = EnterpriseDataApiClient().iterate_enterprise_enrollments(self.enterprise_customer_uuid)
+        first_enrollment = next(enrollments, None)
+        if first_enrollment is None:
+            return []
+        with ParquetReportWriter(self.data_report_file_name) as data_report_file:
+            for enrollment in chain([first_enrollment], enrollments):
+                data_report_file.write_item(enrollment)
+        return [data_report_file]
+
     def _generate_enterprise_report_catalog_csv(self):
         """
-        Query the Enterprise Customer Catalog API and turn results into multiple CSV files.
-
-        Note that at the current time, the CSV is unconventional. It is produced with multiple headers,
-        one per each JSON object retrieved from the catalog API.
-        """
-        content_metadata = self.__get_content_metadata()
-        LOGGER.debug('Grouping up content metadata by type...')
-        grouped_content_metadata = {}
-        for item in content_metadata:
-            content_type = item['content_type']
-            if content_type not in grouped_content_metadata:
-                grouped_content_metadata[content_type] = [item]
-            else:
-                grouped_content_metadata[content_type].append(item)
-
-        LOGGER.info('Beginning to write content metadata groups to CSVs...')
-        files = []
-        for content_type, grouped_items in grouped_content_metadata.items():
-            with open(self.data_report_file_name_with.format(content_type), 'w') as data_report_file:
-                writer = csv.writer(data_report_file)
-                if grouped_items:
-                    # Write single row of headers in csv.
-                    writer.writerow(generate_data(grouped_items[0], target='key'))
+        Query the Enterprise Customer Catalog API and turn results into one CSV file per content type.
 
-                for item in grouped_items:
-                    writer.writerow(generate_data(item, target='value'))
+        Each file's header is the sorted union of the keys of all the items of its content type, and items are
+        streamed to their file as they arrive rather than grouped in memory first.
+        """
+        LOGGER.info('Beginning to write content metadata to CSVs by content type...')
+        writers = OrderedDict()
+        with self.__get_content_metadata() as content_metadata:
+            for item in content_metadata:
+                content_type = item['content_type']
+                writer = writers.get(content_type)
+                if writer is None:
+                    writer = CsvUnionWriter(self.data_report_file_name_with.format(content_type))
+                    writers[content_type] = writer
+                writer.write_item(item)
 
-                files.append(data_report_file)
-        return files
+        for writer in writers.values():
+            writer.close()
+        return list(writers.values())
 
     def _generate_enterprise_report_catalog_json(self):
         """Query the Enterprise Customer Catalog API and transfer the results into a JSON file."""
-        content_metadata = self.__get_content_metadata()
-        with open(self.data_report_file_name, 'w') as data_report_file:
-            json.dump(list(content_metadata), data_report_file, indent=4)
+        with self.__get_content_metadata() as content_metadata, \
+                open(self.data_report_file_name, 'w') as data_report_file:
+            write_json_records(content_metadata, data_report_file, self.json_report_style)
         return [data_report_file]
 
+    def _generate_enterprise_report_catalog_parquet(self):
+        """
+        Query the Enterprise Customer Catalog API and turn results into one Parquet file per content type.
+
+        Columns are the sorted union of the top-level keys of all the items of each content type, like the
+        headers of the CSV files; nested values are stored as JSON.
+        """
+        LOGGER.info('Beginning to write content metadata to Parquet files by content type...')
+        writers = OrderedDict()
+        with self.__get_content_metadata() as content_metadata:
+            for item in content_metadata:
+                content_type = item['content_type']
+                writer = writers.get(content_type)
+                if writer is None:
+                    writer = ParquetReportWriter(self.data_report_file_name_with.format(content_type))
+                    writers[content_type] = writer
+                writer.write_item(item)
+
+        for writer in writers.values():
+            writer.close()
+        return list(writers.values())
+
     def __get_content_metadata(self):
-        """Get content metadata from the Enterprise Customer Catalog API."""
+        """Get content metadata from the Enterprise Customer Catalog API, as a `DedupSpillStore` to be closed."""
         enterprise_api_client = EnterpriseAPIClient()
         LOGGER.info('Gathering all catalog content metadata...')
         content_metadata = enterprise_api_client.get_content_metadata(
             self.enterprise_customer_uuid,
             self.reporting_config,
         )
-        LOGGER.debug('Gathered this content metadata: {}'.format(content_metadata))
+        LOGGER.debug('Gathered {} content metadata items'.format(len(content_metadata)))
         return content_metadata
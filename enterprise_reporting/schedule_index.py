@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+A local index of which enterprises have reports due at each hour of the reporting schedule.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import logging
+import os
+import time
+
+from enterprise_reporting.utils import (
+    FREQUENCY_TYPE_DAILY,
+    FREQUENCY_TYPE_MONTHLY,
+    FREQUENCY_TYPE_WEEKLY,
+    get_current_schedule_time,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEDULE_INDEX_PATH = os.environ.get(
+    'REPORTING_SCHEDULE_INDEX_PATH',
+    '/tmp/enterprise_reporting_schedule_index.json'
+)
+# The reporting config API returns nothing to tell which configs changed, so the index can only be rebuilt from
+# all configs. Between rebuilds no config is fetched unless its enterprise is due, which means a config created or
+# rescheduled less than this long ago can miss its slot until the next rebuild. A shorter interval narrows that
+# window at the cost of listing every config more often; at or under the interval between runs, every run lists
+# every config, as without the index. Run with --refresh-schedule-index after changing a config to pick it up now.
+SCHEDULE_INDEX_REFRESH_INTERVAL = int(os.environ.get('REPORTING_SCHEDULE_INDEX_REFRESH_INTERVAL', 6 * 60 * 60))
+
+
+def get_schedule_bucket(frequency, hour_of_day, day_of_month=None, day_of_week=None):
+    """
+    Return the key of the schedule bucket a reporting config falls in, or None if it is never due.
+    """
+    if frequency == FREQUENCY_TYPE_DAILY:
+        return '{}:{}'.format(frequency, hour_of_day)
+    elif frequency == FREQUENCY_TYPE_WEEKLY:
+        return '{}:{}:{}'.format(frequency, hour_of_day, day_of_week)
+    elif frequency == FREQUENCY_TYPE_MONTHLY:
+        return '{}:{}:{}'.format(frequency, hour_of_day, day_of_month)
+    return None
+
+
+def get_due_schedule_buckets(current_time):
+    """
+    Return the keys of the schedule buckets that are due at the given time.
+    """
+    return [
+        get_schedule_bucket(FREQUENCY_TYPE_DAILY, current_time.hour),
+        get_schedule_bucket(FREQUENCY_TYPE_WEEKLY, current_time.hour, day_of_week=current_time.weekday()),
+        get_schedule_bucket(FREQUENCY_TYPE_MONTHLY, current_time.hour, day_of_month=current_time.day),
+    ]
+
+
+class ReportingScheduleIndex(object):
+    """
+    The uuids of the enterprises with active reporting configs, bucketed by schedule and cached on disk.
+
+    Only enterprise uuids are stored, never the configs themselves, as those contain delivery credentials.
+    """
+
+    def __init__(self, path=None, refresh_interval=None):
+        self.path = path or SCHEDULE_INDEX_PATH
+        self.refresh_interval = SCHEDULE_INDEX_REFRESH_INTERVAL if refresh_interval is None else refresh_interval
+        self.buckets = {}
+        self.built_at = None
+
+    @classmethod
+    def from_reporting_configs(cls, reporting_configs, **kwargs):
+        """
+        Build an index from a list of reporting configs.
+        """
+        index = cls(**kwargs)
+        buckets = {}
+        for reporting_config in reporting_configs:
+            if not reporting_config['active']:
+                continue
+            bucket = get_schedule_bucket(
+                reporting_config['frequency'],
+                reporting_config['hour_of_day'],
+                reporting_config['day_of_month'],
+                reporting_config['day_of_week'],
+            )
+            if bucket:
+                buckets.setdefault(bucket, set()).add(reporting_config['enterprise_customer']['uuid'])
+        index.buckets = {bucket: sorted(uuids) for bucket, uuids in buckets.items()}
+        index.built_at = time.time()
+        return index
+
+    @classmethod
+    def load(cls, **kwargs):
+        """
+        Load the index saved on disk, or return None if there is none or it is due for a refresh.
+        """
+        index = cls(**kwargs)
+        try:
+            with open(index.path) as index_file:
+                data = json.load(index_file)
+        except (IOError, ValueError):
+            return None
+        index.buckets = data['buckets']
+        index.built_at = data['built_at']
+        if time.time() - index.built_at >= index.refresh_interval:
+            return None
+        return index
+
+    def save(self):
+        """
+        Write the index to disk, replacing the previous one atomically.
+        """
+        temporary_path = '{}.tmp'.format(self.path)
+        with open(temporary_path, 'w') as index_file:
+            json.dump({'built_at': self.built_at, 'buckets': self.buckets}, index_file)
+        os.replace(temporary_path, self.path)
+
+    def get_due_enterprise_uuids(self, current_time=None):
+        """
+        Return the uuids of the enterprises with at least one report due at the given time, defaulting to now.
+        """
+        current_time = current_time or get_current_schedule_time()
+        due_uuids = set()
+        for bucket in get_due_schedule_buckets(current_time):
+            due_uuids.update(self.buckets.get(bucket, []))
+        return sorted(due_uuids)
+
+
+def get_due_reporting_configs(enterprise_api_client, force_refresh=False):
+    """
+    Return the reporting configs of the enterprises with a report due now.
+
+    All reporting configs are only fetched when the index on disk is missing, expired or `force_refresh` is set;
+    otherwise only the configs of the enterprises the index lists as due are fetched.
+    The returned configs still need to be checked against the schedule, since a config may have changed since
+    the index was built.
+    """
+    index = None if force_refresh else ReportingScheduleIndex.load()
+    if index is None:
+        LOGGER.info('Rebuilding the reporting schedule index from all reporting configs.')
+        reporting_configs = enterprise_api_client.get_all_enterprise_reporting_configs()['results']
+        index = ReportingScheduleIndex.from_reporting_configs(reporting_configs)
+        index.save()
+        due_uuids = set(index.get_due_enterprise_uuids())
+        return [config for config in reporting_configs if config['enterprise_customer']['uuid'] in due_uuids]
+
+    due_uuids = index.get_due_enterprise_uuids()
+    LOGGER.info('The reporting schedule index lists {} enterprises with reports due.'.format(len(due_uuids)))
+    reporting_configs = []
+    for enterprise_customer_uuid in due_uuids:
+        reporting_configs.extend(
+            enterprise_api_client.get_enterprise_reporting_configs(enterprise_customer_uuid)['results']
+        )
+    return reporting_configs
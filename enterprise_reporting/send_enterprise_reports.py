@@ -11,8 +11,12 @@ import os
 import re
 import sys
 
-from enterprise_reporting.clients.enterprise import EnterpriseAPIClient
+from enterprise_reporting.clients.enterprise import CATALOG_CONTENT_CACHE, EnterpriseAPIClient
+from enterprise_reporting.clients.vertica import VerticaClient
+from enterprise_reporting.delivery_method import SFTP_SESSION_POOL
+from enterprise_reporting.report_fingerprints import ReportFingerprintStore
 from enterprise_reporting.reporter import EnterpriseReportSender
+from enterprise_reporting.schedule_index import get_due_reporting_configs
 from enterprise_reporting.utils import is_current_time_in_schedule
 
 logging.basicConfig(level=logging.INFO)
@@ -20,18 +24,20 @@ LOGGER = logging.getLogger(__name__)
 DATA_TYPES = ['progress', 'progress_v2', 'catalog']
 
 
-def send_data(config):
+def send_data(config, vertica_client=None, fingerprint_store=None):
     """
     Send data report to each enterprise.
 
     Args:
         config
+        vertica_client: A VerticaClient shared by all reports of the run, if any.
+        fingerprint_store: A ReportFingerprintStore used to skip reports whose data has not changed, if any.
     """
     enterprise_customer_name = config['enterprise_customer']['name']
     LOGGER.info('Kicking off job to send report for {}'.format(enterprise_customer_name))
 
     try:
-        reporter = EnterpriseReportSender.create(config)
+        reporter = EnterpriseReportSender.create(config, vertica_client, fingerprint_store)
         reporter.send_enterprise_report()
     except Exception:  # pylint: disable=broad-except
         LOGGER.exception('Data report failed to send for {}'.format(enterprise_customer_name,))
@@ -40,6 +46,69 @@ def send_data(config):
     LOGGER.info('Finished job to send report for {}'.format(enterprise_customer_name))
 
 
+def send_batched_progress_data(configs, vertica_client=None, fingerprint_store=None):
+    """
+    Send the progress CSV reports of several enterprises, generating all of them with a single Vertica scan.
+
+    If generating the reports together fails, each report is generated and sent on its own instead.
+
+    Args:
+        configs: Reporting configurations with the progress data type and the csv report type.
+        vertica_client: A VerticaClient shared by all reports of the run, if any.
+        fingerprint_store: A ReportFingerprintStore used to skip reports whose data has not changed, if any.
+    """
+    senders = []
+    for config in configs:
+        try:
+            senders.append(EnterpriseReportSender.create(config, vertica_client, fingerprint_store))
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('Data report failed to send for {}'.format(config['enterprise_customer']['name']))
+
+    batch_vertica_client = vertica_client or VerticaClient()
+    if fingerprint_store is not None:
+        try:
+            EnterpriseReportSender.fetch_batched_report_fingerprints(senders, batch_vertica_client)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('Failed to fetch report fingerprints in a batch, fetching them one at a time instead.')
+    changed_senders = []
+    for sender in senders:
+        try:
+            if not sender.is_report_unchanged():
+                changed_senders.append(sender)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('Data report failed to send for {}'.format(sender.enterprise_customer_name))
+    senders = changed_senders
+
+    try:
+        files_by_sender = EnterpriseReportSender.generate_batched_progress_reports(senders, batch_vertica_client)
+    except Exception:  # pylint: disable=broad-except
+        LOGGER.exception('Failed to generate progress reports in a batch, generating them one at a time instead.')
+        if batch_vertica_client.is_connected:
+            batch_vertica_client.close_connection()
+        for config in configs:
+            send_data(config, vertica_client, fingerprint_store)
+        return
+    if vertica_client is None and batch_vertica_client.is_connected:
+        batch_vertica_client.close_connection()
+
+    for sender in senders:
+        LOGGER.info('Kicking off job to send report for {}'.format(sender.enterprise_customer_name))
+        try:
+            sender.send_enterprise_report(files_by_sender[sender])
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('Data report failed to send for {}'.format(sender.enterprise_customer_name))
+        LOGGER.info('Finished job to send report for {}'.format(sender.enterprise_customer_name))
+
+    # Reports of the same enterprise may share files, so only clean up once every report has been sent.
+    for config in configs:
+        cleanup_files(config['enterprise_customer']['uuid'])
+
+
+def is_batchable_progress_report(reporting_config):
+    """Return True if the report can be generated by `send_batched_progress_data`."""
+    return reporting_config['data_type'] == 'progress' and reporting_config['report_type'] == 'csv'
+
+
 def cleanup_files(enterprise_id):
     """
     Clean up any files created by sending the enterprise report.
@@ -78,11 +147,30 @@ def process_reports():
                              "whether forced or not.")
     parser.add_argument('--page-size', required=False, type=int, default=1000,
                         help="The page size to use to retrieve data that comes in a paginated response.")
+    parser.add_argument('--share-vertica-connection', action='store_true',
+                        help="Use a single Vertica connection for all progress reports instead of one per report.")
+    parser.add_argument('--batch-progress-reports', action='store_true',
+                        help="Generate all due progress CSV reports with a single Vertica query.")
+    parser.add_argument('--use-schedule-index', action='store_true',
+                        help="Only fetch the reporting configs of enterprises with reports due now, using the "
+                             "schedule index cached on disk. Configs created or rescheduled since the index was "
+                             "built are only picked up when it is next rebuilt, every "
+                             "REPORTING_SCHEDULE_INDEX_REFRESH_INTERVAL seconds (6 hours by default); a shorter "
+                             "interval misses fewer slots but lists every config more often.")
+    parser.add_argument('--refresh-schedule-index', action='store_true',
+                        help="Rebuild the schedule index from all reporting configs, even if it has not expired.")
+    parser.add_argument('--skip-unchanged-reports', action='store_true',
+                        help="Skip progress reports whose source data has not changed since they were last "
+                             "delivered. Ignored when an enterprise customer is specified.")
     args = parser.parse_args()
 
     enterprise_api_client = EnterpriseAPIClient()
     if args.enterprise_customer:
         reporting_configs = enterprise_api_client.get_enterprise_reporting_configs(args.enterprise_customer)
+    elif args.use_schedule_index:
+        reporting_configs = {
+            'results': get_due_reporting_configs(enterprise_api_client, force_refresh=args.refresh_schedule_index)
+        }
     else:
         reporting_configs = enterprise_api_client.get_all_enterprise_reporting_configs()
 
@@ -90,6 +178,11 @@ def process_reports():
         LOGGER.error('The enterprise {} does not have a reporting configuration.'.format(args.enterprise_customer))
         sys.exit(1)
 
+    vertica_client = VerticaClient() if args.share_vertica_connection else None
+    fingerprint_store = None
+    if args.skip_unchanged_reports and not args.enterprise_customer:
+        fingerprint_store = ReportFingerprintStore()
+    batched_progress_configs = []
     for reporting_config in reporting_configs['results']:
         LOGGER.info('Checking if {}\'s reporting config for {} data in {} format is ready for processing'.format(
             reporting_config['enterprise_customer']['name'],
@@ -97,10 +190,21 @@ def process_reports():
             reporting_config['report_type'],
         ))
 
-        if should_deliver_report(args, reporting_config):
-            send_data(reporting_config)
-        else:
+        if not should_deliver_report(args, reporting_config):
             LOGGER.info('Not ready -- skipping this report.')
+        elif args.batch_progress_reports and is_batchable_progress_report(reporting_config):
+            batched_progress_configs.append(reporting_config)
+        else:
+            send_data(reporting_config, vertica_client, fingerprint_store)
+
+    if batched_progress_configs:
+        send_batched_progress_data(batched_progress_configs, vertica_client, fingerprint_store)
+
+    SFTP_SESSION_POOL.close_all()
+    CATALOG_CONTENT_CACHE.clear()
+
+    if vertica_client and vertica_client.is_connected:
+        vertica_client.close_connection()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+An SFTP server on localhost, for testing SFTP report delivery against a real SFTP connection.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import os
+import posixpath
+import socket
+import threading
+
+import paramiko
+
+
+class LocalSFTPHandle(paramiko.SFTPHandle):
+    """
+    A handle to a file opened through `LocalSFTPServerInterface`.
+    """
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def chattr(self, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+
+class LocalSFTPServerInterface(paramiko.SFTPServerInterface):
+    """
+    Serves SFTP requests from a local directory, the `root` of the `LocalSSHServer` it is started for.
+    """
+
+    def __init__(self, server, *args, **kwargs):
+        self.root = server.root
+        super().__init__(server, *args, **kwargs)
+
+    def _local_path(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def canonicalize(self, path):
+        return posixpath.normpath(posixpath.join('/', path))
+
+    def list_folder(self, path):
+        local_path = self._local_path(path)
+        try:
+            attributes = []
+            for filename in os.listdir(local_path):
+                attribute = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local_path, filename)))
+                attribute.filename = filename
+                attributes.append(attribute)
+            return attributes
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local_path(path)))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._local_path(path)))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def open(self, path, flags, attr):
+        local_path = self._local_path(path)
+        try:
+            file_descriptor = os.open(local_path, flags | getattr(os, 'O_BINARY', 0), 0o666)
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = LocalSFTPHandle(flags)
+        handle.filename = local_path
+        handle.readfile = handle.writefile = os.fdopen(file_descriptor, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._local_path(path))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(self._local_path(newpath)):
+            return paramiko.SFTP_FAILURE
+        return self.posix_rename(oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.rename(self._local_path(oldpath), self._local_path(newpath))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._local_path(path))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self._local_path(path), attr)
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+
+class LocalSSHServer(paramiko.ServerInterface):
+    """
+    Accepts a single username and password, and only allows opening the sftp subsystem.
+    """
+
+    def __init__(self, root, username, password):
+        self.root = root
+        self.username = username
+        self.password = password
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (self.username, self.password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class LocalSFTPServer(object):
+    """
+    An SFTP server on localhost that stores uploads in the `root` directory.
+
+    Use it as a context manager; `port` is picked by the OS and `connection_count` counts accepted connections.
+    """
+
+    def __init__(self, root, username='reporting', password='secret'):
+        self.root = root
+        self.username = username
+        self.password = password
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.connection_count = 0
+        self.transports = []
+        self._socket = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._socket.getsockname()[1]
+
+    def __enter__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(16)
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._socket.close()
+        for transport in self.transports:
+            transport.close()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            self.connection_count += 1
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSFTPServerInterface)
+            transport.start_server(server=LocalSSHServer(self.root, self.username, self.password))
+            self.transports.append(transport)
@@ -3,10 +3,200 @@
 Test delivery methods.
 """
 
+import os
+import shutil
+import tempfile
 import unittest
 
-from enterprise_reporting import delivery_method
+import mock
+import paramiko
+
+from enterprise_reporting.delivery_method import SFTP_SESSION_POOL, SFTPDeliveryMethod
+from enterprise_reporting.tests.sftp_server import LocalSFTPServer
 
 
 class TestDeliveryMethod(unittest.TestCase):
 	pass
+
+
+class TestSFTPDeliveryMethod(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSFTPDeliveryMethod, self).setUp()
+        self.remote_root = tempfile.mkdtemp()
+        self.local_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.remote_root)
+        self.addCleanup(shutil.rmtree, self.local_root)
+        self.pending_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.pending_root)
+        patcher = mock.patch('enterprise_reporting.delivery_method.SFTP_PENDING_UPLOAD_DIRECTORY', self.pending_root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.server = LocalSFTPServer(self.remote_root)
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        # Sessions are closed before the server that they are connected to.
+        self.addCleanup(SFTP_SESSION_POOL.close_all)
+
+    def _create_delivery_method(self, name):
+        return SFTPDeliveryMethod({
+            'enterprise_customer': {'name': name},
+            'data_type': 'progress',
+            'report_type': 'csv',
+            'sftp_hostname': '127.0.0.1',
+            'sftp_port': self.server.port,
+            'sftp_username': self.server.username,
+            'sftp_file_path': '/',
+        }, self.server.password)
+
+    def _create_report(self, name, content):
+        file_path = os.path.join(self.local_root, name)
+        with open(file_path, 'wb') as report_file:
+            report_file.write(content)
+        return file_path
+
+    def test_sessions_are_reused_across_deliveries(self):
+        """
+        Reports for customers delivering to the same host and user share a single SSH connection.
+        """
+        reports = {
+            'first.zip': b'first report',
+            'second.zip': b'second report' * 10000,
+        }
+        for name, content in reports.items():
+            with mock.patch('enterprise_reporting.delivery_method.compress_and_encrypt',
+                            return_value=self._create_report(name, content)):
+                self._create_delivery_method(name).send([])
+
+        assert self.server.connection_count == 1
+        for name, content in reports.items():
+            with open(os.path.join(self.remote_root, name), 'rb') as uploaded_file:
+                assert uploaded_file.read() == content
+
+    @mock.patch('enterprise_reporting.delivery_method.SFTP_UPLOAD_RETRIES', 0)
+    def test_sessions_are_not_reused_with_another_password(self):
+        """
+        A delivery with a different password authenticates on its own instead of reusing an open session.
+        """
+        with mock.patch('enterprise_reporting.delivery_method.compress_and_encrypt',
+                        side_effect=lambda *args, **kwargs: self._create_report('report.zip', b'report')):
+            self._create_delivery_method('customer').send([])
+            delivery_method = self._create_delivery_method('customer')
+            delivery_method.password = 'rotated'
+            with self.assertRaises(paramiko.AuthenticationException):
+                delivery_method.send([])
+
+        assert self.server.connection_count == 2
+
+    @mock.patch('enterprise_reporting.delivery_method.SFTP_UPLOAD_RETRIES', 1)
+    def test_failed_upload_discards_session(self):
+        """
+        A session is not reused after an upload fails on it, and the upload is retried once.
+        """
+        delivery_method = self._create_delivery_method('customer')
+        delivery_method.file_path = '/does/not/exist'
+        with mock.patch('enterprise_reporting.delivery_method.compress_and_encrypt',
+                        side_effect=lambda *args, **kwargs: self._create_report('report.zip', b'report')):
+            with self.assertRaises(IOError):
+                delivery_method.send([])
+            self._create_delivery_method('customer').send([])
+
+        assert self.server.connection_count == 3
+
+    def _send_interrupted(self, delivery_method, files, archive, failing_write=4):
+        """
+        Send `archive` for `files` with a connection that fails on the `failing_write`th write, without retries.
+        """
+        write = paramiko.SFTPFile.write
+        writes = []
+
+        def interrupted_write(remote_file, data):
+            writes.append(data)
+            if len(writes) == failing_write:
+                raise IOError('Connection lost')
+            return write(remote_file, data)
+
+        with mock.patch('enterprise_reporting.delivery_method.compress_and_encrypt', return_value=archive), \
+                mock.patch('enterprise_reporting.delivery_method.SFTP_UPLOAD_RETRIES', 0), \
+                mock.patch('enterprise_reporting.delivery_method.SFTP_UPLOAD_CHUNK_SIZE', 100000), \
+                mock.patch.object(paramiko.SFTPFile, 'write', interrupted_write):
+            with self.assertRaises(IOError):
+                delivery_method.send(files)
+
+    def test_stale_partial_file_is_replaced(self):
+        """
+        A partial file left by an archive that was not kept is overwritten, not resumed.
+        """
+        content = b'0123456789' * 100000
+        with open(os.path.join(self.remote_root, 'report.zip.part'), 'wb') as partial_file:
+            partial_file.write(b'x' * 654321)
+
+        with mock.patch('enterprise_reporting.delivery_method.compress_and_encrypt',
+                        return_value=self._create_report('report.zip', content)):
+            self._create_delivery_method('customer').send([])
+
+        with open(os.path.join(self.remote_root, 'report.zip'), 'rb') as uploaded_file:
+            assert uploaded_file.read() == content
+        assert os.listdir(self.remote_root) == ['report.zip']
+
+    def test_failed_upload_resumes_in_next_delivery(self):
+        """
+        The archive of an upload that ran out of retries is kept, and the next delivery of the same files
+        resumes uploading it from the end of the partial file instead of creating a new archive.
+        """
+        content = b'0123456789' * 100000
+        files = [open(self._create_report('report.csv', b'report data'))]
+        files[0].close()
+        self._send_interrupted(
+            self._create_delivery_method('customer'), files, self._create_report('report.zip', content)
+        )
+        assert os.path.getsize(os.path.join(self.remote_root, 'report.zip.part')) == 300000
+
+        with mock.patch('enterprise_reporting.delivery_method.compress_and_encrypt') as mock_compress_and_encrypt:
+            with mock.patch('enterprise_reporting.delivery_method.LOGGER') as mock_logger:
+                self._create_delivery_method('customer').send(files)
+
+        mock_compress_and_encrypt.assert_not_called()
+        mock_logger.info.assert_any_call('Resuming upload for customer at byte 300000 of 1000000')
+        with open(os.path.join(self.remote_root, 'report.zip'), 'rb') as uploaded_file:
+            assert uploaded_file.read() == content
+        assert os.listdir(self.remote_root) == ['report.zip']
+        assert not os.listdir(self.pending_root)
+
+    def test_pending_archive_of_earlier_run_is_discarded(self):
+        """
+        An archive kept from an earlier day's run is not delivered under its name by a run with the same data.
+        """
+        files = [open(self._create_report('report_2018-10-01.csv', b'report data'))]
+        files[0].close()
+        archive = self._create_report('report_2018-10-01.zip', b'1' * 1000000)
+        self._send_interrupted(self._create_delivery_method('customer'), files, archive)
+        files = [open(self._create_report('report_2018-10-02.csv', b'report data'))]
+        files[0].close()
+
+        with mock.patch('enterprise_reporting.delivery_method.compress_and_encrypt',
+                        return_value=self._create_report('report_2018-10-02.zip', b'2' * 1000000)):
+            self._create_delivery_method('customer').send(files)
+
+        assert os.listdir(self.remote_root) == ['report_2018-10-02.zip']
+        assert not os.listdir(self.pending_root)
+
+    def test_pending_archive_of_other_files_is_discarded(self):
+        """
+        Once the report files change, the kept archive and its partial upload are dropped for a new archive.
+        """
+        report_path = self._create_report('report.csv', b'report data')
+        files = [open(report_path)]
+        files[0].close()
+        self._send_interrupted(
+            self._create_delivery_method('customer'), files, self._create_report('report_1.zip', b'1' * 1000000)
+        )
+        self._create_report('report.csv', b'new report data')
+
+        with mock.patch('enterprise_reporting.delivery_method.compress_and_encrypt',
+                        return_value=self._create_report('report_2.zip', b'2' * 1000000)):
+            self._create_delivery_method('customer').send(files)
+
+        assert os.listdir(self.remote_root) == ['report_2.zip']
+        assert not os.listdir(self.pending_root)
@@ -4,12 +4,22 @@ Test Enterprise client.
 """
 
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 import json
 import mock
 
+from enterprise_reporting.clients import reset_shared_http_state
 from enterprise_reporting.clients.enterprise import (
+    CatalogContentCache,
+    EnterpriseAPIClient,
+    EnterpriseDataApiClient,
     extract_catalog_uuids_from_reporting_config,
 )
 
@@ -39,3 +49,185 @@ class TestEnterpriseClient(unittest.TestCase):
             ]
         }
         assert extract_catalog_uuids_from_reporting_config(config) == expected
+
+    @mock.patch('enterprise_reporting.clients.enterprise.CATALOG_FETCH_WORKERS', 3)
+    def test_get_content_metadata_merges_catalogs_in_order(self):
+        """
+        Catalogs fetched concurrently are merged as if fetched in order, regardless of which finishes first.
+        """
+        catalogs = OrderedDict([
+            ('catalog-1', [{'content_type': 'course', 'key': 'a', 'catalog': 1},
+                           {'content_type': 'program', 'uuid': 'p', 'catalog': 1}]),
+            ('catalog-2', [{'content_type': 'course', 'key': 'b', 'catalog': 2}]),
+            ('catalog-3', [{'content_type': 'course', 'key': 'a', 'catalog': 3},
+                           {'content_type': 'course', 'key': 'c', 'catalog': 3}]),
+        ])
+        first_catalog_released = threading.Event()
+
+        def get_catalog_content(catalog):
+            if catalog['uuid'] == 'catalog-1':
+                # Finish last, after the other catalogs were fetched.
+                first_catalog_released.wait(5)
+            elif catalog['uuid'] == 'catalog-3':
+                first_catalog_released.set()
+            return iter(catalogs[catalog['uuid']])
+
+        client = EnterpriseAPIClient()
+        reporting_config = {'enterprise_customer_catalogs': [{'uuid': uuid} for uuid in catalogs]}
+        with mock.patch.object(client, 'token_expired', return_value=False), \
+                mock.patch.object(client, '_get_catalog_content', side_effect=get_catalog_content):
+            content_metadata = list(client.get_content_metadata('enterprise-uuid', reporting_config))
+
+        assert [(item.get('key') or item['uuid'], item['catalog']) for item in content_metadata] == [
+            ('a', 3), ('p', 1), ('b', 2), ('c', 3),
+        ]
+
+    @mock.patch('enterprise_reporting.clients.enterprise.CATALOG_FETCH_WORKERS', 2)
+    def test_get_content_metadata_bounds_catalogs_fetched_ahead(self):
+        """
+        No more catalogs are fetched ahead of the one being merged than there are workers.
+        """
+        started, merged, fetched_ahead = [], [], []
+
+        def get_catalog_content(catalog):
+            started.append(catalog['uuid'])
+            fetched_ahead.append(len(started) - len(merged))
+            yield {'content_type': 'course', 'key': catalog['uuid']}
+            merged.append(catalog['uuid'])
+
+        client = EnterpriseAPIClient()
+        reporting_config = {'enterprise_customer_catalogs': [{'uuid': str(index)} for index in range(6)]}
+        with mock.patch.object(client, 'token_expired', return_value=False), \
+                mock.patch.object(client, '_get_catalog_content', side_effect=get_catalog_content):
+            content_metadata = list(client.get_content_metadata('enterprise-uuid', reporting_config))
+
+        assert [item['key'] for item in content_metadata] == [str(index) for index in range(6)]
+        assert max(fetched_ahead) <= 2
+
+    def test_catalog_content_is_cached(self):
+        """
+        A catalog is fetched once per run, and catalogs with a `modified` timestamp are reused from disk by later runs.
+        """
+        cache_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_directory)
+        items = [{'content_type': 'course', 'key': 'a'}, {'content_type': 'course', 'key': 'b'}]
+
+        for run in range(2):
+            cache = CatalogContentCache(directory=cache_directory)
+            with mock.patch('enterprise_reporting.clients.enterprise.CATALOG_CONTENT_CACHE', cache), \
+                    mock.patch.object(EnterpriseAPIClient, '_stream_data', side_effect=lambda *args, **kwargs: iter(
+                        items
+                    )) as stream_data:
+                for catalog in ({'uuid': 'shared', 'modified': '2018-10-01'}, {'uuid': 'unversioned'}) * 2:
+                    assert list(EnterpriseAPIClient()._get_catalog_content(catalog)) == items
+            cache.clear()
+            # The catalog without a `modified` timestamp is fetched again by every run.
+            assert stream_data.call_count == (2 if run == 0 else 1)
+        assert len(os.listdir(cache_directory)) == 1
+
+    def test_catalog_cache_keeps_latest_entry(self):
+        """
+        Caching a catalog at a new `modified` timestamp removes its older entries, but not those of other catalogs.
+        """
+        cache_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_directory)
+        cache = CatalogContentCache(directory=cache_directory)
+        self.addCleanup(cache.clear)
+
+        assert list(cache.get_items('first', '2018-10-01', lambda: iter([{'key': 'a'}]))) == [{'key': 'a'}]
+        assert list(cache.get_items('second', '2018-10-01', lambda: iter([{'key': 'c'}]))) == [{'key': 'c'}]
+        assert list(cache.get_items('first', '2018-10-02', lambda: iter([{'key': 'b'}]))) == [{'key': 'b'}]
+        assert len(os.listdir(cache_directory)) == 2
+        assert list(cache.get_items('second', '2018-10-01', lambda: iter([]))) == [{'key': 'c'}]
+
+    def test_expired_catalogs_are_fetched_again(self):
+        """
+        Catalogs cached longer than the max age are fetched again, and removed by `clear` if they aren't.
+        """
+        cache_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_directory)
+        cache = CatalogContentCache(directory=cache_directory, max_age=60)
+        list(cache.get_items('refetched', '2018-10-01', lambda: iter([{'key': 'a'}])))
+        list(cache.get_items('unused', '2018-10-01', lambda: iter([{'key': 'a'}])))
+        expired = time.time() - 120
+        for name in os.listdir(cache_directory):
+            os.utime(os.path.join(cache_directory, name), (expired, expired))
+
+        items = list(cache.get_items('refetched', '2018-10-01', lambda: iter([{'key': 'b'}])))
+        cache.clear()
+
+        assert items == [{'key': 'b'}]
+        assert len(os.listdir(cache_directory)) == 1
+        assert list(cache.get_items('refetched', '2018-10-01', lambda: iter([]))) == [{'key': 'b'}]
+        cache.clear()
+
+    def test_concurrent_misses_fetch_catalog_once(self):
+        """
+        Threads that need a catalog while another thread is fetching it wait for that fetch instead of repeating it.
+        """
+        cache = CatalogContentCache(directory='')
+        self.addCleanup(cache.clear)
+        fetch_started = threading.Event()
+        fetch_count = []
+
+        def fetch_items():
+            fetch_count.append(1)
+            fetch_started.set()
+            yield {'key': 'a'}
+            # Give the other thread time to miss the cache while this fetch is still in progress.
+            threading.Event().wait(0.2)
+            yield {'key': 'b'}
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(list(cache.get_items('catalog', None, fetch_items))))
+            for _ in range(2)
+        ]
+        threads[0].start()
+        fetch_started.wait(5)
+        threads[1].start()
+        for thread in threads:
+            thread.join()
+
+        assert len(fetch_count) == 1
+        assert results == [[{'key': 'a'}, {'key': 'b'}]] * 2
+
+
+class TestEdxOAuth2APIClientConnectionReuse(unittest.TestCase):
+
+    def setUp(self):
+        super(TestEdxOAuth2APIClientConnectionReuse, self).setUp()
+        reset_shared_http_state()
+        self.addCleanup(reset_shared_http_state)
+
+    @mock.patch('enterprise_reporting.clients.EdxRestApiClient')
+    def test_access_token_is_shared_between_clients(self, mock_rest_client):
+        """
+        Clients created during the same run should reuse a valid token and the same connection pool.
+        """
+        mock_rest_client.get_oauth_access_token.return_value = ('token', datetime.utcnow() + timedelta(hours=1))
+
+        EnterpriseAPIClient().connect()
+        EnterpriseDataApiClient().connect()
+
+        assert mock_rest_client.get_oauth_access_token.call_count == 1
+        first_session = mock_rest_client.call_args_list[0][1]['session']
+        second_session = mock_rest_client.call_args_list[1][1]['session']
+        assert first_session.get_adapter('https://') is second_session.get_adapter('https://')
+
+    @mock.patch('enterprise_reporting.clients.EdxRestApiClient')
+    def test_expired_access_token_is_refreshed(self, mock_rest_client):
+        """
+        An expired cached token should be replaced by a freshly fetched one.
+        """
+        mock_rest_client.get_oauth_access_token.side_effect = [
+            ('expired-token', datetime.utcnow() - timedelta(seconds=1)),
+            ('token', datetime.utcnow() + timedelta(hours=1)),
+        ]
+
+        EnterpriseAPIClient().connect()
+        client = EnterpriseAPIClient()
+        client.connect()
+
+        assert mock_rest_client.get_oauth_access_token.call_count == 2
+        assert mock_rest_client.call_args[1]['jwt'] == 'token'
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Test the external resource link report.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import ddt
+import mock
+
+from enterprise_reporting import external_resource_link_report
+from enterprise_reporting.benchmarks.fakes import FakeCoursegraph, generate_html_blocks
+
+
+@ddt.ddt
+class TestExternalResourceLinkReport(unittest.TestCase):
+    """
+    Tests the link extraction of the external resource link report.
+    """
+
+    @ddt.data(
+        ('<a href="https://example.com/a">a</a>', {'https://example.com/a'}),
+        ('see http://example.com/b and <br/>http://example.com/c<', {'http://example.com/b', 'http://example.com/c'}),
+        ('<a href="https://courses.edx.org/about">edX</a>', set()),
+        ('<img src="https://example.com/image.PNG"/><img src="http://example.com/photo.jpeg"/>', set()),
+        ('https://example.com/image.png and https://example.com/a.gif<', {
+            'https://example.com/image.png', 'https://example.com/a.gif',
+        }),
+        ('https://example.com/broken\nline"', set()),
+        ('"http://"', {'http://'}),
+    )
+    @ddt.unpack
+    def test_gather_links_from_html(self, html_string, links):
+        assert external_resource_link_report.gather_links_from_html(html_string) == links
+
+    def test_process_results_in_parallel(self):
+        """
+        Extracting links in several processes gives the same results, in the same order, as doing it inline.
+        """
+        raw_results = FakeCoursegraph(list(generate_html_blocks(200, course_count=20))).run(
+            external_resource_link_report.COURSEGRAPH_QUERY
+        )
+
+        processed_results = external_resource_link_report.process_results(raw_results, workers=1)
+        assert external_resource_link_report.process_results(raw_results, workers=2, chunk_size=3) == processed_results
+        assert list(processed_results) == [
+            'course-v1:edX+DemoX{}+2018'.format(index) for index in range(20) if index % 10 != 9
+        ]
+        assert processed_results['course-v1:edX+DemoX0+2018']['external_links'] == {
+            'https://example.com/articles/{}'.format(index) for index in range(10)
+        } | {
+            'http://videos.example.org/watch?v={}&amp;t=1'.format(index) for index in range(10)
+        } | {'https://example.com/plain/0'}
+
+    def test_process_results_extracted_by_apoc(self):
+        """
+        Links extracted by the APOC query with the same pattern are those extracted from the html blocks.
+        """
+        coursegraph = FakeCoursegraph(list(generate_html_blocks(200, course_count=20)))
+        processed_results = external_resource_link_report.process_results(
+            coursegraph.run(external_resource_link_report.COURSEGRAPH_QUERY), workers=1
+        )
+        apoc_results = coursegraph.run(
+            external_resource_link_report.COURSEGRAPH_APOC_QUERY,
+            pattern=external_resource_link_report.EXTERNAL_LINK_PATTERN.pattern,
+        )
+        assert all('html_blocks' not in record for record in apoc_results)
+        assert external_resource_link_report.process_results(apoc_results, links_extracted=True) == processed_results
+
+    def test_generate_csv_string(self):
+        """
+        Courses and links are written in sorted order, and titles are escaped.
+        """
+        processed_results = {
+            'course-v1:edX+B+2018': {
+                'course_title': 'Say "Hello", World',
+                'organization': 'edX',
+                'external_links': {'https://example.com/2', 'https://example.com/1'},
+            },
+            'course-v1:edX+A+2018': {
+                'course_title': 'A',
+                'organization': 'edX',
+                'external_links': {'https://example.com/3'},
+            },
+        }
+        assert external_resource_link_report.generate_csv_string(processed_results) == (
+            'Course Key,Course Title,Partner,External Links\n'
+            'course-v1:edX+A+2018,A,edX,https://example.com/3\n'
+            'course-v1:edX+B+2018,"Say ""Hello"", World",edX,https://example.com/1\n'
+            ',,,https://example.com/2\n'
+        )
+
+
+class FakeCoursegraphCursor(object):
+    """
+    Stands in for a py2neo cursor, serving records one at a time and counting how many were served.
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.consumed = 0
+
+    def __iter__(self):
+        for record in self.records:
+            self.consumed += 1
+            yield record
+
+    def data(self):
+        raise AssertionError('The whole result set should not be loaded at once.')
+
+
+class TestGenerateAndEmailReport(unittest.TestCase):
+    """
+    Tests the external resource link report is generated from a stream of coursegraph records.
+    """
+
+    def setUp(self):
+        super(TestGenerateAndEmailReport, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.state_path = os.path.join(directory, 'state.json')
+        patcher = mock.patch(
+            'enterprise_reporting.external_resource_link_report.LINK_REPORT_STATE_PATH', self.state_path
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(external_resource_link_report, 'TO_EMAILS', 'cs@example.com', create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('enterprise_reporting.external_resource_link_report.LINK_EXTRACTION_WORKERS', 1)
+    @mock.patch('enterprise_reporting.external_resource_link_report.LINK_EXTRACTION_CHUNK_SIZE', 2)
+    @mock.patch('enterprise_reporting.external_resource_link_report.send_email_with_attachment')
+    @mock.patch('enterprise_reporting.external_resource_link_report.Graph')
+    def test_records_are_streamed(self, mock_graph, mock_send_email):
+        coursegraph = FakeCoursegraph(list(generate_html_blocks(100, course_count=10)))
+        cursors = []
+
+        def run(query, **parameters):
+            cursors.append(FakeCoursegraphCursor(coursegraph.run(query, **parameters)))
+            return cursors[-1]
+
+        mock_graph.return_value.run.side_effect = run
+        consumed_at_first_extraction = []
+        gather_links_from_html = external_resource_link_report.gather_links_from_html
+
+        def gather_links(html_string):
+            consumed_at_first_extraction.append(cursors[-1].consumed)
+            return gather_links_from_html(html_string)
+
+        with mock.patch.object(external_resource_link_report, 'gather_links_from_html', side_effect=gather_links):
+            external_resource_link_report.generate_and_email_report()
+
+        # Links were extracted from the first chunk before the rest of the records were received.
+        query, parameters = coursegraph.queries[-1]
+        assert query == external_resource_link_report.COURSEGRAPH_QUERY
+        assert len(parameters['course_keys']) == 9
+        assert consumed_at_first_extraction[0] == 2
+        assert cursors[-1].consumed == 9
+        csv_string = mock_send_email.call_args[1]['attachment_data'].decode('utf-8')
+        assert csv_string.count('course-v1:') == 9
+
+    @mock.patch('enterprise_reporting.external_resource_link_report.COURSEGRAPH_USE_APOC', True)
+    @mock.patch('enterprise_reporting.external_resource_link_report.send_email_with_attachment')
+    @mock.patch('enterprise_reporting.external_resource_link_report.Graph')
+    def test_links_extracted_by_apoc(self, mock_graph, mock_send_email):
+        mock_graph.return_value = FakeCoursegraph(list(generate_html_blocks(100, course_count=10)))
+
+        with mock.patch.object(external_resource_link_report, 'gather_links_from_html') as mock_gather_links:
+            external_resource_link_report.generate_and_email_report()
+
+        mock_gather_links.assert_not_called()
+        query, parameters = mock_graph.return_value.queries[-1]
+        assert query == external_resource_link_report.COURSEGRAPH_APOC_QUERY
+        assert parameters['pattern'] == external_resource_link_report.EXTERNAL_LINK_PATTERN.pattern
+        csv_string = mock_send_email.call_args[1]['attachment_data'].decode('utf-8')
+        assert csv_string.count('course-v1:') == 9
+
+    @mock.patch('enterprise_reporting.external_resource_link_report.LINK_EXTRACTION_WORKERS', 1)
+    @mock.patch('enterprise_reporting.external_resource_link_report.send_email_with_attachment')
+    @mock.patch('enterprise_reporting.external_resource_link_report.Graph')
+    def test_only_changed_courses_are_extracted(self, mock_graph, mock_send_email):
+        html_blocks = list(generate_html_blocks(100, course_count=10))
+        mock_graph.return_value = FakeCoursegraph(html_blocks)
+        external_resource_link_report.generate_and_email_report()
+        first_csv_string = mock_send_email.call_args[1]['attachment_data'].decode('utf-8')
+
+        # Nothing changed, so the links recorded by the first report are reused.
+        with mock.patch.object(external_resource_link_report, 'query_coursegraph') as mock_query:
+            external_resource_link_report.generate_and_email_report()
+        mock_query.assert_not_called()
+        assert mock_send_email.call_args[1]['attachment_data'].decode('utf-8') == first_csv_string
+
+        # A link is added to a block of one course, and the others are gone.
+        html_blocks[0]['h.data'] += '<a href="https://example.com/new">new</a>'
+        html_blocks[0]['h.edited_on'] = '2019-01-01 00:00:00+00:00'
+        del html_blocks[20:]
+        external_resource_link_report.generate_and_email_report()
+
+        query, parameters = mock_graph.return_value.queries[-1]
+        assert query == external_resource_link_report.COURSEGRAPH_QUERY
+        assert parameters['course_keys'] == ['course-v1:edX+DemoX0+2018']
+        csv_string = mock_send_email.call_args[1]['attachment_data'].decode('utf-8')
+        assert csv_string.count('course-v1:') == 2
+        assert 'https://example.com/new' in csv_string
+        assert 'https://example.com/articles/10' in csv_string
+        state = external_resource_link_report.LinkReportState(self.state_path)
+        assert sorted(state.courses) == ['course-v1:edX+DemoX0+2018', 'course-v1:edX+DemoX1+2018']
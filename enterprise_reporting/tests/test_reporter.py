@@ -3,10 +3,221 @@
 Test reporter.
 """
 
+import csv
+import datetime
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
-from enterprise_reporting import reporter
+import mock
+import pyarrow.parquet as pq
+
+from enterprise_reporting.clients.vertica import VerticaClient
+from enterprise_reporting.report_fingerprints import ReportFingerprintStore
+from enterprise_reporting.reporter import NOW, EnterpriseReportSender
+from enterprise_reporting.utils import DedupSpillStore
+
+REPO_DIR = os.getcwd()
+FIXTURE_DIR = os.path.join(REPO_DIR, 'enterprise_reporting/fixtures')
 
 
 class TestReporter(unittest.TestCase):
-	pass
+
+    def setUp(self):
+        super(TestReporter, self).setUp()
+
+        json_path = os.path.join(FIXTURE_DIR, 'enterprise_customer_reporting.json')
+        with open(json_path, 'r') as fh:
+            self.reporting_configs = json.load(fh)['results']
+
+    def _create_sender(self, reporting_config, vertica_client=None, fingerprint_store=None):
+        """Create an EnterpriseReportSender that writes to a throwaway file."""
+        sender = EnterpriseReportSender(reporting_config, mock.Mock(), vertica_client, fingerprint_store)
+        self.addCleanup(lambda: os.path.exists(sender.data_report_file_name) and os.remove(
+            sender.data_report_file_name
+        ))
+        return sender
+
+    @mock.patch('enterprise_reporting.clients.vertica.vertica_python')
+    def test_progress_reports_share_vertica_connection(self, mock_vertica_python):
+        """
+        Progress reports sharing a VerticaClient connect once and pass the enterprise as a query parameter.
+        """
+        cursor = mock_vertica_python.connect.return_value.cursor.return_value
+        cursor.fetchmany.return_value = []
+        vertica_client = VerticaClient()
+
+        first_config, second_config = self.reporting_configs[0], dict(self.reporting_configs[0])
+        second_config['enterprise_customer'] = dict(first_config['enterprise_customer'], uuid=(
+            '8d4ecb68-7a67-43bd-8ed9-1c31d7c5a8ff'
+        ))
+        for reporting_config in (first_config, second_config):
+            self._create_sender(reporting_config, vertica_client)._generate_enterprise_report_progress_csv()
+
+        assert mock_vertica_python.connect.call_count == 1
+        assert vertica_client.is_connected
+        first_call, second_call = cursor.execute.call_args_list
+        assert first_call[0][0] == second_call[0][0]
+        assert first_call[0][1] == {'enterprise_id': '39e42f02fe3b4462a3b2d1d490666ff4'}
+        assert second_call[0][1] == {'enterprise_id': '8d4ecb687a6743bd8ed91c31d7c5a8ff'}
+
+    @mock.patch('enterprise_reporting.clients.vertica.vertica_python')
+    def test_progress_report_without_shared_connection(self, mock_vertica_python):
+        """
+        Without a shared VerticaClient, each report opens and closes its own connection.
+        """
+        mock_vertica_python.connect.return_value.cursor.return_value.fetchmany.return_value = []
+
+        self._create_sender(self.reporting_configs[0])._generate_enterprise_report_progress_csv()
+
+        assert mock_vertica_python.connect.call_count == 1
+        mock_vertica_python.connect.return_value.close.assert_called_once_with()
+
+    @mock.patch('enterprise_reporting.clients.vertica.vertica_python')
+    def test_generate_batched_progress_reports(self, mock_vertica_python):
+        """
+        A single query fans out into one progress report per enterprise.
+        """
+        first_config = self.reporting_configs[0]
+        second_config = dict(first_config, enterprise_customer=dict(
+            first_config['enterprise_customer'],
+            uuid='8d4ecb68-7a67-43bd-8ed9-1c31d7c5a8ff',
+        ))
+        senders = [self._create_sender(first_config), self._create_sender(second_config)]
+        cursor = mock_vertica_python.connect.return_value.cursor.return_value
+        cursor.fetchmany.side_effect = [
+            [('39e42f02fe3b4462a3b2d1d490666ff4', 1), ('39e42f02fe3b4462a3b2d1d490666ff4', 2)],
+            [('39e42f02fe3b4462a3b2d1d490666ff4', 3)],
+            [],
+        ]
+
+        files_by_sender = EnterpriseReportSender.generate_batched_progress_reports(senders, VerticaClient())
+
+        assert cursor.execute.call_count == 1
+        assert cursor.execute.call_args[0][1] == (
+            '39e42f02fe3b4462a3b2d1d490666ff4', '8d4ecb687a6743bd8ed91c31d7c5a8ff',
+        )
+        with open(files_by_sender[senders[0]][0].name) as report_file:
+            rows = list(csv.reader(report_file))
+        assert rows == [list(EnterpriseReportSender.VERTICA_QUERY_FIELDS), ['1'], ['2'], ['3']]
+        with open(files_by_sender[senders[1]][0].name) as report_file:
+            rows = list(csv.reader(report_file))
+        assert rows == [list(EnterpriseReportSender.VERTICA_QUERY_FIELDS)]
+
+    @mock.patch('enterprise_reporting.clients.vertica.vertica_python')
+    def test_fetch_batched_report_fingerprints(self, mock_vertica_python):
+        """
+        A single grouped query gives every sender the fingerprint it would have fetched on its own.
+        """
+        fingerprint_store = ReportFingerprintStore(os.path.join(tempfile.mkdtemp(), 'fingerprints.json'))
+        self.addCleanup(shutil.rmtree, os.path.dirname(fingerprint_store.path))
+        first_config = self.reporting_configs[0]
+        second_config = dict(first_config, enterprise_customer=dict(
+            first_config['enterprise_customer'],
+            uuid='8d4ecb68-7a67-43bd-8ed9-1c31d7c5a8ff',
+        ))
+        senders = [
+            self._create_sender(first_config, fingerprint_store=fingerprint_store),
+            self._create_sender(second_config, fingerprint_store=fingerprint_store),
+        ]
+        source_fingerprint = (3, datetime.datetime(2018, 10, 1), None, datetime.date(2018, 10, 2), 1.5)
+        cursor = mock_vertica_python.connect.return_value.cursor.return_value
+        cursor.fetchall.return_value = [('39e42f02fe3b4462a3b2d1d490666ff4',) + source_fingerprint]
+
+        EnterpriseReportSender.fetch_batched_report_fingerprints(senders, VerticaClient())
+
+        assert cursor.execute.call_count == 1
+        assert 'GROUP BY enterprise_id' in cursor.execute.call_args[0][0]
+        assert cursor.execute.call_args[0][1] == (
+            '39e42f02fe3b4462a3b2d1d490666ff4', '8d4ecb687a6743bd8ed91c31d7c5a8ff',
+        )
+        cursor.fetchall.side_effect = [[source_fingerprint], [(0, None, None, None, None)]]
+        for sender in senders:
+            assert sender.report_fingerprint == self._create_sender(sender.reporting_config).get_report_fingerprint()
+
+    @mock.patch('enterprise_reporting.clients.vertica.vertica_python')
+    def test_unchanged_progress_report_is_skipped(self, mock_vertica_python):
+        """
+        A progress report is only generated and sent again once the fingerprint of its source data changes.
+        """
+        state_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_directory)
+        fingerprint_store = ReportFingerprintStore(os.path.join(state_directory, 'fingerprints.json'))
+        cursor = mock_vertica_python.connect.return_value.cursor.return_value
+        cursor.fetchmany.return_value = []
+        cursor.fetchall.return_value = [(3, datetime.datetime(2018, 10, 1), None, datetime.date(2018, 10, 2), 1.5)]
+
+        senders = [self._create_sender(self.reporting_configs[0], fingerprint_store=fingerprint_store)]
+        senders[0].send_enterprise_report()
+        # A new store is read back from disk, as it would be on the next run.
+        fingerprint_store = ReportFingerprintStore(fingerprint_store.path)
+        senders.append(self._create_sender(self.reporting_configs[0], fingerprint_store=fingerprint_store))
+        senders[1].send_enterprise_report()
+        cursor.fetchall.return_value = [(4, datetime.datetime(2018, 10, 3), None, datetime.date(2018, 10, 3), 2.5)]
+        senders.append(self._create_sender(self.reporting_configs[0], fingerprint_store=fingerprint_store))
+        senders[2].send_enterprise_report()
+
+        assert [sender.delivery_method.send.call_count for sender in senders] == [1, 0, 1]
+        assert cursor.fetchall.call_count == 3
+
+    @mock.patch('enterprise_reporting.reporter.EnterpriseAPIClient')
+    def test_catalog_json_style_is_read_when_written(self, mock_enterprise_api_client):
+        """
+        The JSON report style is read from the environment when the report is written, and NDJSON reports are
+        written to a .jsonl file.
+        """
+        def get_content_metadata(*args):
+            content_metadata = DedupSpillStore()
+            content_metadata.add_items([
+                {'content_type': 'course', 'key': 'first'},
+                {'content_type': 'course', 'key': 'second'},
+            ], lambda item: item['key'])
+            return content_metadata
+
+        mock_enterprise_api_client.return_value.get_content_metadata.side_effect = get_content_metadata
+        reporting_config = dict(self.reporting_configs[0], data_type='catalog', report_type='json')
+        sender = self._create_sender(reporting_config)
+        sender.FILE_WRITE_DIRECTORY = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sender.FILE_WRITE_DIRECTORY)
+
+        with mock.patch.dict(os.environ, {'JSON_REPORT_STYLE': 'ndjson'}):
+            [report_file] = sender._generate_enterprise_report_catalog_json()
+        assert report_file.name.endswith('_catalog_json_{}.jsonl'.format(NOW))
+        with open(report_file.name) as data_report_file:
+            assert [json.loads(line)['key'] for line in data_report_file] == ['first', 'second']
+
+        with mock.patch.dict(os.environ, {'JSON_REPORT_STYLE': 'indented'}):
+            [report_file] = sender._generate_enterprise_report_catalog_json()
+        assert report_file.name.endswith('_catalog_json_{}.json'.format(NOW))
+        with open(report_file.name) as data_report_file:
+            assert [item['key'] for item in json.load(data_report_file)] == ['first', 'second']
+
+    @mock.patch('enterprise_reporting.reporter.EnterpriseAPIClient')
+    def test_catalog_parquet_columns_are_union_of_keys(self, mock_enterprise_api_client):
+        """
+        Keys missing from the first item of a content type still get a column in its Parquet file.
+        """
+        content_metadata = DedupSpillStore()
+        content_metadata.add_items([
+            {'key': 'edX+DemoX', 'content_type': 'course', 'title': 'Demo'},
+            {'key': 'edX+Other', 'content_type': 'course', 'title': 'Other', 'short_description': 'More'},
+            {'key': 'edX+Demo+2018', 'content_type': 'courserun', 'start': '2018-01-01'},
+        ], lambda item: item['key'])
+        mock_enterprise_api_client.return_value.get_content_metadata.return_value = content_metadata
+        reporting_config = dict(self.reporting_configs[0], data_type='catalog', report_type='parquet')
+
+        files = self._create_sender(reporting_config)._generate_enterprise_report_catalog_parquet()
+        for report_file in files:
+            self.addCleanup(os.remove, report_file.name)
+
+        assert [pq.read_table(report_file.name).to_pydict() for report_file in files] == [
+            {
+                'content_type': ['course', 'course'],
+                'key': ['edX+DemoX', 'edX+Other'],
+                'short_description': [None, 'More'],
+                'title': ['Demo', 'Other'],
+            },
+            {'content_type': ['courserun'], 'key': ['edX+Demo+2018'], 'start': ['2018-01-01']},
+        ]
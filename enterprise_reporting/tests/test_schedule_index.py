@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Test the reporting schedule index.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from enterprise_reporting.schedule_index import ReportingScheduleIndex, get_due_reporting_configs
+
+
+def _reporting_config(uuid, frequency, hour_of_day, day_of_month=None, day_of_week=None, active=True):
+    return {
+        'active': active,
+        'enterprise_customer': {'uuid': uuid, 'name': uuid},
+        'frequency': frequency,
+        'hour_of_day': hour_of_day,
+        'day_of_month': day_of_month,
+        'day_of_week': day_of_week,
+    }
+
+
+class TestReportingScheduleIndex(unittest.TestCase):
+    """
+    Test ReportingScheduleIndex.
+    """
+
+    def setUp(self):
+        super(TestReportingScheduleIndex, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.index_path = os.path.join(directory, 'index.json')
+        patcher = mock.patch('enterprise_reporting.schedule_index.SCHEDULE_INDEX_PATH', self.index_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # A Wednesday.
+        self.now = datetime.datetime(2018, 10, 17, 9)
+        self.reporting_configs = [
+            _reporting_config('daily', 'daily', 9),
+            _reporting_config('weekly', 'weekly', 9, day_of_week=2),
+            _reporting_config('monthly', 'monthly', 9, day_of_month=17),
+            _reporting_config('other-day', 'weekly', 9, day_of_week=3),
+            _reporting_config('other-hour', 'daily', 10),
+            _reporting_config('inactive', 'daily', 9, active=False),
+        ]
+
+    def test_due_enterprise_uuids(self):
+        index = ReportingScheduleIndex.from_reporting_configs(self.reporting_configs)
+        assert index.get_due_enterprise_uuids(self.now) == ['daily', 'monthly', 'weekly']
+
+    def test_save_and_load(self):
+        ReportingScheduleIndex.from_reporting_configs(self.reporting_configs).save()
+        index = ReportingScheduleIndex.load()
+        assert index.get_due_enterprise_uuids(self.now) == ['daily', 'monthly', 'weekly']
+        assert ReportingScheduleIndex.load(refresh_interval=0) is None
+
+    @mock.patch('enterprise_reporting.schedule_index.get_current_schedule_time')
+    def test_get_due_reporting_configs(self, mock_current_time):
+        mock_current_time.return_value = self.now
+        client = mock.Mock()
+        client.get_all_enterprise_reporting_configs.return_value = {'results': self.reporting_configs}
+        client.get_enterprise_reporting_configs.side_effect = lambda uuid: {
+            'results': [config for config in self.reporting_configs if config['enterprise_customer']['uuid'] == uuid]
+        }
+
+        # The first run builds the index from all configs.
+        configs = get_due_reporting_configs(client)
+        assert [config['enterprise_customer']['uuid'] for config in configs] == ['daily', 'weekly', 'monthly']
+        assert client.get_all_enterprise_reporting_configs.call_count == 1
+
+        # Later runs only fetch the configs of the enterprises that are due.
+        configs = get_due_reporting_configs(client)
+        assert [config['enterprise_customer']['uuid'] for config in configs] == ['daily', 'monthly', 'weekly']
+        assert client.get_all_enterprise_reporting_configs.call_count == 1
+        assert client.get_enterprise_reporting_configs.call_count == 3
+
+        get_due_reporting_configs(client, force_refresh=True)
+        assert client.get_all_enterprise_reporting_configs.call_count == 2
+
+    @mock.patch('enterprise_reporting.schedule_index.get_current_schedule_time')
+    def test_new_configs_are_picked_up_when_the_index_is_rebuilt(self, mock_current_time):
+        """
+        Between rebuilds, only the index is consulted; a config created since is due once the index expires.
+        """
+        mock_current_time.return_value = self.now
+        client = mock.Mock()
+        client.get_all_enterprise_reporting_configs.return_value = {'results': self.reporting_configs}
+        client.get_enterprise_reporting_configs.side_effect = lambda uuid: {
+            'results': [config for config in self.reporting_configs if config['enterprise_customer']['uuid'] == uuid]
+        }
+        get_due_reporting_configs(client)
+
+        self.reporting_configs.append(_reporting_config('created', 'daily', 9))
+        configs = get_due_reporting_configs(client)
+        assert 'created' not in [config['enterprise_customer']['uuid'] for config in configs]
+        assert client.get_all_enterprise_reporting_configs.call_count == 1
+
+        with mock.patch('enterprise_reporting.schedule_index.SCHEDULE_INDEX_REFRESH_INTERVAL', 0):
+            configs = get_due_reporting_configs(client)
+        assert 'created' in [config['enterprise_customer']['uuid'] for config in configs]
+        assert client.get_all_enterprise_reporting_configs.call_count == 2
@@ -4,13 +4,26 @@ Test utilities.
 """
 from __future__ import absolute_import, unicode_literals
 
+import csv
+import datetime
+import io
+import json
 import os
+import shutil
+import subprocess
+import sys
 import tempfile
 import unittest
+from collections import OrderedDict
+from decimal import Decimal
+from operator import itemgetter
 from zipfile import ZipFile
 
 import ddt
+import mock
 import pgpy
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pgpy.constants import CompressionAlgorithm, HashAlgorithm, KeyFlags, PubKeyAlgorithm, SymmetricKeyAlgorithm
 from pgpy.errors import PGPError
 
@@ -155,6 +168,386 @@ class TestUtilities(unittest.TestCase):
         with self.assertRaises(NotImplementedError):
             utils.flatten_dict(dictionary)
 
+    @ddt.data(
+        {'b': 1, 'a': [], 'c': {'d': 'e'}},
+        {'b': 2, 'a': ['x'], 'c': None},
+        {'b': 3, 'a': []},
+        {'b': 4, 'a': [], 'c': None, 'd': 'extra'},
+        {'a': 5},
+        {},
+    )
+    def test_compiled_flattener(self, item):
+        """CompiledFlattener produces the same rows as generate_data, whether or not the item matches its schema."""
+        flattener = utils.CompiledFlattener({'a': [], 'b': 0, 'c': None})
+        assert flattener.keys == utils.generate_data({'a': [], 'b': 0, 'c': None}, target='key')
+        assert flattener.values(item) == utils.generate_data(item, target='value')
+
+    def test_compiled_flattener_single_key(self):
+        """A schema of a single key still produces a row of values."""
+        assert utils.CompiledFlattener({'a': 1}).values({'a': []}) == ['']
+
+
+class TestCsvUnionWriter(unittest.TestCase):
+    """
+    Tests `CsvUnionWriter` writes a single header that fits every row.
+    """
+
+    def setUp(self):
+        super(TestCsvUnionWriter, self).setUp()
+        self.file_path = tempfile.NamedTemporaryFile(suffix='.csv', delete=False).name
+        self.addCleanup(os.remove, self.file_path)
+
+    def _write(self, items):
+        with utils.CsvUnionWriter(self.file_path) as writer:
+            writer.write_items(items)
+        with open(self.file_path, newline='') as report_file:
+            return list(csv.reader(report_file))
+
+    def test_same_keys(self):
+        """Items that share their keys are written as they were with a header from the first item."""
+        items = [{'b': 'x', 'a': []}, {'b': 'multi\nline, "quoted"', 'a': [1]}]
+        assert self._write(items) == [['a', 'b'], ['', 'x'], ['[1]', 'multi\nline, "quoted"']]
+        assert not os.path.exists(self.file_path + '.spill')
+
+    def test_new_and_missing_keys(self):
+        """Keys that only some items have are all in the header, and rows have '' where their item lacks a key."""
+        items = [{'b': 1, 'd': 2}, {'b': 3}, {'a': 4, 'b': 5, 'd': 6}, {'c': 7}]
+        assert self._write(items) == [
+            ['a', 'b', 'c', 'd'],
+            ['', '1', '', '2'],
+            ['', '3', '', ''],
+            ['4', '5', '', '6'],
+            ['', '', '7', ''],
+        ]
+        assert not os.path.exists(self.file_path + '.spill')
+
+    def test_rows_are_written_as_they_arrive(self):
+        """Without new keys, rows go straight to the report and no spill file is written."""
+        with utils.CsvUnionWriter(self.file_path) as writer:
+            writer.write_items([{'a': 1}, {'a': 2}])
+            writer._report_file.flush()  # pylint: disable=protected-access
+            assert not os.path.exists(self.file_path + '.spill')
+            with open(self.file_path, newline='') as report_file:
+                assert list(csv.reader(report_file)) == [['a'], ['1'], ['2']]
+
+    def test_no_items(self):
+        """A report without items only has an empty header row."""
+        assert self._write([]) == [[]]
+
+
+class TestDedupSpillStore(unittest.TestCase):
+    """
+    Tests `DedupSpillStore` de-duplicates items like an OrderedDict would.
+    """
+
+    def test_first_position_last_item(self):
+        """An item added under an existing key replaces the earlier one in its original position."""
+        items = [{'key': 'a', 'v': 1}, {'key': 'b', 'v': 2}, {'key': 'a', 'v': 3}, {'key': 'c', 'v': [4]}]
+        expected = OrderedDict()
+        for item in items:
+            expected[item['key']] = item
+
+        with utils.DedupSpillStore() as store:
+            store.add_items(items[:2], itemgetter('key'))
+            store.add_items(items[2:], itemgetter('key'))
+            assert len(store) == 3
+            assert list(store) == list(expected.values())
+            # The store can be iterated over more than once.
+            assert list(store) == list(expected.values())
+
+
+@ddt.ddt
+class TestWriteJsonRecords(unittest.TestCase):
+    """
+    Tests `write_json_records` streams records correctly.
+    """
+
+    RECORDS = [
+        {'course_id': 'course-v1:edX+DemoX+Demo_Course', 'has_passed': True, 'grades': []},
+        {'course_id': 'course-v1:edX+Test+2018', 'has_passed': False, 'grades': [{'percent': 0.5}]},
+    ]
+
+    @ddt.data([], RECORDS)
+    def test_indented_matches_json_dump(self, records):
+        """The default style produces exactly the same output as dumping the whole list at once."""
+        output = io.StringIO()
+        count = utils.write_json_records(iter(records), output)
+        assert count == len(records)
+        assert output.getvalue() == json.dumps(records, indent=4)
+
+    @ddt.data([], RECORDS)
+    def test_compact(self, records):
+        """The compact style is a valid JSON array without whitespace."""
+        output = io.StringIO()
+        utils.write_json_records(iter(records), output, style=utils.JSON_STYLE_COMPACT)
+        assert json.loads(output.getvalue()) == records
+        assert ', ' not in output.getvalue()
+
+    def test_ndjson(self):
+        """The ndjson style writes one record per line."""
+        output = io.StringIO()
+        utils.write_json_records(iter(self.RECORDS), output, style=utils.JSON_STYLE_NDJSON)
+        assert [json.loads(line) for line in output.getvalue().splitlines()] == self.RECORDS
+
+    def test_invalid_style(self):
+        with self.assertRaises(ValueError):
+            utils.write_json_records([], io.StringIO(), style='yaml')
+
+
+@ddt.ddt
+class TestParquetReportWriter(unittest.TestCase):
+    """
+    Tests `ParquetReportWriter` writes typed row groups correctly.
+    """
+
+    def setUp(self):
+        super(TestParquetReportWriter, self).setUp()
+        self.file_path = tempfile.NamedTemporaryFile(suffix='.parquet', delete=False).name
+        self.addCleanup(os.remove, self.file_path)
+
+    def test_inferred_types(self):
+        """Column types are inferred from the first row group, and nested values are stored as JSON."""
+        rows = [
+            [1, 'a', True, 0.5, {'key': 'value'}, None],
+            [2, 'b', False, 1, ['item'], None],
+            [3, 'c', None, None, None, None],
+        ]
+        with utils.ParquetReportWriter(self.file_path, ['int', 'str', 'bool', 'float', 'nested', 'null'],
+                                       row_group_size=2) as writer:
+            writer.write_rows(rows)
+
+        parquet_file = pq.ParquetFile(self.file_path)
+        assert parquet_file.num_row_groups == 2
+        schema = parquet_file.schema.to_arrow_schema()
+        assert [field.type for field in schema] == [
+            pa.int64(), pa.string(), pa.bool_(), pa.float64(), pa.string(), pa.string(),
+        ]
+        assert pq.read_table(self.file_path).to_pydict() == {
+            'int': [1, 2, 3],
+            'str': ['a', 'b', 'c'],
+            'bool': [True, False, None],
+            'float': [0.5, 1.0, None],
+            'nested': ['{"key": "value"}', '["item"]', None],
+            'null': [None, None, None],
+        }
+
+    def test_explicit_types(self):
+        """Values are coerced to the given column types."""
+        with utils.ParquetReportWriter(self.file_path, ['id', 'passed'], [pa.int64(), pa.bool_()]) as writer:
+            writer.write_row(['7', 1])
+
+        assert pq.read_table(self.file_path).to_pydict() == {'id': [7], 'passed': [True]}
+
+    def test_mixed_types_are_widened(self):
+        """Columns whose later values do not fit the type of their first row group are widened, not truncated."""
+        rows = [
+            [1, True, 1, 'a'],
+            [1.5, 'no', {'a': 1}, 2],
+        ]
+        with utils.ParquetReportWriter(self.file_path, ['number', 'flag', 'nested', 'text'],
+                                       row_group_size=1) as writer:
+            writer.write_rows(rows)
+
+        schema = pq.ParquetFile(self.file_path).schema.to_arrow_schema()
+        assert [field.type for field in schema] == [pa.float64(), pa.string(), pa.string(), pa.string()]
+        assert pq.read_table(self.file_path).to_pydict() == {
+            'number': [1.0, 1.5],
+            'flag': ['True', 'no'],
+            'nested': ['1', '{"a": 1}'],
+            'text': ['a', '2'],
+        }
+        assert not os.path.exists('{}.spill'.format(self.file_path))
+
+    def test_items_columns_are_union_of_keys(self):
+        """Without column names, the columns are the sorted union of the keys of all the items."""
+        with utils.ParquetReportWriter(self.file_path, row_group_size=1) as writer:
+            writer.write_item({'b': 1, 'a': 'x'})
+            writer.write_item({'c': None, 'a': 'y'})
+
+        assert pq.read_table(self.file_path).to_pydict() == {'a': ['x', 'y'], 'b': [1, None], 'c': [None, None]}
+
+    @ddt.data(
+        (pa.int64(), 1.5),
+        (pa.int64(), 'seven'),
+        (pa.bool_(), 'no'),
+        (pa.bool_(), 2),
+        (pa.float64(), {'a': 1}),
+        (pa.float64(), Decimal('1.00000000000000000001')),
+        (pa.decimal128(4, 2), Decimal('0.125')),
+        (pa.decimal128(4, 2), 1000),
+        (pa.date32(), datetime.datetime(2018, 1, 1, 12)),
+    )
+    @ddt.unpack
+    def test_explicit_types_do_not_lose_data(self, column_type, value):
+        """Values that would lose data when coerced to the given column type are rejected."""
+        with self.assertRaises(ValueError) as context:
+            with utils.ParquetReportWriter(self.file_path, ['column'], [column_type]) as writer:
+                writer.write_row([value])
+        assert str(context.exception).startswith('Column column: ')
+
+    def test_decimals_keep_their_precision(self):
+        """Decimal columns are stored as decimals wide enough for all of their values, and integers among them."""
+        rows = [
+            [Decimal('0.1'), Decimal('12345678901234567890.123456789'), Decimal('1.5')],
+            [Decimal('-20.25'), 7, 'text'],
+        ]
+        with utils.ParquetReportWriter(self.file_path, ['short', 'long', 'mixed'], row_group_size=1) as writer:
+            writer.write_rows(rows)
+
+        schema = pq.ParquetFile(self.file_path).schema.to_arrow_schema()
+        assert [field.type for field in schema] == [pa.decimal128(4, 2), pa.decimal128(29, 9), pa.string()]
+        assert pq.read_table(self.file_path).to_pydict() == {
+            'short': [Decimal('0.10'), Decimal('-20.25')],
+            'long': [Decimal('12345678901234567890.123456789'), Decimal('7.000000000')],
+            'mixed': ['1.5', 'text'],
+        }
+
+    def test_decimals_fit_float_columns_without_losing_precision(self):
+        """Decimals only go into a float64 column when the float converts back to the same decimal."""
+        with utils.ParquetReportWriter(self.file_path, ['hours'], [pa.float64()]) as writer:
+            writer.write_row([Decimal('1.25')])
+            writer.write_row([Decimal('0.1')])
+        assert pq.read_table(self.file_path).to_pydict() == {'hours': [1.25, 0.1]}
+
+        with self.assertRaises(ValueError):
+            with utils.ParquetReportWriter(self.file_path, ['hours'], [pa.float64()]) as writer:
+                writer.write_row([Decimal('0.12345678901234567890123')])
+
+    def test_column_type_aliases(self):
+        """Column types can be given by their alias."""
+        with utils.ParquetReportWriter(self.file_path, ['id', 'passed'], ['int64', 'bool']) as writer:
+            writer.write_row(['7', 1])
+
+        schema = pq.ParquetFile(self.file_path).schema.to_arrow_schema()
+        assert [field.type for field in schema] == [pa.int64(), pa.bool_()]
+
+    def test_utils_do_not_import_pyarrow(self):
+        """Only writing a Parquet report needs pyarrow, e.g. sending a report does not."""
+        subprocess.check_call([
+            sys.executable, '-c',
+            'import sys; import enterprise_reporting.delivery_method; assert "pyarrow" not in sys.modules',
+        ])
+
+    def test_no_rows(self):
+        """A file with the expected columns is written even when there are no rows."""
+        with utils.ParquetReportWriter(self.file_path, ['id', 'passed'], [pa.int64(), pa.bool_()]):
+            pass
+
+        table = pq.read_table(self.file_path)
+        assert table.num_rows == 0
+        assert table.schema.names == ['id', 'passed']
+
+
+@ddt.ddt
+class TestSendEmailWithAttachment(unittest.TestCase):
+    """
+    Tests `send_email_with_attachment` encodes the message once and sends it correctly.
+    """
+
+    RECIPIENTS = ['frodo@example.com', 'sam@example.com', 'merry@example.com']
+
+    def setUp(self):
+        super(TestSendEmailWithAttachment, self).setUp()
+        boto3_patcher = mock.patch('enterprise_reporting.utils.boto3')
+        self.mock_boto3 = boto3_patcher.start()
+        self.addCleanup(boto3_patcher.stop)
+        self.mock_ses = self.mock_boto3.client.return_value
+
+    def _sent_messages(self):
+        return [call[1] for call in self.mock_ses.send_raw_email.call_args_list]
+
+    def test_one_email_per_recipient(self):
+        """Each recipient gets their own email, which only differs by its To header."""
+        utils.send_email_with_attachment('Subject', 'Body', 'from@example.com', self.RECIPIENTS, 'report.zip', b'zip')
+
+        messages = self._sent_messages()
+        assert [message['Destinations'] for message in messages] == [[email] for email in self.RECIPIENTS]
+        for email, message in zip(self.RECIPIENTS, messages):
+            assert message['RawMessage']['Data'].startswith('To: {}\n'.format(email))
+            assert 'filename="report.zip"' in message['RawMessage']['Data']
+        assert len({message['RawMessage']['Data'].split('\n', 1)[1] for message in messages}) == 1
+
+    def test_batch_recipients(self):
+        """All recipients can share a single email, without seeing each other's addresses."""
+        utils.send_email_with_attachment(
+            'Subject', 'Body', 'from@example.com', self.RECIPIENTS, 'report.zip', b'zip', batch_recipients=True,
+        )
+
+        messages = self._sent_messages()
+        assert len(messages) == 1
+        assert messages[0]['Destinations'] == self.RECIPIENTS
+        assert messages[0]['RawMessage']['Data'].startswith('To: undisclosed-recipients:;\n')
+        for email in self.RECIPIENTS:
+            assert email not in messages[0]['RawMessage']['Data']
+
+    @mock.patch('enterprise_reporting.utils.REPORT_ATTACHMENT_BUCKET', 'reports-bucket')
+    def test_size_limit_counts_encoded_message_and_to_header(self):
+        """The size limit is checked against the encoded message, including its To header."""
+        attachment_data = b'z' * 2048
+        raw_message = utils._get_raw_message('Subject', 'Body', 'from@example.com', 'report.zip', attachment_data)
+        to_header = 'To: {}\n'.format(self.RECIPIENTS[0])
+
+        with mock.patch('enterprise_reporting.utils.SES_MAX_RAW_MESSAGE_SIZE', len(to_header) + len(raw_message)):
+            utils.send_email_with_attachment(
+                'Subject', 'Body', 'from@example.com', self.RECIPIENTS[:1], 'report.zip', attachment_data,
+            )
+        sent_message = self._sent_messages()[-1]['RawMessage']['Data']
+        assert len(sent_message) == len(to_header) + len(raw_message)
+        assert 'filename="report.zip"' in sent_message
+
+        with mock.patch('enterprise_reporting.utils.SES_MAX_RAW_MESSAGE_SIZE', len(to_header) + len(raw_message) - 1):
+            utils.send_email_with_attachment(
+                'Subject', 'Body', 'from@example.com', self.RECIPIENTS[:1], 'report.zip', attachment_data,
+            )
+        assert 'attachment' not in self._sent_messages()[-1]['RawMessage']['Data']
+        self.mock_boto3.client.return_value.put_object.assert_called_once_with(
+            Bucket='reports-bucket', Key=mock.ANY, Body=attachment_data,
+        )
+
+    @mock.patch('enterprise_reporting.utils.SES_MAX_RAW_MESSAGE_SIZE', 1024)
+    @mock.patch('enterprise_reporting.utils.REPORT_ATTACHMENT_BUCKET', 'reports-bucket')
+    def test_large_attachment_is_linked(self):
+        """Attachments that are too large for SES are uploaded to S3 and linked instead."""
+        self.mock_boto3.client.return_value.generate_presigned_url.return_value = 'https://s3.example.com/report.zip'
+
+        utils.send_email_with_attachment(
+            'Subject', 'Body', 'from@example.com', self.RECIPIENTS[:1], 'report.zip', b'z' * 2048,
+        )
+
+        self.mock_boto3.client.return_value.put_object.assert_called_once_with(
+            Bucket='reports-bucket', Key=mock.ANY, Body=b'z' * 2048,
+        )
+        raw_message = self._sent_messages()[0]['RawMessage']['Data']
+        assert 'https://s3.example.com/report.zip' in raw_message
+        assert 'attachment' not in raw_message
+
+
+    @mock.patch('enterprise_reporting.utils.SES_MAX_RAW_MESSAGE_SIZE', 1024)
+    @mock.patch('enterprise_reporting.utils.REPORT_ATTACHMENT_BUCKET', None)
+    def test_large_attachment_without_bucket(self):
+        """Attachments that are too large for SES raise an error when there is no bucket to upload them to."""
+        with self.assertRaises(ValueError):
+            utils.send_email_with_attachment(
+                'Subject', 'Body', 'from@example.com', self.RECIPIENTS[:1], 'report.zip', b'z' * 2048,
+            )
+        assert not self._sent_messages()
+
+    @mock.patch('enterprise_reporting.utils.SES_MAX_RAW_MESSAGE_SIZE', 1024)
+    @mock.patch('enterprise_reporting.utils.REPORT_ATTACHMENT_BUCKET', 'reports-bucket')
+    def test_large_attachment_file_is_not_read(self):
+        """Attachment files whose size alone exceeds the SES limit are not read into an email."""
+        with tempfile.NamedTemporaryFile(suffix='.zip') as attachment_file:
+            attachment_file.write(b'z' * 1024)
+            attachment_file.flush()
+            with mock.patch('enterprise_reporting.utils.MIMEApplication') as mime_application:
+                utils.send_email_with_attachment(
+                    'Subject', 'Body', 'from@example.com', self.RECIPIENTS[:1], attachment_file.name,
+                )
+
+        mime_application.assert_not_called()
+        self.mock_boto3.client.return_value.upload_file.assert_called_once_with(
+            attachment_file.name, 'reports-bucket', mock.ANY,
+        )
 
 @ddt.ddt
 class TestCompressEncrypt(unittest.TestCase):
@@ -239,6 +632,73 @@ class TestCompressEncrypt(unittest.TestCase):
             with self.assertRaises(RuntimeError):
                 zipfile.read(file['file'].name.split('/')[-1], b'gollum')
 
+    @ddt.data(0, 9)
+    def test_compress_in_parallel(self, compression_level):
+        """
+        Test that files compressed in parallel end up in a single password protected zip file.
+        """
+        files, _ = self.create_files([{'size': 1000}, {'size': 500}, {'size': 2000}])
+
+        password = b'frodo-baggins'
+        compressed_file = utils.compress_and_encrypt(
+            [file['file'] for file in files],
+            password,
+            compression_level=compression_level,
+            workers=2,
+        )
+
+        zipfile = ZipFile(compressed_file, 'r')
+        self.assertEqual(
+            zipfile.namelist(),
+            [file['file'].name.split('/')[-1] for file in files],
+        )
+        for file in files:
+            content = zipfile.read(file['file'].name.split('/')[-1], password)
+            self.assertEqual(content, file['size'] * b'i')
+            with self.assertRaises(RuntimeError):
+                zipfile.read(file['file'].name.split('/')[-1], b'gollum')
+        self.assertFalse(os.path.exists(compressed_file + '.part0'))
+
+    def create_zip_archives(self, count):
+        """Create `count` single-entry zip archives, and return their names."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        archive_names = []
+        for index in range(count):
+            archive_name = os.path.join(directory, 'part{}.zip'.format(index))
+            with ZipFile(archive_name, 'w') as archive:
+                archive.writestr('file{}.txt'.format(index), index * b'i')
+            archive_names.append(archive_name)
+        return archive_names
+
+    def test_merge_zip_archives(self):
+        """
+        Test that the entries of merged archives can be read from the output.
+        """
+        archive_names = self.create_zip_archives(3)
+        output_name = archive_names[0] + '.merged'
+
+        utils._merge_zip_archives(archive_names, output_name)  # pylint: disable=protected-access
+
+        with ZipFile(output_name) as zipfile:
+            self.assertEqual(zipfile.namelist(), ['file0.txt', 'file1.txt', 'file2.txt'])
+            self.assertEqual(zipfile.read('file2.txt'), b'ii')
+
+    @mock.patch('enterprise_reporting.utils.ZIP_MAX_SIZE', 100)
+    def test_merge_zip_archives_needing_zip64(self):
+        """
+        Test that archives too large to merge without Zip64 extensions are refused before any output is written.
+        """
+        archive_names = self.create_zip_archives(3)
+        output_name = archive_names[0] + '.merged'
+
+        with mock.patch('enterprise_reporting.utils._copy_bytes') as copy_bytes:
+            with self.assertRaises(ValueError):
+                utils._merge_zip_archives(archive_names, output_name)  # pylint: disable=protected-access
+
+        copy_bytes.assert_not_called()
+        self.assertFalse(os.path.exists(output_name))
+
     @ddt.data(
         [
             {
@@ -276,5 +736,33 @@ class TestCompressEncrypt(unittest.TestCase):
         decrypted_message = correct_key.decrypt(message)
         self.assertIsInstance(decrypted_message, pgpy.PGPMessage)
 
+        # Verify the decrypted message is a zip of the files, which was never written unencrypted.
+        self.assertFalse(os.path.exists(encrypted_file_name[:-len('.pgp')]))
+        zipfile = ZipFile(io.BytesIO(bytes(decrypted_message.message)))
+        for file in files:
+            self.assertEqual(zipfile.read(os.path.basename(file['file'].name)), file['size'] * b'i')
+
         with self.assertRaises(PGPError):
             wrong_key.decrypt(message)
+
+    @ddt.data(1, 2)
+    @mock.patch('enterprise_reporting.utils.PGP_PARTIAL_BODY_LENGTH_BITS', 9)
+    def test_encryption_with_partial_body_lengths(self, workers):
+        """
+        Test that archives spanning many partial body lengths decrypt to the files, whether or not they are
+        compressed in parallel.
+        """
+        files = []
+        for _ in range(2):
+            report_file = tempfile.NamedTemporaryFile(suffix='.txt')
+            report_file.write(os.urandom(5000))
+            report_file.flush()
+            files.append(report_file)
+        key = self.pgpy_create_key('JohnDoe')
+
+        encrypted_file_name = utils.compress_and_encrypt(files, None, str(key.pubkey), workers=workers)
+
+        zipfile = ZipFile(io.BytesIO(bytes(key.decrypt(pgpy.PGPMessage.from_file(encrypted_file_name)).message)))
+        for report_file in files:
+            report_file.seek(0)
+            self.assertEqual(zipfile.read(os.path.basename(report_file.name)), report_file.read())
@@ -3,10 +3,43 @@
 Test Vertica client.
 """
 
+import datetime
 import unittest
 
-from enterprise_reporting import clients
+import mock
+
+from enterprise_reporting.clients.vertica import VerticaClient, format_datetime_columns
 
 
 class TestVerticaClient(unittest.TestCase):
-	pass
+
+    ROWS = [
+        (1, datetime.datetime(2018, 9, 1, 10, 30, 5, 123), None),
+        (2, None, datetime.datetime(2018, 10, 2, 1, 2, 3)),
+        (3, datetime.datetime(2019, 1, 1), datetime.date(2019, 1, 2)),
+    ]
+
+    def test_format_datetime_columns(self):
+        """
+        Datetimes are formatted without microseconds, anything else is left untouched.
+        """
+        assert format_datetime_columns(self.ROWS) == [
+            (1, '2018-09-01 10:30:05', None),
+            (2, None, '2018-10-02 01:02:03'),
+            (3, '2019-01-01 00:00:00', datetime.date(2019, 1, 2)),
+        ]
+
+    def test_stream_result_batches(self):
+        """
+        Results are fetched with fetchmany and yielded in formatted batches.
+        """
+        client = VerticaClient()
+        client.connection = mock.Mock()
+        cursor = client.connection.cursor.return_value
+        cursor.fetchmany.side_effect = [self.ROWS[:2], self.ROWS[2:], []]
+
+        batches = list(client.stream_result_batches('SELECT 1', batch_size=2))
+
+        cursor.execute.assert_called_once_with('SELECT 1')
+        cursor.fetchmany.assert_called_with(2)
+        assert batches == [format_datetime_columns(self.ROWS[:2]), format_datetime_columns(self.ROWS[2:])]
@@ -4,75 +4,430 @@ Utility functions for Enterprise Reporting.
 """
 from __future__ import absolute_import, unicode_literals
 
+import csv
 import datetime
+import hashlib
+import json
 import logging
 import os
+import pickle
 import re
-from collections import OrderedDict
+import shutil
+import sqlite3
+import struct
+import textwrap
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from decimal import Decimal
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from io import open  # pylint: disable=redefined-builtin
+from itertools import islice
+from operator import itemgetter
+from zipfile import ZIP_DEFLATED, ZipFile
 
 import boto3
 import pgpy
 import pyminizip
 import pytz
 from cryptography.fernet import Fernet
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from fernet_fields.hkdf import derive_fernet_key
+from pgpy.constants import SymmetricKeyAlgorithm
 
 from django.utils.encoding import force_text
 
 LOGGER = logging.getLogger(__name__)
 
-COMPRESSION_LEVEL = 4
+COMPRESSION_LEVEL = int(os.environ.get('REPORT_COMPRESSION_LEVEL', 4))
+COMPRESSION_WORKERS = int(os.environ.get('REPORT_COMPRESSION_WORKERS', 1))
+ZIP_CENTRAL_DIRECTORY_SIGNATURE = b'PK\x01\x02'
+ZIP_CENTRAL_DIRECTORY_STRUCT = struct.Struct('<4s4B4HL2L5H2L')
+ZIP_END_OF_CENTRAL_DIRECTORY_SIGNATURE = b'PK\x05\x06'
+ZIP_END_OF_CENTRAL_DIRECTORY_STRUCT = struct.Struct('<4s4H2LH')
+ZIP_MAX_SIZE = 0xFFFFFFFF
+PGP_CHUNK_SIZE = 1024 * 1024
+
+PGP_PACKET_TAG_PUBLIC_KEY_ENCRYPTED_SESSION_KEY = 1
+PGP_PACKET_TAG_LITERAL_DATA = 11
+PGP_PACKET_TAG_SYM_ENCRYPTED_INTEGRITY_PROTECTED_DATA = 18
+PGP_MODIFICATION_DETECTION_CODE_HEADER = b'\xd3\x14'
+# Partial body lengths of 1 MB.
+PGP_PARTIAL_BODY_LENGTH_BITS = 20
 
 FREQUENCY_TYPE_DAILY = 'daily'
 FREQUENCY_TYPE_MONTHLY = 'monthly'
 FREQUENCY_TYPE_WEEKLY = 'weekly'
 
 AWS_REGION = 'us-east-1'
+SES_MAX_DESTINATIONS = 50
+# Recipients sharing an email are only listed in its envelope, so they do not see each other's addresses.
+BATCH_EMAIL_TO_HEADER = 'To: undisclosed-recipients:;\n'
+SES_MAX_RAW_MESSAGE_SIZE = int(os.environ.get('SES_MAX_RAW_MESSAGE_SIZE', 10 * 1024 * 1024))
+REPORT_ATTACHMENT_BUCKET = os.environ.get('REPORT_ATTACHMENT_BUCKET')
+REPORT_ATTACHMENT_LINK_EXPIRATION = int(os.environ.get('REPORT_ATTACHMENT_LINK_EXPIRATION', 7 * 24 * 60 * 60))
+# Allows pointing S3 at a local stand-in, e.g. for benchmarks.
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+REPORT_LINK_EMAIL_BODY = """
+    The file was too large to be attached to this email. It can be downloaded for the next {days} days from:
+    {link}
+"""
+
+JSON_STYLE_INDENTED = 'indented'
+JSON_STYLE_COMPACT = 'compact'
+JSON_STYLE_NDJSON = 'ndjson'
+JSON_STYLES = (JSON_STYLE_INDENTED, JSON_STYLE_COMPACT, JSON_STYLE_NDJSON)
+
+PARQUET_ROW_GROUP_SIZE = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', 50000))
+PARQUET_COMPRESSION = os.environ.get('PARQUET_COMPRESSION', 'snappy')
+# The widest decimal Arrow holds in a decimal128 column; decimals with more digits are stored as strings.
+ARROW_MAX_DECIMAL_PRECISION = 38
 
 
-def compress_and_encrypt(files, password=None, pgp_key=''):
+def compress_and_encrypt(files, password=None, pgp_key='', compression_level=COMPRESSION_LEVEL, workers=1):
     """
     Given file(s) and a password or a PGP key,
     create a password protected or encrypted compressed file.
     Return the new filename.
+
+    With more than one worker, multiple files are compressed in parallel (see `_get_compressed_file`).
     """
     if pgp_key:
-        zipfile = _get_compressed_file(files)
-        return _get_encrypted_file(zipfile, pgp_key)
+        return _get_encrypted_file(files, pgp_key, compression_level, workers)
     else:
-        return _get_compressed_file(files, password)
+        return _get_compressed_file(files, password, compression_level, workers)
 
 
-def _get_encrypted_file(zipfile, pgp_key):
+def _get_encrypted_file(files, pgp_key, compression_level=COMPRESSION_LEVEL, workers=1):
     """
-    Given a file and a pgp public key, create an encrypted file. Return the new filename.
+    Given file(s) and a pgp public key, create an encrypted zip file. Return the new filename.
+
+    The zip is not password protected, so the files are zipped with the standard library straight into the
+    encrypted data, a chunk at a time: no unencrypted archive is written and memory usage does not depend on
+    the size of the files. Files compressed in parallel are first merged into an archive that is then
+    encrypted the same way. pgpy is only used to encrypt the random AES-256 session key for the public key;
+    the encrypted data packet that follows is written here (see `_pgp_encrypted_literal_data`).
     """
     rsa_pub, _ = pgpy.PGPKey.from_blob(pgp_key)
-    message = pgpy.PGPMessage.new(zipfile, file=True)
+    session_key = os.urandom(32)
+    zipfile = _get_zip_file_name(files)
     pgpfile = '{}.pgp'.format(zipfile)
-    encrypted_message = rsa_pub.encrypt(message)
-    with open(pgpfile, 'wb') as encrypted_file:
-        encrypted_file.write(encrypted_message.__bytes__())
+    try:
+        with open(pgpfile, 'wb') as encrypted_file:
+            encrypted_file.write(_get_pgp_session_key_packets(rsa_pub, SymmetricKeyAlgorithm.AES256, session_key))
+            with _pgp_encrypted_literal_data(encrypted_file, session_key, os.path.basename(zipfile)) as literal_data:
+                if _should_compress_in_parallel(files, workers):
+                    _compress_in_parallel([f.name for f in files], zipfile, None, compression_level, workers)
+                    try:
+                        with open(zipfile, 'rb') as plain_file:
+                            shutil.copyfileobj(plain_file, literal_data, PGP_CHUNK_SIZE)
+                    finally:
+                        os.remove(zipfile)
+                else:
+                    with ZipFile(literal_data, 'w', ZIP_DEFLATED, compresslevel=compression_level) as archive:
+                        for report_file in files:
+                            archive.write(report_file.name, os.path.basename(report_file.name))
+    except Exception:
+        os.remove(pgpfile)
+        raise
     return pgpfile
 
 
-def _get_compressed_file(files, password=None):
+def _get_pgp_session_key_packets(public_key, cipher, session_key):
+    """
+    Return the serialized public-key encrypted session key packet(s) for `session_key`.
+
+    pgpy has no streaming API, so a tiny message is encrypted with our session key and everything but its
+    session key packets is discarded.
+    """
+    encrypted_message = public_key.encrypt(pgpy.PGPMessage.new('session key'), cipher=cipher, sessionkey=session_key)
+    return b''.join(
+        packet for tag, packet in _iter_pgp_packets(bytes(encrypted_message))
+        if tag == PGP_PACKET_TAG_PUBLIC_KEY_ENCRYPTED_SESSION_KEY
+    )
+
+
+def _iter_pgp_packets(data):
+    """
+    Split serialized OpenPGP data into (tag, packet bytes) pairs.
+
+    Handles old and new format packet headers with definite lengths, which is all pgpy produces.
+    """
+    offset = 0
+    while offset < len(data):
+        start = offset
+        packet_tag_byte = data[offset]
+        offset += 1
+        if packet_tag_byte & 0x40:
+            tag = packet_tag_byte & 0x3f
+            first_octet = data[offset]
+            if first_octet < 192:
+                length, offset = first_octet, offset + 1
+            elif first_octet < 224:
+                length, offset = ((first_octet - 192) << 8) + data[offset + 1] + 192, offset + 2
+            elif first_octet == 255:
+                length, offset = struct.unpack('>I', data[offset + 1:offset + 5])[0], offset + 5
+            else:
+                raise ValueError('Partial body lengths are not supported')
+        else:
+            tag = (packet_tag_byte >> 2) & 0x0f
+            length_size = {0: 1, 1: 2, 2: 4}.get(packet_tag_byte & 0x03)
+            if length_size is None:
+                length = len(data) - offset
+            else:
+                length = int.from_bytes(data[offset:offset + length_size], 'big')
+                offset += length_size
+        offset += length
+        yield tag, data[start:offset]
+
+
+def _pgp_length(length):
+    """
+    Return the new format OpenPGP encoding of a definite packet body length.
+    """
+    if length < 192:
+        return bytes([length])
+    elif length < 8384:
+        return bytes([((length - 192) >> 8) + 192, (length - 192) & 0xff])
+    return b'\xff' + struct.pack('>I', length)
+
+
+class PGPPartialBodyWriter(object):
+    """
+    Writes the body of a new format OpenPGP packet whose length is not known up front.
+
+    The body is written as partial body lengths (RFC 4880, section 4.2.2.4) of `2 ** PGP_PARTIAL_BODY_LENGTH_BITS`
+    bytes, followed by a definite length for what is left when the writer is closed, so there is no limit on the
+    size of the packet.
+    """
+
+    def __init__(self, output, tag):
+        self.output = output
+        self.buffer = bytearray()
+        self.output.write(bytes([0xc0 | tag]))
+
+    def write(self, data):
+        """Append data to the packet body, writing out every full partial body."""
+        self.buffer += data
+        partial_body_length = 1 << PGP_PARTIAL_BODY_LENGTH_BITS
+        while len(self.buffer) >= partial_body_length:
+            self.output.write(bytes([224 + PGP_PARTIAL_BODY_LENGTH_BITS]) + self.buffer[:partial_body_length])
+            del self.buffer[:partial_body_length]
+        return len(data)
+
+    def flush(self):
+        """Nothing is written out before a full partial body is buffered."""
+
+    def close(self):
+        """Write the rest of the packet body with a definite length."""
+        self.output.write(_pgp_length(len(self.buffer)) + self.buffer)
+        self.buffer = bytearray()
+
+
+class PGPEncryptor(object):
+    """
+    Encrypts the plaintext written to it with AES-256 in CFB mode, keeping track of its modification detection code.
+    """
+
+    def __init__(self, output, session_key):
+        self.output = output
+        self.encryptor = Cipher(
+            algorithms.AES(session_key), modes.CFB(b'\x00' * 16), backend=default_backend()
+        ).encryptor()
+        self.modification_detection_code = hashlib.sha1()
+
+    def write(self, data):
+        """Encrypt and write plaintext."""
+        self.modification_detection_code.update(data)
+        self.output.write(self.encryptor.update(data))
+        return len(data)
+
+    def close(self):
+        """Encrypt and write the modification detection code packet, which covers all the plaintext before it."""
+        self.write(PGP_MODIFICATION_DETECTION_CODE_HEADER)
+        self.output.write(
+            self.encryptor.update(self.modification_detection_code.digest()) + self.encryptor.finalize()
+        )
+
+
+@contextmanager
+def _pgp_encrypted_literal_data(encrypted_file, session_key, filename):
+    """
+    Yield a file-like object whose data is written to `encrypted_file` as an encrypted binary literal data packet.
+
+    The literal data packet is the plaintext of a symmetrically encrypted integrity protected data packet
+    (RFC 4880, section 5.13), followed by a modification detection code packet. Both packets are written with
+    partial body lengths, so the data is encrypted as it is written, without knowing its size.
+    """
+    encrypted_data = PGPPartialBodyWriter(encrypted_file, PGP_PACKET_TAG_SYM_ENCRYPTED_INTEGRITY_PROTECTED_DATA)
+    # The encrypted data is preceded by the packet version number.
+    encrypted_data.write(b'\x01')
+    plaintext = PGPEncryptor(encrypted_data, session_key)
+    # A random block, with its last two octets repeated so that decryption can quickly check the key.
+    prefix = os.urandom(16)
+    plaintext.write(prefix + prefix[-2:])
+
+    literal_data = PGPPartialBodyWriter(plaintext, PGP_PACKET_TAG_LITERAL_DATA)
+    filename = filename.encode('utf-8')[:255]
+    literal_data.write(b'b' + bytes([len(filename)]) + filename + struct.pack('>I', int(time.time())))
+    yield literal_data
+    literal_data.close()
+    plaintext.close()
+    encrypted_data.close()
+
+
+def _get_zip_file_name(files):
+    """
+    Return the name of the zip file for the given file(s), which replaces the data and report type with `.zip`.
+    """
+    return re.sub(r'(_(\w+))?\.(\w+)$', '.zip', files[0].name)
+
+
+def _should_compress_in_parallel(files, workers):
+    """
+    Return whether the files should be compressed into separate archives in parallel, then merged.
+    """
+    return len(files) > 1 and workers > 1 and all(os.path.getsize(f.name) < ZIP_MAX_SIZE for f in files)
+
+
+def _get_compressed_file(files, password=None, compression_level=COMPRESSION_LEVEL, workers=1):
     """
     Given file(s) and a password, create a zip file. Return the new filename.
+
+    When there are multiple files and more than one worker, each file is compressed (and encrypted) into its own
+    archive by a separate process, and the archives are then merged into one without recompressing.
     """
     multiple_files = len(files) > 1
-    # Replace the data and report type with just `.zip`.
-    zipfile = re.sub(r'(_(\w+))?\.(\w+)$', '.zip', files[0].name)
+    zipfile = _get_zip_file_name(files)
+    file_names = [f.name for f in files]
+    if _should_compress_in_parallel(files, workers):
+        _compress_in_parallel(file_names, zipfile, password, compression_level, workers)
+        return zipfile
     compression = pyminizip.compress_multiple if multiple_files else pyminizip.compress
-    compression([f.name for f in files] if multiple_files else files[0].name, zipfile, password, COMPRESSION_LEVEL)
+    compression(file_names if multiple_files else files[0].name, zipfile, password, compression_level)
     return zipfile
 
 
-def send_email_with_attachment(subject, body, from_email, to_email, filename, attachment_data=None):
+def _compress_in_parallel(file_names, zipfile, password, compression_level, workers):
+    """
+    Compress each file into a single-entry archive in a pool of processes, then merge them into `zipfile`.
+    """
+    part_names = ['{}.part{}'.format(zipfile, index) for index in range(len(file_names))]
+    LOGGER.info('Compressing {} files with {} workers...'.format(len(file_names), workers))
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Consume the results so that any exception raised by a worker is raised here.
+            list(executor.map(
+                pyminizip.compress,
+                file_names,
+                part_names,
+                [password] * len(file_names),
+                [compression_level] * len(file_names),
+            ))
+        _merge_zip_archives(part_names, zipfile)
+    finally:
+        for part_name in part_names:
+            if os.path.exists(part_name):
+                os.remove(part_name)
+
+
+def _merge_zip_archives(archive_names, output_name):
+    """
+    Merge zip archives into a single archive without recompressing or re-encrypting their entries.
+
+    Local file headers and entry data are copied verbatim, so password protected entries stay protected. Only
+    the central directory, which holds each entry's offset, is rewritten. Zip64 archives are not supported.
+    """
+    # Work out where every entry will be before writing anything, so that an archive that would need Zip64
+    # extensions is refused up front instead of after copying gigabytes of data.
+    archives = []
+    entries = []
+    central_directory_offset = 0
+    for archive_name in archive_names:
+        with ZipFile(archive_name) as archive:
+            entries.extend((info, central_directory_offset + info.header_offset) for info in archive.infolist())
+            # Everything before the central directory is local headers and data.
+            archives.append((archive_name, archive.start_dir))
+            central_directory_offset += archive.start_dir
+    if central_directory_offset > ZIP_MAX_SIZE or len(entries) > 0xFFFF:
+        raise ValueError('Merged archive {} would need Zip64 extensions'.format(output_name))
+
+    try:
+        with open(output_name, 'wb') as output:
+            for archive_name, length in archives:
+                with open(archive_name, 'rb') as archive_file:
+                    _copy_bytes(archive_file, output, length)
+
+            for info, header_offset in entries:
+                output.write(_zip_central_directory_record(info, header_offset))
+            central_directory_size = output.tell() - central_directory_offset
+
+            output.write(ZIP_END_OF_CENTRAL_DIRECTORY_STRUCT.pack(
+                ZIP_END_OF_CENTRAL_DIRECTORY_SIGNATURE,
+                0,
+                0,
+                len(entries),
+                len(entries),
+                central_directory_size,
+                central_directory_offset,
+                0,
+            ))
+    except Exception:
+        if os.path.exists(output_name):
+            os.remove(output_name)
+        raise
+
+
+def _zip_central_directory_record(info, header_offset):
+    """
+    Serialize the central directory record of a ZipInfo read from another archive, at a new offset.
+    """
+    year, month, day, hour, minute, second = info.date_time
+    filename = info.orig_filename.encode('utf-8' if info.flag_bits & 0x800 else 'cp437')
+    return ZIP_CENTRAL_DIRECTORY_STRUCT.pack(
+        ZIP_CENTRAL_DIRECTORY_SIGNATURE,
+        info.create_version,
+        info.create_system,
+        info.extract_version,
+        info.reserved,
+        info.flag_bits,
+        info.compress_type,
+        hour << 11 | minute << 5 | second // 2,
+        (year - 1980) << 9 | month << 5 | day,
+        info.CRC,
+        info.compress_size,
+        info.file_size,
+        len(filename),
+        len(info.extra),
+        len(info.comment),
+        0,
+        info.internal_attr,
+        info.external_attr,
+        header_offset,
+    ) + filename + info.extra + info.comment
+
+
+def _copy_bytes(source, destination, length):
+    """
+    Copy the first `length` bytes of the `source` file into `destination`.
+    """
+    source.seek(0)
+    while length > 0:
+        chunk = source.read(min(length, PGP_CHUNK_SIZE))
+        if not chunk:
+            break
+        destination.write(chunk)
+        length -= len(chunk)
+
+
+def send_email_with_attachment(
+        subject, body, from_email, to_email, filename, attachment_data=None, batch_recipients=False,
+):
     """
     Send an email with a file attachment.
 
@@ -84,46 +439,448 @@ def send_email_with_attachment(subject, body, from_email, to_email, filename, at
     set attachment_data to anything. This gives us the option of
     handing this function string data that lives in memory instead
     of needing to first write to a file.
+
+    The message is built and encoded once; each email only gets its own `To` header prepended. By default
+    every recipient gets a separate email addressed to them, but with `batch_recipients` up to
+    `SES_MAX_DESTINATIONS` recipients share one, addressed to undisclosed recipients so that they do not see each
+    other's addresses. If an encoded email would exceed the SES size limit, the attachment is uploaded to the
+    `REPORT_ATTACHMENT_BUCKET` S3 bucket instead and the email contains a presigned link to it; without a bucket,
+    a ValueError is raised.
     """
     # connect to SES
     client = boto3.client('ses', region_name=AWS_REGION)
 
-    # the message body
-    msg_body = MIMEText(body)
-    
-    # the attachment
-    if attachment_data:
-        msg_attachment = MIMEApplication(attachment_data)
+    if batch_recipients:
+        recipient_groups = [
+            to_email[index:index + SES_MAX_DESTINATIONS] for index in range(0, len(to_email), SES_MAX_DESTINATIONS)
+        ]
+        to_headers = [BATCH_EMAIL_TO_HEADER] * len(recipient_groups)
     else:
-        msg_attachment = MIMEApplication(open(filename, 'rb').read())
-    msg_attachment.add_header('Content-Disposition', 'attachment', filename=os.path.basename(filename))
-    msg_attachment.set_type('application/zip')
-
-    # iterate over each email in the list to send emails independently
-    for email in to_email:
-        msg = MIMEMultipart()
-        msg['Subject'] = subject
-        msg['From'] = from_email
-        msg['To'] = email
-
-        # what a recipient sees if they don't use an email reader
-        msg.preamble = 'Multipart message.\n'
-
-        # attach the message body and attachment
-        msg.attach(msg_body)
-        msg.attach(msg_attachment)
+        # send emails to each recipient independently
+        recipient_groups = [[email] for email in to_email]
+        to_headers = ['To: {}\n'.format(email) for email in to_email]
 
-        # and send the message
-        result = client.send_raw_email(RawMessage={'Data': msg.as_string()}, Source=msg['From'], Destinations=[email])
+    attachment_size = len(attachment_data) if attachment_data else os.path.getsize(filename)
+    # The encoded message is never smaller than the encoded attachment, so only read the file and build the
+    # message when it could fit.
+    raw_message = None
+    if _get_base64_size(attachment_size) <= SES_MAX_RAW_MESSAGE_SIZE:
+        raw_message = _get_raw_message(subject, body, from_email, filename, attachment_data)
+    too_large = raw_message is None or any(
+        len(to_header) + len(raw_message) > SES_MAX_RAW_MESSAGE_SIZE for to_header in to_headers
+    )
+    if too_large:
+        if not REPORT_ATTACHMENT_BUCKET:
+            raise ValueError(
+                'Attachment {} ({} bytes) is too large to be emailed through SES, and REPORT_ATTACHMENT_BUCKET is '
+                'not set to upload it to instead'.format(filename, attachment_size)
+            )
+        link = _upload_attachment(filename, attachment_data)
+        body += REPORT_LINK_EMAIL_BODY.format(days=REPORT_ATTACHMENT_LINK_EXPIRATION // (24 * 60 * 60), link=link)
+        raw_message = _get_raw_message(subject, body, from_email)
+
+    for recipients, to_header in zip(recipient_groups, to_headers):
+        result = client.send_raw_email(
+            RawMessage={'Data': to_header + raw_message},
+            Source=from_email,
+            Destinations=recipients,
+        )
         LOGGER.debug(result)
 
 
+def _get_base64_size(size):
+    """
+    Return the size of `size` bytes once base64 encoded into an email, in lines of 76 characters.
+    """
+    encoded_size = (size + 2) // 3 * 4
+    return encoded_size + (encoded_size + 75) // 76
+
+
+def _get_raw_message(subject, body, from_email, filename=None, attachment_data=None):
+    """
+    Build and encode an email without its `To` header, attaching the file if a `filename` is given.
+    """
+    msg = MIMEMultipart()
+    msg['Subject'] = subject
+    msg['From'] = from_email
+
+    # what a recipient sees if they don't use an email reader
+    msg.preamble = 'Multipart message.\n'
+
+    # attach the message body and attachment
+    msg.attach(MIMEText(body))
+    if filename:
+        if attachment_data:
+            msg_attachment = MIMEApplication(attachment_data)
+        else:
+            with open(filename, 'rb') as attachment_file:
+                msg_attachment = MIMEApplication(attachment_file.read())
+        msg_attachment.add_header('Content-Disposition', 'attachment', filename=os.path.basename(filename))
+        msg_attachment.set_type('application/zip')
+        msg.attach(msg_attachment)
+
+    return msg.as_string()
+
+
+def _upload_attachment(filename, attachment_data=None):
+    """
+    Upload an attachment that is too large to be emailed to S3, and return a presigned link to download it.
+    """
+    client = boto3.client('s3', region_name=AWS_REGION, endpoint_url=S3_ENDPOINT_URL)
+    key = 'enterprise-reports/{}/{}'.format(uuid.uuid4(), os.path.basename(filename))
+    LOGGER.info('Attachment {} is too large to be emailed, uploading it to S3 as {}'.format(filename, key))
+    if attachment_data:
+        client.put_object(Bucket=REPORT_ATTACHMENT_BUCKET, Key=key, Body=attachment_data)
+    else:
+        client.upload_file(filename, REPORT_ATTACHMENT_BUCKET, key)
+    return client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': REPORT_ATTACHMENT_BUCKET, 'Key': key},
+        ExpiresIn=REPORT_ATTACHMENT_LINK_EXPIRATION,
+    )
+
+
+def write_json_records(records, output_file, style=JSON_STYLE_INDENTED):
+    """
+    Incrementally write an iterable of JSON-serializable records to an open text file.
+
+    Only one record is encoded at a time, so the size of the report does not affect memory usage.
+
+    The available styles are:
+        * indented: A JSON array identical to `json.dump(list(records), output_file, indent=4)`.
+        * compact: A JSON array without any whitespace between tokens.
+        * ndjson: Newline-delimited JSON, i.e. one compact JSON document per line.
+
+    Returns the number of records written.
+    """
+    if style not in JSON_STYLES:
+        raise ValueError('Invalid JSON style: {}'.format(style))
+
+    compact_separators = (',', ':')
+    if style == JSON_STYLE_NDJSON:
+        count = 0
+        for record in records:
+            output_file.write(json.dumps(record, separators=compact_separators))
+            output_file.write('\n')
+            count += 1
+        return count
+
+    if style == JSON_STYLE_COMPACT:
+        opening, delimiter, closing = '[', ',', ']'
+
+        def encode(record):
+            return json.dumps(record, separators=compact_separators)
+    else:
+        opening, delimiter, closing = '[\n', ',\n', '\n]'
+
+        def encode(record):
+            return textwrap.indent(json.dumps(record, indent=4), '    ')
+
+    count = 0
+    for record in records:
+        output_file.write(delimiter if count else opening)
+        output_file.write(encode(record))
+        count += 1
+    output_file.write(closing if count else '[]')
+    return count
+
+
+class ParquetReportWriter(object):
+    """
+    Writes rows to a Parquet file, one row group at a time.
+
+    Rows are sequences of values in the same order as `column_names`. When `column_types` are given, each row
+    group is written as soon as it is full, and values that do not fit their column's type raise a ValueError.
+    Otherwise rows are spilled to a file next to the report while the type of each column is inferred from all
+    of its values (see `infer_arrow_type` and `widen_arrow_type`), and the row groups are written from the
+    spill file when the report is closed, so e.g. a column of integers that later holds a float is stored as
+    floats rather than truncated. Nested JSON values end up as JSON strings in a string column.
+
+    Without `column_names`, items are written with `write_item` and the columns are the sorted union of the
+    keys of all the items, as with `CsvUnionWriter`.
+
+    `column_types` are Arrow types or their aliases, e.g. 'int64'. pyarrow is only imported by this writer, so
+    that the rest of this module does not depend on it. Only `row_group_size` rows are held in memory at once.
+    """
+
+    def __init__(self, file_path, column_names=None, column_types=None, row_group_size=PARQUET_ROW_GROUP_SIZE):
+        """Initialize the writer. Nothing is written to the report until the first row group is full."""
+        import pyarrow as pa  # pylint: disable=import-outside-toplevel
+        self.name = file_path
+        self.column_names = list(column_names) if column_names is not None else None
+        self.column_types = None
+        if column_types is not None:
+            self.column_types = [
+                pa.type_for_alias(column_type) if isinstance(column_type, str) else column_type
+                for column_type in column_types
+            ]
+        self.row_group_size = row_group_size
+        self._rows = []
+        self._writer = None
+        self._inferred_types = dict.fromkeys(self.column_names or [])
+        self._spill_path = '{}.spill'.format(file_path)
+        self._spill_file = open(self._spill_path, 'wb') if self.column_types is None else None
+        self._arrow_types_by_python_type = get_arrow_types_by_python_type()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_row(self, row):
+        """Buffer a single row, writing out a row group when enough rows are buffered."""
+        if self._spill_file is not None:
+            self._infer_types(zip(self.column_names, row))
+        self._rows.append(row)
+        if len(self._rows) >= self.row_group_size:
+            self._flush_rows()
+
+    def write_rows(self, rows):
+        """Buffer an iterable of rows, writing out row groups as they fill up."""
+        for row in rows:
+            self.write_row(row)
+
+    def write_item(self, item):
+        """Buffer a dict item of a writer created without `column_names`, adding any new keys as columns."""
+        self._infer_types(item.items())
+        self._rows.append(item)
+        if len(self._rows) >= self.row_group_size:
+            self._flush_rows()
+
+    def close(self):
+        """Write any buffered rows and finalize the file."""
+        self._flush_rows()
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._write_spilled_rows()
+        if self._writer is None:
+            import pyarrow as pa  # pylint: disable=import-outside-toplevel
+            import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+            # No rows at all: still produce a valid file with the expected columns.
+            column_names = self.column_names or []
+            column_types = self.column_types or [pa.string()] * len(column_names)
+            self._writer = pq.ParquetWriter(
+                self.name,
+                self._build_table([[] for _ in column_names], column_names, column_types).schema,
+                compression=PARQUET_COMPRESSION,
+            )
+        self._writer.close()
+
+    def _infer_types(self, named_values):
+        """Widen the inferred type of each column to fit the given (column name, value) pairs."""
+        inferred_types = self._inferred_types
+        arrow_types_by_python_type = self._arrow_types_by_python_type
+        for name, value in named_values:
+            value_type = arrow_types_by_python_type.get(type(value))
+            if value_type is None and value is not None:
+                value_type = get_arrow_type(value)
+            if name not in inferred_types:
+                inferred_types[name] = value_type
+            # Most values have the type already inferred for their column, so check for that cheaply first.
+            elif value_type is not None and value_type is not inferred_types[name]:
+                inferred_types[name] = widen_arrow_type(inferred_types[name], value_type)
+
+    def _flush_rows(self):
+        """Write the buffered rows as a row group, or to the spill file while column types are being inferred."""
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        if self._spill_file is not None:
+            pickle.dump(rows, self._spill_file, pickle.HIGHEST_PROTOCOL)
+        else:
+            self._write_row_group(rows)
+
+    def _write_spilled_rows(self):
+        """Write the spilled rows as row groups with the inferred column types, then remove the spill file."""
+        if self.column_names is None:
+            self.column_names = sorted(self._inferred_types)
+        self.column_types = [self._inferred_types[name] or get_arrow_type('') for name in self.column_names]
+        with open(self._spill_path, 'rb') as spill_file:
+            while True:
+                try:
+                    rows = pickle.load(spill_file)
+                except EOFError:
+                    break
+                if rows and isinstance(rows[0], dict):
+                    rows = [[item.get(name) for name in self.column_names] for item in rows]
+                self._write_row_group(rows)
+        os.remove(self._spill_path)
+        self._spill_file = None
+
+    def _write_row_group(self, rows):
+        """Convert rows into a table and write it as a row group."""
+        columns = [list(column) for column in zip(*rows)]
+        table = self._build_table(columns, self.column_names, self.column_types)
+        if self._writer is None:
+            import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+            self._writer = pq.ParquetWriter(self.name, table.schema, compression=PARQUET_COMPRESSION)
+        self._writer.write_table(table)
+
+    @staticmethod
+    def _build_table(columns, column_names, column_types):
+        """Build a table from columns of raw values."""
+        import pyarrow as pa  # pylint: disable=import-outside-toplevel
+        arrays = []
+        for column, column_name, column_type in zip(columns, column_names, column_types):
+            try:
+                values = [coerce_arrow_value(value, column_type) for value in column]
+            except ValueError as error:
+                raise ValueError('Column {}: {}'.format(column_name, error))
+            arrays.append(pa.array(values, type=column_type))
+        return pa.Table.from_arrays(arrays, names=column_names)
+
+
+@lru_cache(maxsize=None)
+def get_arrow_types_by_python_type():
+    """
+    Return the Arrow type a column of each Python type is stored as, with None for nulls.
+
+    Values of other types are typed by `get_arrow_type`.
+    """
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+    return {type(None): None, bool: pa.bool_(), int: pa.int64(), float: pa.float64(), str: pa.string()}
+
+
+def get_arrow_type(value):
+    """
+    Return the Arrow type a column holding the value would be stored as, or None for a null.
+
+    Booleans, integers and floats get their own types, and decimals get a decimal type just wide enough for
+    them; anything else is stored as a string.
+    """
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+    arrow_type = get_arrow_types_by_python_type().get(type(value), pa.string())
+    if isinstance(value, Decimal):
+        if not value.is_finite():
+            return pa.string()
+        _, digits, exponent = value.as_tuple()
+        scale = max(-exponent, 0)
+        return _get_decimal_arrow_type(max(len(digits) + exponent, 0) + scale, scale)
+    return arrow_type
+
+
+def _get_decimal_arrow_type(precision, scale):
+    """
+    Return the decimal128 type of the given precision and scale, or the string type if it is too wide.
+    """
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+    if precision > ARROW_MAX_DECIMAL_PRECISION:
+        return pa.string()
+    return pa.decimal128(max(precision, 1), scale)
+
+
+def infer_arrow_type(values):
+    """
+    Infer the Arrow type of a column from a sample of its values, or return None if they are all null.
+
+    Booleans, integers, floats and decimals get their own types; anything else is stored as a string.
+    """
+    arrow_type = None
+    for value in values:
+        arrow_type = widen_arrow_type(arrow_type, get_arrow_type(value))
+    return arrow_type
+
+
+def widen_arrow_type(arrow_type, other_type):
+    """
+    Return the narrowest Arrow type that holds the values of both types without losing data.
+
+    Integers and floats widen to floats, integers and decimals to decimals wide enough for both, and any other
+    mix of types to strings. None stands for a column with only nulls so far.
+    """
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+    if arrow_type is None or arrow_type == other_type:
+        return other_type
+    if other_type is None:
+        return arrow_type
+    if {arrow_type, other_type} == {pa.int64(), pa.float64()}:
+        return pa.float64()
+    decimal_types = [
+        # An int64 has up to 19 digits.
+        pa.decimal128(19, 0) if column_type == pa.int64() else column_type
+        for column_type in (arrow_type, other_type)
+    ]
+    if all(pa.types.is_decimal(column_type) for column_type in decimal_types):
+        scale = max(column_type.scale for column_type in decimal_types)
+        integer_digits = max(column_type.precision - column_type.scale for column_type in decimal_types)
+        return _get_decimal_arrow_type(integer_digits + scale, scale)
+    return pa.string()
+
+
+def coerce_arrow_value(value, arrow_type):
+    """
+    Coerce a value returned by Vertica or one of the APIs into something Arrow accepts for the given type.
+
+    Values are only converted when no data is lost, e.g. 1.5 is not truncated into an int64 column and a
+    decimal only goes into a float64 column if the float converts back to the same decimal; anything else
+    raises a ValueError.
+    """
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+    if value is None:
+        return None
+    if arrow_type == pa.string():
+        if isinstance(value, str):
+            return value
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, sort_keys=True)
+        return str(value)
+    if arrow_type == pa.bool_():
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, int) and value in (0, 1):
+            return bool(value)
+    elif arrow_type == pa.int64():
+        if isinstance(value, int):
+            return int(value)
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if isinstance(value, Decimal) and value == value.to_integral_value():
+            return int(value)
+        if isinstance(value, str) and re.match(r'^[-+]?\d+$', value.strip()):
+            return int(value)
+    elif arrow_type == pa.float64():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+        if isinstance(value, (Decimal, str)):
+            try:
+                number = float(value)
+                if Decimal(repr(number)) == Decimal(value):
+                    return number
+            except (ValueError, ArithmeticError):
+                pass
+    elif pa.types.is_decimal(arrow_type):
+        if isinstance(value, (int, Decimal, str)) and not isinstance(value, bool):
+            try:
+                number = Decimal(value)
+            except ArithmeticError:
+                number = None
+            if number is not None and number.is_finite() and widen_arrow_type(
+                    arrow_type, get_arrow_type(number)) == arrow_type:
+                return number
+    elif arrow_type == pa.date32():
+        if isinstance(value, datetime.datetime):
+            if value.time() == datetime.time(0):
+                return value.date()
+        elif isinstance(value, datetime.date):
+            return value
+    else:
+        return value
+    raise ValueError('{!r} does not fit the {} type without losing data'.format(value, arrow_type))
+
+
+def get_current_schedule_time():
+    """
+    Return the current time in the timezone reporting schedules are configured in.
+    """
+    return datetime.datetime.now(pytz.timezone('US/Eastern'))
+
+
 def is_current_time_in_schedule(frequency, hour_of_day, day_of_month=None, day_of_week=None):
     """
     Determine if the current time is in the range specified by this configuration's schedule.
     """
-    est_timezone = pytz.timezone('US/Eastern')
-    current_est_time = datetime.datetime.now(est_timezone)
+    current_est_time = get_current_schedule_time()
     current_hour_of_day = current_est_time.hour
     current_day_of_week = current_est_time.weekday()
     current_day_of_month = current_est_time.day
@@ -162,8 +919,8 @@ def flatten_dict(d, target='key' or 'value'):
 
     The behavior is as such for targeting keys:
         * Each key is concatenated into the list.
-        * Each key with a list value has the list's indices formatted (see [1]) and concatenated into the list.
-        * Each key with a dict value has the dict's sub-keys formatted (see [1]) and concatenated into the list.
+        * Each key with a list value has the list's indices formatted as `<key>_<index>` and concatenated into the list.
+        * Each key with a dict value has its sub-keys formatted as `<key>_<sub-key>` and concatenated into the list.
         * Sub-objects are recursively flattened.
 
     The behavior is as such for targeting values:
@@ -173,63 +930,61 @@ def flatten_dict(d, target='key' or 'value'):
 
     WARNING: Appropriately flattening lists with a mixture of dict and non-dict objects within them is unsupported.
 
-    [1]: The nested-value formatting function can be found nested within this function. (No pun intended).
-
-    # TODO: This beastly mess of a house of cards *needs* a refactor at some point. Make do with comments for now.
     # TODO: This can probably be separated into a dedicated Python library somewhere sometime in the future.
     """
-    def format_nested(nested, _key=None):
-        if _key is None:
-            _key = key
-        return '{}_{}'.format(_key, nested)
-
     flattened = []
-    target_is_key = target == 'key'
-    for key, value in OrderedDict(sorted(d.items())).items():
+    _flatten_dict_into(flattened, d, target == 'key', '')
+    return flattened
+
+
+def _flatten_dict_into(flattened, d, target_is_key, prefix):
+    """
+    Append the flattened keys or values of `d` to the list `flattened`, prefixing keys with `prefix`.
+
+    Keys are built by prefix concatenation while recursing, rather than re-formatting each flattened sub-list.
+    """
+    for key in sorted(d):
+        value = d[key]
+        key = '{}{}'.format(prefix, key)
 
         # Simple case: recursively flatten the dictionary.
         if isinstance(value, dict):
-            flattened += map(
-                format_nested if target_is_key else lambda x: x,
-                flatten_dict(value, target=target)
-            )
+            _flatten_dict_into(flattened, value, target_is_key, key + '_')
 
         # We are suddenly in muddy waters, because lists can have multiple types within them in JSON.
         elif isinstance(value, list):
-            items_are_dict = [isinstance(item, dict) for item in value]
-            items_are_list = [isinstance(item, list) for item in value]
+            dict_count = list_count = 0
+            for item in value:
+                if isinstance(item, dict):
+                    dict_count += 1
+                elif isinstance(item, list):
+                    list_count += 1
 
             # To help reduce the complexity here, let's not support this case.
             # Besides, most sensible APIs won't bump into this case.
-            if any(items_are_dict) and not all(items_are_dict):
+            if dict_count and dict_count != len(value):
                 raise NotImplementedError("Ability to flatten dict with list of mixed dict and non-dict types "
                                           "is not currently supported")
 
             # Same here, this is just weird.
-            if any(items_are_list):
+            if list_count:
                 raise NotImplementedError("Ability to flatten a dict with lists within lists "
                                           "is not currently supported. And we'd like to ask you to take it easy.")
 
-            # This case is common, but a little complex.
-            elif all(items_are_dict):
+            # This case is common, but a little complex: prepend the dict's index in the list to its keys.
+            elif dict_count:
                 for index, item in enumerate(value):
-                    _flattened_dict = flatten_dict(item, target=target)
-
-                    # In this case we actually want to prepend the dict's index in the list to each flattened dict.
-                    if target_is_key:
-                        _flattened_dict = [format_nested(flattened_item, _key=index)
-                                           for flattened_item in _flattened_dict]
-
-                    flattened += map(format_nested if target_is_key else lambda x: x, _flattened_dict)
+                    _flatten_dict_into(flattened, item, target_is_key, '{}_{}_'.format(key, index))
 
             # All items are non-dict, so just directly add either the index or the value.
+            elif target_is_key:
+                flattened.extend('{}_{}'.format(key, index) for index in range(len(value)))
             else:
-                flattened += map(format_nested, range(len(value))) if target_is_key else value
+                flattened.extend(value)
 
         # Kindergarten -- just add to the list.
         else:
             flattened.append(key if target_is_key else value)
-    return flattened
 
 
 def generate_data(item, target='key' or 'value'):
@@ -237,12 +992,13 @@ def generate_data(item, target='key' or 'value'):
     Either return a list of JSON data objects or
     List of headers depends upon the target.
     """
+    keys = sorted(item)
+    if target == 'key':
+        return keys
+
     data = []
-    target_is_key = target == 'key'
-    for key, value in OrderedDict(sorted(item.items())).items():
-        if target_is_key:
-            data.append(key)
-            continue
+    for key in keys:
+        value = item[key]
 
         # For empty list we are just writing an empty string ''.
         if isinstance(value, list) and not len(value):
@@ -251,3 +1007,157 @@ def generate_data(item, target='key' or 'value'):
         data.append(value)
 
     return data
+
+
+class CompiledFlattener(object):
+    """
+    Produce `generate_data` rows for many items that share the same keys, e.g. catalog items of one content type.
+
+    The sorted key schema is derived once from a sample item and values are then read with a single
+    `itemgetter` call per item, instead of sorting every item's keys again. Items whose keys differ from the
+    schema fall back to `generate_data`, so the rows are always the same as `generate_data` would produce.
+    """
+
+    def __init__(self, sample_item):
+        self.keys = sorted(sample_item)
+        self.key_set = frozenset(self.keys)
+        if not self.keys:
+            self._get_values = lambda item: ()
+        elif len(self.keys) == 1:
+            single_key = self.keys[0]
+            self._get_values = lambda item: (item[single_key],)
+        else:
+            self._get_values = itemgetter(*self.keys)
+
+    def values(self, item):
+        """
+        Return the row of values for `item`, in the order of `keys`.
+        """
+        if not self._matches(item):
+            return generate_data(item, target='value')
+        # For empty list we are just writing an empty string ''.
+        return ['' if value == [] else value for value in self._get_values(item)]
+
+    def aligned_values(self, item):
+        """
+        Return the values of `item` for exactly the keys in `keys`, with '' for the keys `item` lacks.
+        """
+        values = self._get_values(item) if self._matches(item) else [item.get(key, '') for key in self.keys]
+        return ['' if value == [] else value for value in values]
+
+    def _matches(self, item):
+        """Return True if `item` has exactly the keys of the schema."""
+        return bool(self.keys) and len(item) == len(self.keys) and item.keys() == self.key_set
+
+
+class CsvUnionWriter(object):
+    """
+    Writes dict items to a CSV file whose header is the sorted union of the keys of all the items.
+
+    Rows are written straight to the report as they arrive, under a header made of the keys of the first item, so
+    no items are held in memory. Only if new keys appear in later items is the report moved to a spill file when
+    it is closed, and rewritten from it with the final header, each row realigned to it with '' for the keys its
+    item lacked.
+    """
+
+    def __init__(self, file_path):
+        """Initialize the writer and open the report file."""
+        self.name = file_path
+        self.row_count = 0
+        self._spill_path = '{}.spill'.format(file_path)
+        self._report_file = open(file_path, 'w')
+        self._writer = csv.writer(self._report_file)
+        self._flattener = None
+        # The row index from which each successive set of keys was used, along with those keys.
+        self._schemas = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_item(self, item):
+        """Write the row for a single item, widening the schema if the item has new keys."""
+        if self._flattener is None or not item.keys() <= self._flattener.key_set:
+            keys = set(item).union(self._flattener.keys if self._flattener else [])
+            self._flattener = CompiledFlattener(dict.fromkeys(keys))
+            if not self._schemas:
+                self._writer.writerow(self._flattener.keys)
+            self._schemas.append((self.row_count, self._flattener.keys))
+        self._writer.writerow(self._flattener.aligned_values(item))
+        self.row_count += 1
+
+    def write_items(self, items):
+        """Write the rows for an iterable of items."""
+        for item in items:
+            self.write_item(item)
+
+    def close(self):
+        """Finish the report, rewriting it with the final header if new keys appeared after the first item."""
+        if not self._schemas:
+            self._writer.writerow([])
+        self._report_file.close()
+        if len(self._schemas) <= 1:
+            return
+        os.rename(self.name, self._spill_path)
+        header = self._flattener.keys
+        with open(self._spill_path, newline='') as spill_file, open(self.name, 'w') as report_file:
+            reader = csv.reader(spill_file)
+            writer = csv.writer(report_file)
+            # Skip the header of the first item's keys.
+            next(reader)
+            writer.writerow(header)
+            ends = [start for start, _ in self._schemas[1:]] + [self.row_count]
+            for (start, keys), end in zip(self._schemas, ends):
+                positions = {key: index for index, key in enumerate(keys)}
+                indices = [positions.get(key) for key in header]
+                for row in islice(reader, end - start):
+                    writer.writerow(['' if index is None else row[index] for index in indices])
+        os.remove(self._spill_path)
+
+
+class DedupSpillStore(object):
+    """
+    A de-duplicating, insertion-ordered store of JSON-serializable items that spills to disk instead of memory.
+
+    Behaves like an `OrderedDict` of key to item that is only iterated over: adding an item under an existing
+    key replaces the earlier item but keeps its original position. Items are kept in a private temporary
+    SQLite database, which SQLite moves to disk once it outgrows its page cache and deletes when closed.
+    """
+
+    def __init__(self):
+        """Create the temporary database."""
+        self._connection = sqlite3.connect('')
+        self._connection.execute('CREATE TABLE items (key TEXT PRIMARY KEY, item TEXT NOT NULL)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+    def __iter__(self):
+        """Lazily iterate over the items, in the order their keys were first added."""
+        for (item,) in self._connection.execute('SELECT item FROM items ORDER BY rowid'):
+            yield json.loads(item)
+
+    def add(self, key, item):
+        """Add an item, replacing the item previously added under the same key, if any."""
+        serialized_item = json.dumps(item)
+        # Updating in place keeps the rowid, and so the position, of the first item added under the key.
+        if not self._connection.execute('UPDATE items SET item = ? WHERE key = ?', (serialized_item, key)).rowcount:
+            self._connection.execute('INSERT INTO items (key, item) VALUES (?, ?)', (key, serialized_item))
+
+    def add_items(self, items, get_key):
+        """Add an iterable of items in a single transaction, keyed by `get_key(item)`."""
+        with self._connection:
+            for item in items:
+                self.add(get_key(item), item)
+
+    def close(self):
+        """Close and delete the temporary database."""
+        self._connection.close()